@@ -3,11 +3,33 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import concurrent.futures
 import copy
 import datetime
-from CarmSimulatorScene import CarmSimulatorScene
+import time
+from vtk.util import numpy_support
+from CarmSimulatorScene import CarmSimulatorScene, SceneModels, LumbarSpineVolumeName, ScoliosisVolumeName
+from CarmSimulatorCore import CarmSimulatorCore
+from CarmSimulatorDRRCache import CarmSimulatorDRRCache
+from CarmSimulatorScheduler import CarmSimulatorDRRScheduler
+from CarmSimulatorMotion import CarmSimulatorMotionController
+from CarmSimulatorDRRWorker import CarmSimulatorDRRWorker
+from CarmSimulatorLOD import CarmSimulatorLODManager
+from CarmSimulatorCaseLibrary import CarmSimulatorCaseLibrary
+from CarmSimulatorProfiler import CarmSimulatorProfiler
+from CarmSimulatorSessionStore import CarmSimulatorSessionStore
+from CarmSimulatorScoring import CarmSimulatorTargetScorer, TargetViewPoses, ReadReferenceImage
+from CarmSimulatorPoseSolver import SolvePose, PoseError, LoadOptimalPoses, SaveOptimalPose
+from CarmSimulatorCollision import CarmSimulatorCollisionChecker, CollisionPairs
+from CarmSimulatorDose import CarmSimulatorDoseMap, CollimationFraction
+from CarmSimulatorRecorder import CarmSimulatorPoseRecorder, CarmSimulatorReplay, ReadRecording, \
+    EventPose, EventShot, EventCollect, EventFieldOfView
 #import CarmSimulatorScene
 
+# Pose (C, gantry, wag, table, zoom) and field of view every training module starts from
+TrainingPose = [0.0, 0.0, 0.0, 0.0, 27.0]
+TrainingFieldOfView = 46.0
+
 # TEST COMMIT LINE
 #
 # Carm Simulator
@@ -52,18 +74,15 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
 
     @vtk.calldata_type(vtk.VTK_INT)
     def updateTransforms(self, caller, event, calldata):
+        # Slider valueChanged signals forward the new value to the logic
         if calldata == 1:
             self.xRotationSliderWidget.value += 1
-            self.logic.UpdateCRotation(self.xRotationSliderWidget.value)
         elif calldata == 2:
             self.xRotationSliderWidget.value -= 1
-            self.logic.UpdateCRotation(self.xRotationSliderWidget.value)
         elif calldata == 3:
             self.zRotationSliderWidget.value += 1
-            self.logic.UpdateGantryRotation(self.zRotationSliderWidget.value)
         elif calldata == 4:
             self.zRotationSliderWidget.value -= 1
-            self.logic.UpdateGantryRotation(self.zRotationSliderWidget.value)
 
     @vtk.calldata_type(vtk.VTK_OBJECT)
     def interactorCallback(self, caller, event, calldata):
@@ -79,6 +98,8 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         #print("Action") # 2.0 for pressed 3.0 for released
         #print(action)
 
+        self.logic.RecordInput([trackpadPositionX, trackpadPositionY, device, input, action])
+
         if input == 4:
             if action == 3:
                 self.logic.CollectImage(True)
@@ -90,32 +111,34 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
                self.onShootFluoroButtonClicked(True)
             return
         if trackpadPositionX == 0:
-            self.direction = 0
+            self.motionController.SetDirection(0)
             return
 
         # Set C-arm Movement Direction
+        direction = 0
         if device == 1:
             if trackpadPositionX > 0:
                 if trackpadPositionY > 0:
-                    self.direction = 1
+                    direction = 1
                 else:
-                    self.direction = 2
+                    direction = 2
             else:
                 if trackpadPositionY > 0:
-                    self.direction = 3
+                    direction = 3
                 else:
-                    self.direction = 4
+                    direction = 4
         elif device == 2:
             if trackpadPositionX > 0:
                 if trackpadPositionY > 0:
-                    self.direction = 5
+                    direction = 5
                 else:
-                    self.direction = 6
+                    direction = 6
             else:
                 if trackpadPositionY > 0:
-                    self.direction = 7
+                    direction = 7
                 else:
-                    self.direction = 8
+                    direction = 8
+        self.motionController.SetDirection(direction)
 
 
         # Do Nothing unless we receive a release event from the trigger
@@ -124,35 +147,16 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
 
 
 
-    def processOneThing(self):
-        #if self.movement:
-        #print(direction)
-        if self.direction == 1:
-            self.xRotationSliderWidget.value -= 0.5
-            self.logic.UpdateCRotation(self.xRotationSliderWidget.value)
-        elif self.direction == 2:
-            self.xRotationSliderWidget.value += 0.5
-            self.logic.UpdateCRotation(self.xRotationSliderWidget.value)
-        elif self.direction == 3:
-            self.zRotationSliderWidget.value -= 0.5
-            self.logic.UpdateGantryRotation(self.zRotationSliderWidget.value)
-        elif self.direction == 4:
-            self.zRotationSliderWidget.value += 0.5
-            self.logic.UpdateGantryRotation(self.zRotationSliderWidget.value)
-        elif self.direction == 5:
-            self.wagRotationSliderWidget.value += 0.1
-            self.logic.UpdateWagRotation(self.wagRotationSliderWidget.value)
-        elif self.direction == 6:
-            self.wagRotationSliderWidget.value -= 0.1
-            self.logic.UpdateWagRotation(self.wagRotationSliderWidget.value)
-        elif self.direction == 7:
-            self.tableSliderWidget.value += 0.5
-            self.logic.UpdateTable(self.tableSliderWidget.value)
-        elif self.direction == 8:
-            self.tableSliderWidget.value -= 0.5
-            self.logic.UpdateTable(self.tableSliderWidget.value)
-
-
+    def onMotionStep(self, axis, delta):
+        # Slider valueChanged signals forward the new value to the logic
+        if axis == "C":
+            self.xRotationSliderWidget.value += delta
+        elif axis == "Gantry":
+            self.zRotationSliderWidget.value += delta
+        elif axis == "Wag":
+            self.wagRotationSliderWidget.value += delta
+        elif axis == "Table":
+            self.tableSliderWidget.value += delta
 
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
@@ -179,6 +183,21 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         self.toggleDRRButton.connect('toggled(bool)', self.onToggleDRRButtonClicked)
         parametersFormLayout.addRow("Toggle DRR", self.toggleDRRButton)
 
+        # DRR Backend
+        self.drrBackendComboBox = qt.QComboBox()
+        self.drrBackendComboBox.addItems(["VTK", "CPU"])
+        self.drrBackendComboBox.setToolTip("VTK renders the DRR offscreen with OpenGL, CPU ray casts it with NumPy.")
+        self.drrBackendComboBox.connect('currentTextChanged(QString)', self.onDRRBackendChanged)
+        parametersFormLayout.addRow("DRR Backend", self.drrBackendComboBox)
+
+        # X-ray beam of the CPU backend
+        self.drrBeamComboBox = qt.QComboBox()
+        self.drrBeamComboBox.addItems(["Transfer Function", "60 kVp", "70 kVp", "80 kVp", "90 kVp", "100 kVp", "120 kVp"])
+        self.drrBeamComboBox.setToolTip("Transfer Function uses the opacities of VolumeProperty.vp, a kVp simulates "
+                                        "the polychromatic tube spectrum. CPU backend only.")
+        self.drrBeamComboBox.connect('currentTextChanged(QString)', self.onDRRBeamChanged)
+        parametersFormLayout.addRow("X-ray Beam", self.drrBeamComboBox)
+
         # Toggle VR Button - TO DO
         self.toggleVRButton = qt.QCheckBox()
         self.toggleVRButton.connect('toggled(bool)', self.onToggleVRButtonClicked)
@@ -256,6 +275,18 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         self.collectImageButton.connect('clicked(bool)', self.onCollectImageButtonClicked)
         parametersFormLayout.addRow(self.collectImageButton)
 
+        # Similarity of the monitor image to the view being asked for
+        self.targetScoreLabel = qt.QLabel('-')
+        parametersFormLayout.addRow("Target Match", self.targetScoreLabel)
+
+        # Models the C-arm is touching, moves into them are blocked
+        self.collisionLabel = qt.QLabel('-')
+        parametersFormLayout.addRow("Collision", self.collisionLabel)
+
+        # Dose area product and peak skin dose of the shots taken so far
+        self.doseLabel = qt.QLabel('-')
+        parametersFormLayout.addRow("Dose", self.doseLabel)
+
         # Shoot Fluoro Button
         self.shootFluoroButton = qt.QPushButton('ShootFluoro')
         self.shootFluoroButton.connect('clicked(bool)', self.onShootFluoroButtonClicked)
@@ -263,6 +294,11 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
 
         # Create Logic Instance
         self.logic = CarmSimulatorLogic()
+        self.logic.targetScoreCallback = self.onTargetScoreChanged
+        self.logic.collisionCallback = self.onCollisionChanged
+        self.logic.doseCallback = self.onDoseChanged
+        # Replays move the C-arm without the sliders, the sliders only follow
+        self.logic.replayPoseCallback = lambda: self.syncSlidersToPose(blockSignals=True)
 
         # Disable All Buttons until generate scene is clicked
         self.toggleDRRButton.setDisabled(True)
@@ -290,14 +326,8 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         #    self.useGestureRecognition = False
 
         #self.useGestureRecognition = False
-        self.timer = qt.QTimer()
-        self.elapsed = qt.QElapsedTimer()
-        self.timerIteration = 0
-        self.movement = 1
-        self.direction = 0
-        self.timer.connect('timeout()', self.processOneThing)
-        #self.timer.setInterval(30)
-        self.timer.start()
+        # Trackpad motion, only ticks while a direction is held
+        self.motionController = CarmSimulatorMotionController(self.onMotionStep)
 
 
 
@@ -318,15 +348,14 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
     def onToggleDRRButtonClicked(self, value):
         self.logic.ToggleDRR(value)
 
-    def onShootFluoroButtonClicked(self, value):
+    def onDRRBackendChanged(self, value):
+        self.logic.SetDRRBackend(value)
 
-        if self.logic.toggleDRR == True:
-            return
+    def onDRRBeamChanged(self, value):
+        self.logic.SetDRRBeam(float(value.split()[0]) if value.endswith("kVp") else None)
 
-        self.logic.ToggleDRR(True)
-        self.logic.UpdateDRR()
-        self.logic.ToggleDRR(False)
-        self.logic.numShots += 1
+    def onShootFluoroButtonClicked(self, value):
+        self.logic.ShootFluoro()
 
     def onToggleVRButtonClicked(self, value):
 
@@ -342,6 +371,9 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         self.vrInteractor = w.renderWindow().GetInteractor()
         self.vrInteractorObserver = self.vrInteractor.AddObserver(123456, self.interactorCallback)
 
+        # Hold the headset frame rate by switching the scene models to decimated meshes
+        self.logic.EnableLOD(w.renderWindow().GetRenderers().GetFirstRenderer())
+
     def onGenerateSceneButtonClicked(self, value):
         #if self.useGestureRecognition == True:
             #if self.gestureObserverNum != 0:
@@ -365,17 +397,36 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         self.logic.CollectImage(value)
 
     def onStartModuleButtonClicked(self, value):
+        # The logic resets the pose and field of view in one step, the sliders only follow
         self.logic.StartModule(value)
         self.toggleDRRButton.setChecked(False)
-        self.zoomSlider.value = 27
-        self.fieldOfViewSlider.value = 46
-        self.xRotationSliderWidget.value = 0
-        self.zRotationSliderWidget.value = 0
-        self.wagRotationSliderWidget.value = 0
-        self.tableSliderWidget.value = 0
+        self.syncSlidersToPose(blockSignals=True)
         self.logic.UpdateDRR()
         self.toggleDRRButton.setChecked(False)
 
+    def onCollisionChanged(self, collisions, blocked):
+        self.collisionLabel.text = ", ".join("%s / %s" % pair for pair in collisions) or '-'
+        if blocked:
+            # The logic kept the previous pose, move the sliders back once this change has been handled
+            qt.QTimer.singleShot(0, self.syncSlidersToPose)
+
+    def syncSlidersToPose(self, blockSignals=False):
+        # With blockSignals the sliders only show the logic's pose, it is not applied again
+        pose = self.logic.GetPose()
+        sliders = [(self.xRotationSliderWidget, pose[0]), (self.zRotationSliderWidget, pose[1]),
+                   (self.wagRotationSliderWidget, pose[2]), (self.tableSliderWidget, pose[3]),
+                   (self.zoomSlider, pose[4]), (self.fieldOfViewSlider, self.logic.core.fieldOfViewValue)]
+        for slider, value in sliders:
+            wasBlocked = slider.blockSignals(blockSignals)
+            slider.value = value
+            slider.blockSignals(wasBlocked)
+
+    def onTargetScoreChanged(self, targetScore):
+        self.targetScoreLabel.text = "%s: %.0f%%" % (targetScore["label"], targetScore["score"])
+
+    def onDoseChanged(self, doseAreaProduct, peakSkinDose):
+        self.doseLabel.text = "DAP %.0f mGy cm2, peak skin %.1f mGy" % (doseAreaProduct, peakSkinDose)
+
     def onNeedleValuesChanged(self, value):
         self.logic.UpdateNeedle(value)
 
@@ -395,6 +446,14 @@ class CarmSimulatorWidget(ScriptedLoadableModuleWidget):
         if self.vrInteractor is not None:
             self.vrInteractor.RemoveObserver(self.vrInteractorObserver)
 
+        self.motionController.Stop()
+        self.logic.StopReplay()
+        self.logic.StopRecording()
+        self.logic.CloseSessionStore()
+        self.logic.StopPoseSolves()
+        self.logic.DisableLOD()
+        self.logic.core.Shutdown()
+
 
         print("HELLO")
         # Cleanup any memory leaks
@@ -411,7 +470,12 @@ class CarmSimulatorLogic(ScriptedLoadableModuleLogic):
     def __init__(self, parent = None):
         ScriptedLoadableModuleLogic.__init__(self, parent)
         self.resourcePath = os.path.dirname(os.path.abspath(__file__))
-        self.slicerRenderer = slicer.app.layoutManager().threeDWidget(0).threeDView().renderWindow().GetRenderers().GetFirstRenderer()
+        # Without a main window (e.g. benchmarks) there is no 3D view to render into
+        self.threeDView = None
+        self.slicerRenderer = vtk.vtkRenderer()
+        if slicer.app.layoutManager() is not None:
+            self.threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
+            self.slicerRenderer = self.threeDView.renderWindow().GetRenderers().GetFirstRenderer()
         slicer.mymod = self
         self.Initialize()
 
@@ -422,26 +486,11 @@ class CarmSimulatorLogic(ScriptedLoadableModuleLogic):
 
         self.scene = CarmSimulatorScene()
 
-        # Set up FOV and dummy renderer
+        # Set up dummy renderer, the collimation is applied to its image afterwards
         self.renderer = vtk.vtkRenderer()
-        self.rendererFOV = vtk.vtkRenderer()
-        self.pngReader = vtk.vtkPNGReader()
-        self.imageViewer = vtk.vtkImageViewer2()
-        self.fovPath = os.path.join(self.resourcePath, 'Resources\FieldOfViewMedium.png')
-        self.pngReader.SetFileName(self.fovPath)
-        self.pngReader.Update()
-        self.imageViewer.SetInputConnection(self.pngReader.GetOutputPort())
-        self.imageViewer.SetRenderer(self.rendererFOV)
         #self.renderer.AddVolume(self.volume)
         self.renderWindow = vtk.vtkRenderWindow()
-        self.renderWindow.SetNumberOfLayers(2)
         self.renderWindow.AddRenderer(self.renderer)
-        self.renderWindow.AddRenderer(self.rendererFOV)
-        # self.rendererFOV.ResetCamera()
-        self.rendererFOV.GetActiveCamera().SetPosition(750.0, 750.0, 700)
-        self.rendererFOV.GetActiveCamera().SetFocalPoint(750.0, 750.0, 0.0)
-        self.renderer.SetLayer(0)
-        self.rendererFOV.SetLayer(1)
         self.renderWindow.SetSize(530, 335)
         # self.ChangeFOV(0)
         self.renderWindow.SetOffScreenRendering(1)
@@ -458,100 +507,447 @@ class CarmSimulatorLogic(ScriptedLoadableModuleLogic):
         #self.needleActor.GetProperty().SetColor(0.3, 0.3, 0.3)
         #self.renderer.AddActor(self.needleActor)
 
-        # Initialize Carm Transforms
-        self.cRotation = vtk.vtkTransform()
-        self.gantryRotation = vtk.vtkTransform()
-        self.wagRotation = vtk.vtkTransform()
-        self.tableTranslationTransform = vtk.vtkTransform()
-        self.focalPointTransform = vtk.vtkTransform()
-        self.xRotationValue = 0.0
-        self.zRotationValue = 0.0
-        self.yRotationValue = 0.0
-        self.tableTranslationValue = 0.0
-        self.zoomFactor = 0.0
+        # Pose, CT volume and CPU DRR engine live in the Slicer independent core
+        self.core = CarmSimulatorCore(self.resourcePath)
         self.DRRInitialized = False
+        self.drrPixels = None
+        self.volume = None
         self.toggleDRR = False
 
+        # Stage timings of the DRR pipeline, the hooks cost nothing until profiling is enabled
+        self.profiler = CarmSimulatorProfiler()
+        self.profilerOverlay = None
+        self.profilerObservers = []
+        self.threeDViewRenderStartTime = None
+        self.profilerOverlayTimer = qt.QTimer()
+        self.profilerOverlayTimer.setInterval(500)
+        self.profilerOverlayTimer.connect('timeout()', self.OnProfilerOverlayTimer)
+
+        # Live similarity of the monitor image to a reference image of currentImageLabel
+        self.currentImageLabel = None
+        self.targetScorer = CarmSimulatorTargetScorer()
+        self.targetScoring = True
+        self.targetScore = None
+        self.targetScoreCallback = None
+
+        # Collisions of the C-arm with the table and patient, checked before every move
+        # "Block" refuses colliding moves, "Flag" only highlights the colliding models, "Off" skips the check
+        self.collisionChecker = None
+        self.collisionMode = "Block"
+        self.collisions = []
+        # Colliding pairs at the applied pose, moves that stay within them are not blocked
+        self.poseCollisions = []
+        self.highlightedModels = set()
+        self.blockedMoveCount = 0
+        self.collisionCallback = None
+
+        # Skin dose on the HumanMesh vertices, built with the scene and reset by StartModule
+        self.doseMap = None
+        self.doseMapModel = None
+        self.skinDoseArray = None
+        self.skinDoseVisible = True
+        self.doseCallback = None
+
+        # Solved optimal pose of each target view of the active case, see SolveTargetPose
+        self.optimalPoses = {}
+        self.optimalPosesPath = None
+        # Solves run on their own thread, (case name, label, future, callback) until OnPoseSolverPoll stores them
+        self.poseSolverExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.poseSolves = []
+        self.poseSolverTimer = qt.QTimer()
+        self.poseSolverTimer.setInterval(200)
+        self.poseSolverTimer.connect('timeout()', self.OnPoseSolverPoll)
+
+        # Results of every training session, opened by the first StartModule
+        self.sessionStore = None
+        self.sessionStorePath = None
+        self.sessionId = None
+        self.traineeName = ""
+
+        # Session recording and replay
+        self.recorder = None
+        self.replay = None
+        self.replayElapsedTimer = qt.QElapsedTimer()
+        self.replayTimer = qt.QTimer()
+        self.replayTimer.setInterval(5)
+        self.replayTimer.connect('timeout()', self.OnReplayTimer)
+        # Called after a replayed pose or field of view is applied, so the widget's sliders can follow
+        self.replayPoseCallback = None
+
+        # CPU DRR engine, selected with SetDRRBackend("CPU")
+        self.drrBackend = "VTK"
+        self.drrEngine = self.core.drrEngine
+        self.opacityPoints = self.core.opacityPoints
+
+        # CPU DRRs are rendered on a worker thread so the main (VR) thread never blocks
+        self.drrAsync = True
+        self.drrWorker = None
+        self.drrWorkerTimer = qt.QTimer()
+        self.drrWorkerTimer.setInterval(5)
+        self.drrWorkerTimer.connect('timeout()', self.OnDRRWorkerPoll)
+
+        # While the pose keeps changing CPU DRRs are rendered from a coarse pyramid level,
+        # the full resolution image follows once the pose has been still for drrRefineDelay ms
+        self.drrProgressive = True
+        self.drrMotionLevel = 1
+        self.drrRefineTimer = qt.QTimer()
+        self.drrRefineTimer.setSingleShot(True)
+        self.drrRefineTimer.setInterval(150)
+        self.drrRefineTimer.connect('timeout()', self.OnDRRRefine)
+
+        # Bytes copied on the way from the renderers to the monitor texture
+        self.ResetDRRCopyStatistics()
+
+        # Rendered DRRs keyed by pose, cleared per volume when a case is evicted
+        self.drrCache = CarmSimulatorDRRCache()
+
+        # Pose changes only mark the DRR dirty, it is rendered at most once per frame
+        self.drrScheduler = CarmSimulatorDRRScheduler(self.OnScheduledDRRUpdate)
+
         # Initialize DRR Model
         self.planeModelNode = None
 
+        # Levels of detail for the scene models, built when VR is enabled
+        self.lodManager = CarmSimulatorLODManager()
+        self.lodRenderer = None
+        self.lodTimer = qt.QTimer()
+        self.lodTimer.setInterval(500)
+        self.lodTimer.connect('timeout()', self.OnLODTimer)
+
+        # Decoded CT cases stay resident so StartModule only swaps the shown volume
+        self.caseLibrary = CarmSimulatorCaseLibrary(self.opacityPoints, self.CreateCaseVolume, self.OnCaseEvicted)
+        self.caseLibrary.AddCase(ScoliosisVolumeName, os.path.join(self.resourcePath, 'Resources', ScoliosisVolumeName + '.mha'))
+        self.caseLibraryTimer = qt.QTimer()
+        self.caseLibraryTimer.setInterval(50)
+        self.caseLibraryTimer.connect('timeout()', self.OnCaseLibraryPoll)
+
     def GenerateScene(self, value):
 
         self.scene.GenerateScene()
+        logging.debug("Scene loaded:\n" + self.scene.GetLoadTimingReport())
+
+        # Register the phantom with the case library and decode the next case in the background
+        volumeNode = self.scene.lumbarSpineVolume
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        self.caseLibrary.AdoptCase(LumbarSpineVolumeName, volumeNode, slicer.util.arrayFromVolume(volumeNode),
+                                   slicer.util.arrayFromVTKMatrix(ijkToRAS))
+        self.caseLibrary.activeName = LumbarSpineVolumeName
+        self.PrefetchCase(ScoliosisVolumeName)
+
+        self.BuildCollisionChecker()
+        self.BuildDoseMap()
 
         # Add volume into dummy render window
-        self.volume = self.slicerRenderer.GetVolumes().GetItemAsObject(0)
-        self.renderer.AddVolume(self.volume)
+        self.volume = self.GetVisibleVolume()
+        if self.volume is not None:
+            self.renderer.AddVolume(self.volume)
         self.slicerRenderer.ResetCamera()
-        self.slicerRenderer.Render()
+        self.RenderThreeDView()
+
+
+    def BuildCollisionChecker(self):
+        # Bounding volume hierarchies of the full resolution meshes, and the scene transforms above them
+        models = {}
+        chains = {}
+        staticMatrices = {}
+        names = set(name for pair in CollisionPairs for name in pair)
+        for name, fileName, color, opacity, parent, attribute in SceneModels:
+            if name not in names:
+                continue
+            modelNode = getattr(self.scene, attribute)
+            lodModel = self.lodManager.models.get(name)
+            polyData = lodModel.levels[0] if lodModel is not None else modelNode.GetPolyData()
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            triangles = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1, 4)[:, 1:]
+            models[name] = (points, triangles)
+            chains[name] = []
+            transformNode = modelNode.GetParentTransformNode()
+            while transformNode is not None:
+                chains[name].append(transformNode.GetName())
+                staticMatrices[transformNode.GetName()] = slicer.util.arrayFromTransformMatrix(transformNode)
+                transformNode = transformNode.GetParentTransformNode()
+        self.collisionChecker = CarmSimulatorCollisionChecker(models, chains, staticMatrices)
+        logging.debug("Collision hierarchies built in %.1f ms" % (self.collisionChecker.buildTime * 1000.0))
+        self.poseCollisions = self.CheckCollisions(self.GetPose())
+
+    def SetCollisionMode(self, mode):
+        self.collisionMode = mode
+        if mode == "Off":
+            self.collisions = []
+            self.poseCollisions = []
+            self.UpdateCollisionHighlight()
+        else:
+            # The pose may have been moved into a contact while unchecked or only flagged
+            self.poseCollisions = self.CheckCollisions(self.GetPose())
+
+    def CheckCollisions(self, pose, stopAtFirst=False):
+        # Colliding model pairs at pose, the models are highlighted while they collide
+        if self.collisionChecker is None or self.collisionMode == "Off":
+            return []
+        with self.profiler.Stage("Collision check"):
+            self.collisions = self.collisionChecker.Check(pose, stopAtFirst)
+        self.UpdateCollisionHighlight()
+        return self.collisions
+
+    def IsMoveBlocked(self, pose):
+        # Called with the new pose before it is applied
+        # Only moves starting a new contact are refused, so the arm can always be moved out of one
+        # (a pose from Flag mode, a replay or SetPose); from a clear pose the first collision is enough
+        block = self.collisionMode == "Block"
+        collisions = self.CheckCollisions(pose, block and not self.poseCollisions)
+        blocked = block and not set(collisions) <= set(self.poseCollisions)
+        if blocked:
+            self.blockedMoveCount += 1
+        else:
+            self.poseCollisions = collisions
+        if self.collisionCallback is not None and self.collisionChecker is not None:
+            self.collisionCallback(self.collisions, blocked)
+        return blocked
+
+    def UpdateCollisionHighlight(self):
+        models = set(name for pair in self.collisions for name in pair)
+        if models == self.highlightedModels:
+            return
+        for name, fileName, color, opacity, parent, attribute in SceneModels:
+            if name in models or name in self.highlightedModels:
+                getattr(self.scene, attribute).GetDisplayNode().SetColor(*((1.0, 0.0, 0.0) if name in models else color))
+        self.highlightedModels = models
+
+    def GetCollisionStatistics(self):
+        if self.collisionChecker is None:
+            return None
+        statistics = self.collisionChecker.GetStatistics()
+        statistics["blockedMoves"] = self.blockedMoveCount
+        return statistics
+
+    def BuildDoseMap(self):
+        # The map is kept on the full resolution mesh, the one the overlay is shown on
+        self.doseMapModel = self.scene.surfaceMesh
+        lodModel = self.lodManager.models.get("HumanMesh")
+        polyData = lodModel.levels[0] if lodModel is not None else self.doseMapModel.GetPolyData()
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        triangles = numpy_support.vtk_to_numpy(polyData.GetPolys().GetData()).reshape(-1, 4)[:, 1:]
+        self.doseMap = CarmSimulatorDoseMap(points, triangles)
+
+        skinDose = numpy_support.numpy_to_vtk(self.doseMap.skinDose, deep=0)
+        skinDose.SetName("SkinDose")
+        polyData.GetPointData().AddArray(skinDose)
+        self.skinDoseArray = skinDose
+        displayNode = self.doseMapModel.GetDisplayNode()
+        displayNode.SetActiveScalarName("SkinDose")
+        displayNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+        displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeFileColdToHotRainbow.txt")
+        self.SetSkinDoseVisible(self.skinDoseVisible)
+
+    def SetSkinDoseVisible(self, visible):
+        # Shows the skin dose as a color overlay on the patient instead of the skin color
+        self.skinDoseVisible = visible
+        self.UpdateSkinDoseOverlay()
+
+    def UpdateSkinDoseOverlay(self):
+        # Drawn once there is dose to show
+        if self.doseMap is None:
+            return
+        drawn = self.skinDoseVisible and self.doseMap.shotCount > 0
+        self.doseMapModel.GetDisplayNode().SetScalarVisibility(drawn)
+        # The overlay is only on the full resolution mesh, keep the level of detail from switching it while drawn
+        self.lodManager.LockModelLevel("HumanMesh", 0 if drawn else None)
+
+    def DepositDose(self):
+        # Dose of one shot at the current pose and field of view, onto the skin as it lies on the table now
+        if self.doseMap is None:
+            return
+        with self.profiler.Stage("Dose deposition"):
+            coneToWorld = slicer.util.arrayFromTransformMatrix(self.scene.coneTransform, toWorld=True)
+            meshToWorld = slicer.util.arrayFromTransformMatrix(self.doseMapModel.GetParentTransformNode(), toWorld=True)
+            self.doseMap.Deposit(coneToWorld, meshToWorld, CollimationFraction(self.core.fieldOfViewValue))
+            self.skinDoseArray.Modified()
+            self.doseMapModel.GetPolyData().Modified()
+        self.doseMapModel.GetDisplayNode().SetScalarRange(0.0, max(self.doseMap.GetPeakSkinDose(), 1e-3))
+        self.UpdateSkinDoseOverlay()
+        if self.doseCallback is not None:
+            self.doseCallback(self.doseMap.doseAreaProduct, self.doseMap.GetPeakSkinDose())
+
+    def ResetDose(self):
+        if self.doseMap is None:
+            return
+        self.doseMap.Reset()
+        self.skinDoseArray.Modified()
+        self.doseMapModel.GetPolyData().Modified()
+        self.UpdateSkinDoseOverlay()
+        if self.doseCallback is not None:
+            self.doseCallback(0.0, 0.0)
+
+    def GetDoseStatistics(self):
+        if self.doseMap is None:
+            return None
+        return self.doseMap.GetStatistics()
+
+    def EnableLOD(self, renderer):
+        # Decimate every scene model and start adapting their level of detail to renderer
+        if not self.lodManager.models:
+            for name, fileName, color, opacity, parent, attribute in SceneModels:
+                self.lodManager.AddModel(name, getattr(self.scene, attribute))
+        self.lodRenderer = renderer
+        self.lodTimer.start()
+
+    def DisableLOD(self):
+        self.lodTimer.stop()
+        self.lodManager.RemoveAllModels()
+        self.lodRenderer = None
+
+    def OnLODTimer(self):
+        self.lodManager.Update(self.lodRenderer)
+
+    def GetLODStatistics(self):
+        return self.lodManager.GetStatistics()
+
+    def PrefetchCase(self, name):
+        self.caseLibrary.Prefetch(name)
+        self.caseLibraryTimer.start()
+
+    def OnCaseLibraryPoll(self):
+        for name in self.caseLibrary.Poll():
+            case = self.caseLibrary.cases[name]
+            logging.debug("Case %s ready: decoded in %.1f ms, node in %.1f ms, %.1f MB" %
+                          (name, case.loadTime * 1000.0, case.nodeTime * 1000.0, case.GetMemoryBytes() / 1048576.0))
+        if not self.caseLibrary.IsLoading():
+            self.caseLibraryTimer.stop()
+
+    def CreateCaseVolume(self, name, voxels, ijkToRAS):
+        # The library keeps the node's scalars instead of the decoded voxels, so a case holds its CT once
+        volumeNode = self.scene.CreateCaseVolume(name, voxels, ijkToRAS)
+        return volumeNode, slicer.util.arrayFromVolume(volumeNode)
+
+    def OnCaseEvicted(self, volumeNode):
+        self.drrCache.Invalidate(volumeNode.GetID())
+        self.core.InvalidateVolume(volumeNode.GetID())
+        slicer.mrmlScene.RemoveNode(volumeNode)
+
+    def SwitchCase(self, name):
+        # Show a library case in place of the current CT, no disk access if it is resident
+        startTime = time.perf_counter()
+        case = self.caseLibrary.Activate(name)
+        if case.node is self.scene.lumbarSpineVolume:
+            return
+        if self.volume is not None:
+            self.renderer.RemoveVolume(self.volume)
+        if self.scene.lumbarSpineVolume is not None:
+            self.scene.lumbarSpineVolume.SetDisplayVisibility(0)
+        case.node.SetDisplayVisibility(1)
+        self.scene.lumbarSpineVolume = case.node
+        self.volume = self.GetVisibleVolume()
+        if self.volume is not None:
+            self.renderer.AddVolume(self.volume)
+        logging.debug("Switched to case %s in %.1f ms" % (name, (time.perf_counter() - startTime) * 1000.0))
+
+    def GetVisibleVolume(self):
+        # Every resident case has a volume actor in the 3D view, only the active one is visible
+        volumes = self.slicerRenderer.GetVolumes()
+        for index in range(volumes.GetNumberOfItems()):
+            volume = volumes.GetItemAsObject(index)
+            if volume.GetVisibility():
+                return volume
+        if volumes.GetNumberOfItems() == 0:
+            return None
+        return volumes.GetItemAsObject(0)
+
+    def RenderThreeDView(self, stageName="3D view render"):
+        if self.threeDView is not None:
+            with self.profiler.Stage(stageName):
+                self.slicerRenderer.Render()
+
+    def ScheduleThreeDViewRender(self):
+        if self.threeDView is not None:
+            self.threeDView.scheduleRender()
 
+    def GetCaseLibraryStatistics(self):
+        return self.caseLibrary.GetStatistics()
 
     def UpdateNeedle(self, value):
         self.needleActor.SetPosition(value, 0, 0)
         if self.toggleDRR == True:
-            self.slicerRenderer.Render()
-            self.UpdateDRR()
+            self.RenderThreeDView()
+            self.RequestDRRUpdate()
             # self.UpdateCRotation(self.zRotationValue)
 
 
     def ChangeZoomFactor(self, value):
-        self.zoomFactor = value
+        self.core.zoomFactor = value
+        self.RecordPose()
         if self.toggleDRR == True:
-            self.slicerRenderer.Render()
-            self.UpdateDRR()
+            self.RenderThreeDView("ChangeZoomFactor 3D render")
+            self.RequestDRRUpdate()
 
     def ChangeFOV(self, value):
+        self.core.SetFieldOfView(value)
+        if self.recorder is not None:
+            self.recorder.RecordFieldOfView(self.GetPose(), value)
         if self.toggleDRR == False:
             return
-        self.rendererFOV.GetActiveCamera().SetPosition(750.0, 750.0, 700 - value * 10)
-        self.rendererFOV.GetActiveCamera().SetFocalPoint(750.0, 750.0, 0.0)
-        self.slicerRenderer.Render()
-        self.UpdateDRR()
+        self.RequestDRRUpdate()
         # self.UpdateCRotation(self.zRotationValue)
 
     def ToggleDRR(self, value):
 
         if self.DRRInitialized == True:
             if value == True:
-                self.image.VisibilityOn()
                 self.toggleDRR = True
-                self.slicerRenderer.Render()
+                self.RenderThreeDView("ToggleDRR 3D render")
                 return
-            self.image.VisibilityOff()
             self.toggleDRR = False
-            self.slicerRenderer.Render()
+            self.drrScheduler.Cancel()
+            self.RenderThreeDView("ToggleDRR 3D render")
             return
 
-        self.DRRInitialized = True
+        self.InitializeDRR()
         self.toggleDRR = True
+        self.UpdateDRR()
+        self.RenderThreeDView("ToggleDRR 3D render")
+
+    def InitializeDRR(self):
+        self.DRRInitialized = True
 
-        # Initialize Window To Input Pipeline
+        # Initialize the offscreen DRR render window
         self.cameraTransform = vtk.vtkTransform()
-        self.xRotationValue = 0.0
-        self.zRotationValue = 0.0
-        self.winToImage = vtk.vtkWindowToImageFilter()
-        self.pixelData = vtk.vtkImageData()
-        self.winToImage.SetInput(self.renderWindow)
-        self.imageMapper = vtk.vtkImageSliceMapper()
-        self.image = vtk.vtkImageSlice()
-        self.imageMapper.SetInputData(self.winToImage.GetOutput())
-        self.image.SetMapper(self.imageMapper)
+        self.core.xRotationValue = 0.0
+        self.core.zRotationValue = 0.0
 
         # Render DRR (replace with udpate DRR)
         self.cameraTransform.Identity()
         self.cameraTransform.PostMultiply()
         self.cameraTransform.Translate(0, 705.81, 0)
-        self.cameraTransform.RotateZ(self.zRotationValue)
-        self.cameraTransform.RotateX(-self.xRotationValue)
+        self.cameraTransform.RotateZ(self.core.zRotationValue)
+        self.cameraTransform.RotateX(-self.core.xRotationValue)
         self.renderer.GetActiveCamera().SetPosition(self.cameraTransform.GetPosition())
         self.renderer.GetActiveCamera().SetFocalPoint(0, 0, 0)
         self.renderer.GetActiveCamera().SetViewUp(0, 0, 1)
         self.renderer.SetBackground(1, 1, 1)
         self.renderWindow.Render()
 
-        self.winToImage = vtk.vtkWindowToImageFilter()
-        self.winToImage.SetInput(self.renderWindow)
-        self.winToImage.Update()
+        # DRR shown on the monitor, exposed to NumPy so the CPU engine, the VTK readback and the cache
+        # write straight into the texture's scalars
+        # Two buffers: the front one is shown, the CPU worker renders into the back one and they are swapped
+        self.drrImageData = vtk.vtkImageData()
+        self.drrImageData.SetDimensions(self.drrEngine.width, self.drrEngine.height, 1)
+        self.drrScalars = []
+        drrBuffers = []
+        for index in range(2):
+            scalars = vtk.vtkUnsignedCharArray()
+            scalars.SetNumberOfComponents(3)
+            scalars.SetNumberOfTuples(self.drrEngine.width * self.drrEngine.height)
+            self.drrScalars.append(scalars)
+            drrBuffers.append(numpy_support.vtk_to_numpy(scalars).reshape(
+                self.drrEngine.height, self.drrEngine.width, 3))
+            drrBuffers[index].fill(255)
+        self.drrImageData.GetPointData().SetScalars(self.drrScalars[0])
+        self.drrPixels = drrBuffers[0]
+        if self.drrWorker is not None:
+            self.drrWorker.Stop()
+        self.drrWorker = CarmSimulatorDRRWorker(self.drrEngine, drrBuffers, self.profiler)
+        self.drrImageProducer = vtk.vtkTrivialProducer()
+        self.drrImageProducer.SetOutput(self.drrImageData)
 
         # Add DRR Image to Scene using vtkPlaneSource
         self.plane = vtk.vtkPlaneSource()
@@ -573,118 +969,618 @@ class CarmSimulatorLogic(ScriptedLoadableModuleLogic):
 
         self.planeModelNode.SetAndObserveTransformNodeID(self.scene.dRRToMonitorTransform.GetID())
         self.planeModelDisplay = self.planeModelNode.GetDisplayNode()
-        self.planeModelDisplay.SetTextureImageDataConnection(self.winToImage.GetOutputPort())
+        self.planeModelDisplay.SetTextureImageDataConnection(self.drrImageProducer.GetOutputPort())
         self.planeModelDisplay.VisibilityOn()
 
         self.planeModelDisplay.SetFrontfaceCulling(False)
         self.planeModelDisplay.SetBackfaceCulling(False)
 
         self.renderWindow.Render()
-        self.slicerRenderer.Render()
 
+    def SetDRRBackend(self, backend):
+        # Switch between the offscreen VTK renderer ("VTK") and the CPU ray caster ("CPU")
+        self.drrBackend = backend
+        if self.toggleDRR == True:
+            self.RequestDRRUpdate()
 
-    def UpdateDRR(self):
-        # Position Dummy Renderer Camera
-        # TO DO: Read in Hardcoded values from Config
-        # OR calculate them based on radius of C STL etc...
-        self.cameraTransform.Identity()
-        self.cameraTransform.PostMultiply()
-        #self.cameraTransform.Translate(0, -250 + self.zoomFactor * 4, 0)
-        self.cameraTransform.Translate(0, -705.81 + self.zoomFactor * 16, 0)
-        self.cameraTransform.RotateZ(-self.zRotationValue)
-        self.cameraTransform.RotateX(self.xRotationValue)
-
-        #self.cameraTransform.Translate(500.2704, 0, 0)
-        #self.cameraTransform.Translate(-1262.2704, -337.5527, 5.7)
-        self.cameraTransform.Translate(500, 0, 0)
-        self.cameraTransform.RotateY(-self.yRotationValue)
-        self.cameraTransform.Translate(-500, 0, 0)
-        #self.cameraTransform.Translate(-200, 0, 0)
-        #self.cameraTransform.Translate(-500.2704,0,-self.tableTranslationValue)
-        #self.cameraTransform.Translate(1262.2704, 337.5527, -5.7)
-
-
-        self.focalPointTransform.Identity()
-        self.focalPointTransform.Translate(500, 0, 0)
-        self.focalPointTransform.RotateY(self.yRotationValue)
-        self.focalPointTransform.Translate(-500, 0, 0)
-        self.focalPointTransform.Translate(0,0,-self.tableTranslationValue)
-        zAxis = [0,0,0,0]
-        #up = [0,0,1,0]
-        up = [0,0,1,0]
-        self.cameraTransform.MultiplyPoint(up, zAxis)
+    def SetDRRBeam(self, kVp):
+        # Polychromatic X-ray beam at kVp, or None for the opacity transfer function
+        self.core.SetBeam(kVp)
+        if self.toggleDRR == True:
+            self.RequestDRRUpdate()
 
+    def GetDRRBeamKVp(self):
+        return self.core.GetBeamKVp()
 
-        self.renderer.GetActiveCamera().SetPosition(self.cameraTransform.GetPosition())
-        self.renderer.GetActiveCamera().SetFocalPoint(self.focalPointTransform.GetPosition())
-        #self.renderer.GetActiveCamera().SetFocalPoint(0,0,0)
-        self.renderer.GetActiveCamera().SetViewUp(zAxis[0], zAxis[1], zAxis[2])
-        #self.renderer.GetActiveCamera().SetViewUp(0,0,1)
-        #self.renderer.GetActiveCamera().SetViewUp(0,0,1)
-        #self.renderer.GetActiveCamera().SetFocalPoint(0,0,0)
-
-        # Update WinToImage Filter and Render
-        self.winToImage.Modified()
-        self.renderWindow.Render()
-        self.winToImage.Update()
-        self.imageMapper.Update()
-        self.renderer.Render()
+    def RequestDRRUpdate(self):
+        if self.drrProgressive == True and self.drrBackend == "CPU":
+            # Restarted on every pose change, so it only fires once the C-arm stops
+            self.drrRefineTimer.start()
+        self.drrScheduler.Request()
+
+    def OnScheduledDRRUpdate(self):
+        if self.toggleDRR == False:
+            return
+        level = self.drrMotionLevel if self.drrRefineTimer.isActive() else 0
+        with self.profiler.Stage("UpdateDRR"):
+            self.UpdateDRR(level)
+        self.ScheduleThreeDViewRender()
+
+    def OnDRRRefine(self):
+        if self.toggleDRR == False:
+            return
+        with self.profiler.Stage("UpdateDRR (refine)"):
+            self.UpdateDRR()
+        self.ScheduleThreeDViewRender()
+
+    def SetDRRProgressive(self, enabled, motionLevel=1, refineDelay=150):
+        # motionLevel n renders moving poses with 2^n times fewer rays along each image axis
+        self.drrProgressive = enabled
+        self.drrMotionLevel = max(0, min(motionLevel, self.drrEngine.numberOfLevels - 1))
+        self.drrRefineTimer.setInterval(refineDelay)
+        if not enabled:
+            self.drrRefineTimer.stop()
+
+    def SetDRRTargetRate(self, rate):
+        # Maximum number of DRR renders per second while the pose is changing
+        self.drrScheduler.SetTargetRate(rate)
+
+    def GetDRRSchedulerStatistics(self):
+        return self.drrScheduler.GetStatistics()
+
+    def GetDRRVolumeId(self):
+        if self.scene.lumbarSpineVolume is None:
+            return None
+        return self.scene.lumbarSpineVolume.GetID()
+
+    def GetWorldIJKToRAS(self, volumeNode):
+        # IJK to world RAS as a NumPy matrix, including the volume's parent transform
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        if volumeNode.GetParentTransformNode() is not None:
+            toWorld = vtk.vtkMatrix4x4()
+            volumeNode.GetParentTransformNode().GetMatrixTransformToWorld(toWorld)
+            vtk.vtkMatrix4x4.Multiply4x4(toWorld, ijkToRAS, ijkToRAS)
+        return slicer.util.arrayFromVTKMatrix(ijkToRAS)
+
+    def UpdateDRREngineVolume(self):
+        # Load the current CT into the CPU engine whenever the volume node changes
+        self.UpdateCoreVolume(self.core)
+
+    def UpdateCoreVolume(self, core):
+        # Sets the shown CT on core unless it already has it
+        volumeNode = self.scene.lumbarSpineVolume
+        if volumeNode is None or volumeNode.GetID() == core.volumeId:
+            return
+        case = self.caseLibrary.FindCaseByNode(volumeNode)
+        if core.beam is None and case is not None and case.drrLevels is not None:
+            # Library cases keep the engine's pyramid once it is built, swapping back only swaps references
+            core.SetAttenuationLevels(volumeNode.GetID(), case.drrLevels)
+            return
+        ijkToRAS = self.GetWorldIJKToRAS(volumeNode)
+        if core.beam is None and case is not None and case.attenuation is not None:
+            # Cropped, downsampled and scanned for empty blocks once per case
+            core.SetAttenuationVolume(volumeNode.GetID(), case.attenuation, ijkToRAS, case.attenuationScale)
+        else:
+            # Baked once per transfer function, beside the .mha the volume was loaded from
+            volumePath = os.path.join(self.resourcePath, 'Resources', volumeNode.GetName() + '.mha')
+            baked = core.SetVolume(volumeNode.GetID(), slicer.util.arrayFromVolume(volumeNode), ijkToRAS, volumePath)
+            if baked is not None and case is not None:
+                case.attenuation, case.attenuationScale = baked
+        if core.beam is None and case is not None:
+            case.drrLevels = core.GetAttenuationLevels()
+
+    def UpdateDRR(self, level=0, synchronous=False):
+        # synchronous renders on this thread even when CPU DRRs are asynchronous
+        profiler = self.profiler
+
+        # Position Dummy Renderer Camera
+        with profiler.Stage("Camera setup"):
+            position, focalPoint, viewUp = self.core.GetDRRCamera()
+
+        # Revisited poses come straight from the cache, which only holds full resolution images
+        # Images are collimated, so the FOV is part of the key
+        with profiler.Stage("Cache lookup"):
+            cacheKey = self.drrCache.MakeKey(*(self.GetPose() + [self.GetDRRVolumeId(), self.drrBackend,
+                                                                 self.core.fieldOfViewValue, self.GetDRRBeamKVp()]))
+            cachedImage = self.drrCache.Get(cacheKey)
+        if cachedImage is not None:
+            self.drrWorker.Cancel()
+            with profiler.Stage("Cache copy"):
+                self.drrPixels[...] = cachedImage
+                self.DRRPixelsModified()
+            self.CountDRRFrame(cachedImage.nbytes)
+            return
 
-        # Update C Rotation
+        if self.drrBackend == "CPU":
+            self.UpdateDRREngineVolume()
+            if level > 0:
+                cacheKey = None
+            if self.drrAsync == True and not synchronous:
+                # Swapped onto the monitor by OnDRRWorkerPoll once rendered
+                self.drrWorker.Submit(cacheKey, position, focalPoint, viewUp, level)
+                self.drrWorkerTimer.start()
+                return
+            self.drrWorker.Cancel()
+            with profiler.Stage("CPU render level %d" % level):
+                self.drrEngine.Render(position, focalPoint, viewUp, out=self.drrPixels, level=level)
+            self.DRRPixelsModified()
+            self.CountDRRFrame()
+            if cacheKey is not None:
+                self.CacheDRR(cacheKey)
+            return
+
+        self.drrWorker.Cancel()
+        with profiler.Stage("Camera setup"):
+            self.renderer.GetActiveCamera().SetPosition(position)
+            self.renderer.GetActiveCamera().SetFocalPoint(focalPoint)
+            self.renderer.GetActiveCamera().SetViewUp(viewUp)
+
+        with profiler.Stage("renderWindow.Render"):
+            self.renderWindow.Render()
+
+        # Read the framebuffer straight into the monitor texture's scalars
+        with profiler.Stage("Framebuffer readback"):
+            width, height = self.renderWindow.GetSize()
+            copiedBytes = 0
+            if width == self.drrEngine.width and height == self.drrEngine.height:
+                self.renderWindow.GetPixelData(0, 0, width - 1, height - 1, 1,
+                                               self.drrImageData.GetPointData().GetScalars(), 0)
+            else:
+                # Window was resized by the system, read it into a temporary and copy the overlap
+                windowScalars = vtk.vtkUnsignedCharArray()
+                self.renderWindow.GetPixelData(0, 0, width - 1, height - 1, 1, windowScalars, 0)
+                windowPixels = numpy_support.vtk_to_numpy(windowScalars).reshape(height, width, 3)
+                overlap = self.drrPixels[:min(height, self.drrEngine.height), :min(width, self.drrEngine.width)]
+                overlap[...] = windowPixels[:overlap.shape[0], :overlap.shape[1]]
+                copiedBytes = overlap.nbytes
+        with profiler.Stage("Collimation"):
+            self.drrEngine.ApplyCollimation(self.drrPixels, self.drrEngine.collimation)
+        self.DRRPixelsModified()
+        self.CountDRRFrame(copiedBytes, width * height * 3)
+        self.CacheDRR(cacheKey)
+
+    def OnDRRWorkerPoll(self):
+        # Main thread: show the worker's latest DRR by swapping it in as the texture scalars
+        result = self.drrWorker.TakeResult()
+        if result is not None:
+            self.drrPixels, cacheKey = result
+            self.drrImageData.GetPointData().SetScalars(self.drrScalars[self.drrWorker.frontIndex])
+            self.DRRPixelsModified()
+            self.CountDRRFrame()
+            if cacheKey is not None:
+                self.CacheDRR(cacheKey)
+            self.ScheduleThreeDViewRender()
+        if not self.drrWorker.IsBusy():
+            self.drrWorkerTimer.stop()
+
+    def SetProfilingEnabled(self, enabled):
+        # Also times every frame of the 3D view, which includes uploading the DRR texture
+        self.profiler.SetEnabled(enabled)
+        renderWindow = self.threeDView.renderWindow() if self.threeDView is not None else None
+        if enabled and renderWindow is not None and not self.profilerObservers:
+            self.profilerObservers = [
+                renderWindow.AddObserver(vtk.vtkCommand.StartEvent, self.OnThreeDViewRenderStart),
+                renderWindow.AddObserver(vtk.vtkCommand.EndEvent, self.OnThreeDViewRenderEnd),
+            ]
+        elif not enabled and renderWindow is not None:
+            for observer in self.profilerObservers:
+                renderWindow.RemoveObserver(observer)
+            self.profilerObservers = []
+        if not enabled:
+            self.SetProfilerOverlayVisible(False)
+
+    def OnThreeDViewRenderStart(self, caller, event):
+        self.threeDViewRenderStartTime = time.perf_counter()
+
+    def OnThreeDViewRenderEnd(self, caller, event):
+        if self.threeDViewRenderStartTime is None:
+            return
+        self.profiler.Record("3D view frame (texture upload)", self.threeDViewRenderStartTime,
+                             time.perf_counter() - self.threeDViewRenderStartTime)
+
+    def SetProfilerOverlayVisible(self, visible):
+        # Stage statistics in a corner of the 3D view, and of the VR view when LOD is running
+        renderers = [self.slicerRenderer]
+        if self.lodRenderer is not None:
+            renderers.append(self.lodRenderer)
+        if self.profilerOverlay is not None:
+            for renderer in renderers:
+                renderer.RemoveViewProp(self.profilerOverlay)
+            self.profilerOverlay = None
+            self.profilerOverlayTimer.stop()
+        if not visible:
+            return
+        self.profilerOverlay = vtk.vtkCornerAnnotation()
+        self.profilerOverlay.SetMaximumFontSize(14)
+        self.profilerOverlay.GetTextProperty().SetFontFamilyToCourier()
+        self.profilerOverlay.GetTextProperty().SetColor(1, 1, 0)
+        for renderer in renderers:
+            renderer.AddViewProp(self.profilerOverlay)
+        self.profilerOverlayTimer.start()
+
+    def OnProfilerOverlayTimer(self):
+        self.profilerOverlay.SetText(vtk.vtkCornerAnnotation.UpperLeft, self.profiler.GetReport())
+        self.ScheduleThreeDViewRender()
+
+    def GetProfilerStatistics(self):
+        return self.profiler.GetStatistics()
+
+    def ExportProfilerTrace(self, path):
+        # Chrome trace format, open in chrome://tracing or ui.perfetto.dev
+        return self.profiler.ExportChromeTrace(path)
+
+    def CacheDRR(self, cacheKey):
+        # The cache keeps its own copy of the frame
+        self.drrCache.Put(cacheKey, self.drrPixels)
+        self.drrCopyStatistics["cacheBytes"] += self.drrPixels.nbytes
+
+    def CountDRRFrame(self, copiedBytes=0, readbackBytes=0):
+        # copiedBytes: CPU copies needed to get the frame into the monitor texture
+        statistics = self.drrCopyStatistics
+        statistics["frames"] += 1
+        statistics["copiedBytes"] += copiedBytes
+        statistics["readbackBytes"] += readbackBytes
+        statistics["lastFrameCopiedBytes"] = copiedBytes
+
+    def GetDRRCopyStatistics(self):
+        statistics = dict(self.drrCopyStatistics)
+        frames = max(statistics["frames"], 1)
+        statistics["copiedBytesPerFrame"] = statistics["copiedBytes"] / float(frames)
+        statistics["cacheBytesPerFrame"] = statistics["cacheBytes"] / float(frames)
+        return statistics
+
+    def ResetDRRCopyStatistics(self):
+        self.drrCopyStatistics = {"frames": 0, "copiedBytes": 0, "readbackBytes": 0, "cacheBytes": 0,
+                                  "lastFrameCopiedBytes": 0}
+
+    def GetDRRWorkerStatistics(self):
+        if self.drrWorker is None:
+            return None
+        return self.drrWorker.GetStatistics()
+
+    def GetDRRSkippingStatistics(self):
+        # Samples of the CPU DRRs saved by cropping the volume and skipping empty blocks
+        return self.drrEngine.GetSkippingStatistics()
+
+    def DRRPixelsModified(self):
+        # Let the monitor texture know drrPixels has been written
+        self.drrImageData.GetPointData().GetScalars().Modified()
+        self.drrImageData.Modified()
+        if self.targetScoring and self.targetScorer.HasReference(self.currentImageLabel):
+            self.UpdateTargetScore()
+
+    def CreateReferenceCore(self):
+        # Renders DRRs of the shown case as the module's live frames are rendered: full resolution at the
+        # training field of view, and with the transfer function whatever beam the monitor uses
+        core = CarmSimulatorCore(self.resourcePath, self.drrEngine.width, self.drrEngine.height)
+        core.SetFieldOfView(TrainingFieldOfView)
+        self.UpdateCoreVolume(core)
+        return core
+
+    def GetTargetReferencePath(self, label):
+        return os.path.join(self.resourcePath, 'Resources', 'TargetViews', label + '.png')
+
+    def GetTargetReferenceImage(self, label, referenceCore=None):
+        # Resources/TargetViews/<label>.png when it exists, otherwise a DRR of the current case
+        # rendered at the view's approximate pose
+        path = self.GetTargetReferencePath(label)
+        if os.path.exists(path):
+            return ReadReferenceImage(path)
+        core = referenceCore or self.CreateReferenceCore()
+        image = core.RenderDRR(TargetViewPoses[label]) if core.HasVolume() else None
+        if referenceCore is None:
+            core.Shutdown()
+        return image
+
+    def UpdateTargetReferences(self):
+        # Called once the case, pose and field of view of the module are set
+        self.targetScorer.RemoveAllReferences()
+        self.targetScore = None
+        referenceCore = self.CreateReferenceCore()
+        for label in TargetViewPoses:
+            image = self.GetTargetReferenceImage(label, referenceCore)
+            if image is not None:
+                self.targetScorer.SetReference(label, image)
+        referenceCore.Shutdown()
+
+    def UpdateTargetScore(self):
+        with self.profiler.Stage("Target scoring"):
+            self.targetScore = self.targetScorer.Score(self.currentImageLabel, self.drrPixels)
+        if self.targetScoreCallback is not None:
+            self.targetScoreCallback(self.targetScore)
+
+    def GetTargetScoringStatistics(self):
+        return self.targetScorer.GetStatistics()
+
+    def GetOptimalPosesPath(self):
+        if self.optimalPosesPath is None:
+            settingsDirectory = os.path.dirname(slicer.app.slicerUserSettingsFilePath)
+            self.optimalPosesPath = os.path.join(settingsDirectory, 'CarmSimulator', 'OptimalPoses.json')
+        return self.optimalPosesPath
+
+    def LoadOptimalPoses(self):
+        caseName = self.caseLibrary.activeName
+        self.optimalPoses = LoadOptimalPoses(self.GetOptimalPosesPath()).get(caseName, {})
+
+    def SolveTargetPose(self, label, referenceImage=None, numberOfStarts=8, numberOfWorkers=None, callback=None):
+        """Starts searching the pose whose DRR of the active case best matches a target view.
+
+        The reference is Resources/TargetViews/<label>.png unless referenceImage is given,
+        taken like the training frames: candidates are rendered at the training zoom and
+        field of view, with the transfer function. OnPoseSolverPoll stores the solution with
+        the case, where CollectImage uses it to measure how far the collected pose is from
+        it, and passes it to callback. Returns the future of the solution, or None when
+        there is no reference image.
+        """
+        if referenceImage is None:
+            path = self.GetTargetReferencePath(label)
+            if not os.path.exists(path):
+                # A rendered reference would only give back the pose it was rendered at
+                logging.warning("No reference image for %s, its optimal pose is not solved" % label)
+                return None
+            referenceImage = ReadReferenceImage(path)
+        case = self.caseLibrary.cases[self.caseLibrary.activeName]
+        volumePath = case.path or self.scene.GetResourceFile(case.name + '.mha')
+        future = self.poseSolverExecutor.submit(
+            SolvePose, volumePath, referenceImage, self.GetWorldIJKToRAS(case.node), TrainingPose[4],
+            TargetViewPoses.get(label), numberOfStarts, numberOfWorkers, opacityPoints=self.opacityPoints,
+            width=self.drrEngine.width, height=self.drrEngine.height, fieldOfView=TrainingFieldOfView)
+        self.poseSolves.append((case.name, label, future, callback))
+        self.poseSolverTimer.start()
+        return future
+
+    def OnPoseSolverPoll(self):
+        for solve in [solve for solve in self.poseSolves if solve[2].done()]:
+            self.poseSolves.remove(solve)
+            caseName, label, future, callback = solve
+            if future.cancelled():
+                continue
+            try:
+                solution = future.result()
+            except Exception:
+                logging.exception("Solving %s for %s failed" % (label, caseName))
+                continue
+            SaveOptimalPose(self.GetOptimalPosesPath(), caseName, label, solution)
+            if caseName == self.caseLibrary.activeName:
+                self.optimalPoses[label] = solution
+            logging.info("Solved %s for %s in %.1f s: pose %s, score %.1f" %
+                         (label, caseName, solution["seconds"], ", ".join("%.1f" % v for v in solution["pose"]),
+                          solution["score"]))
+            if callback is not None:
+                callback(solution)
+        if not self.poseSolves:
+            self.poseSolverTimer.stop()
+
+    def StopPoseSolves(self):
+        # Solves that have not started are dropped, a running one finishes but is not stored
+        self.poseSolverTimer.stop()
+        for caseName, label, future, callback in self.poseSolves:
+            future.cancel()
+        self.poseSolves = []
+        self.poseSolverExecutor.shutdown(wait=False)
+
+    def GetPose(self):
+        # Pose in CarmSimulatorKinematics order: C, gantry, wag, table, zoom
+        return self.core.GetPose()
+
+    def GetPoseWith(self, index, value):
+        return self.core.GetPoseWith(index, value)
 
     def UpdateCRotation(self, value):
-        self.zRotationValue = value
-        self.cRotation.Identity()
-        self.cRotation.PostMultiply()
-        self.cRotation.Translate(-1262.2704, -337.5527, 5.7)
-        self.cRotation.RotateZ(value)
-        self.cRotation.Translate(1262.2704, 337.5527, -5.7)
-        self.scene.cTransform.SetMatrixTransformToParent(self.cRotation.GetMatrix())
+        if self.IsMoveBlocked(self.GetPoseWith(0, value)):
+            return
+        self.core.zRotationValue = value
+        matrices = self.core.GetModelMatrices()
+        slicer.util.updateTransformMatrixFromArray(self.scene.cTransform, matrices["C"])
+        self.RecordPose()
         if self.toggleDRR == True:
-            self.UpdateDRR()
+            self.RequestDRRUpdate()
 
         # Update Gantry Rotation
 
     def UpdateGantryRotation(self, value):
-        self.xRotationValue = value
-        self.gantryRotation.Identity()
-        self.gantryRotation.Translate(0,337.5527,0)
-        self.gantryRotation.RotateX(value)
-        self.gantryRotation.Translate(0,-337.5527,0)
-        self.scene.gantryTransform.SetMatrixTransformToParent(self.gantryRotation.GetMatrix())
+        if self.IsMoveBlocked(self.GetPoseWith(1, value)):
+            return
+        self.core.xRotationValue = value
+        matrices = self.core.GetModelMatrices()
+        slicer.util.updateTransformMatrixFromArray(self.scene.gantryTransform, matrices["Gantry"])
+        self.RecordPose()
         if self.toggleDRR == True:
-            self.UpdateDRR()
+            self.RequestDRRUpdate()
 
     def UpdateWagRotation(self, value):
-        self.yRotationValue = value
-        self.wagRotation.Identity()
-        self.wagRotation.Translate(500,0,0)
-        self.wagRotation.RotateY(value)
-        self.wagRotation.Translate(-500,0, 0)
-        self.scene.wagTransform.SetMatrixTransformToParent(self.wagRotation.GetMatrix())
+        if self.IsMoveBlocked(self.GetPoseWith(2, value)):
+            return
+        self.core.yRotationValue = value
+        matrices = self.core.GetModelMatrices()
+        slicer.util.updateTransformMatrixFromArray(self.scene.wagTransform, matrices["Wag"])
+        self.RecordPose()
         if self.toggleDRR == True:
-            self.UpdateDRR()
+            self.RequestDRRUpdate()
 
     def UpdateTable(self, value):
-        self.tableTranslationValue = value
-        self.tableTranslationTransform.Identity()
-        self.tableTranslationTransform.Translate(0,self.tableTranslationValue,0)
-        self.scene.tableZTranslation.SetMatrixTransformToParent(self.tableTranslationTransform.GetMatrix())
+        if self.IsMoveBlocked(self.GetPoseWith(3, value)):
+            return
+        self.core.tableTranslationValue = value
+        matrices = self.core.GetModelMatrices()
+        slicer.util.updateTransformMatrixFromArray(self.scene.tableZTranslation, matrices["Table"])
+        self.RecordPose()
         if self.toggleDRR == True:
-            self.UpdateDRR()
+            self.RequestDRRUpdate()
+
+    def SetPose(self, pose):
+        # Move every axis at once (C, gantry, wag, table, zoom), used by replays and benchmarks
+        # Replays must reproduce the recording, so collisions are only flagged here
+        self.poseCollisions = self.CheckCollisions(pose)
+        self.core.SetPose(pose)
+        matrices = self.core.GetModelMatrices()
+        slicer.util.updateTransformMatrixFromArray(self.scene.cTransform, matrices["C"])
+        slicer.util.updateTransformMatrixFromArray(self.scene.gantryTransform, matrices["Gantry"])
+        slicer.util.updateTransformMatrixFromArray(self.scene.wagTransform, matrices["Wag"])
+        slicer.util.updateTransformMatrixFromArray(self.scene.tableZTranslation, matrices["Table"])
+        self.RecordPose()
+        if self.toggleDRR == True:
+            self.RequestDRRUpdate()
+
+    def ShootFluoro(self):
+        # Single DRR shot while the live DRR is off
+        if self.toggleDRR == True:
+            return
+        if self.DRRInitialized == False:
+            self.InitializeDRR()
+        # Rendered once, at full resolution, and on the monitor by the time the shot is counted
+        self.UpdateDRR(synchronous=True)
+        self.RenderThreeDView("Fluoro shot 3D render")
+        self.numShots += 1
+        self.DepositDose()
+        if self.recorder is not None:
+            self.recorder.RecordShot(self.GetPose(), self.numShots)
+
+    def StartRecording(self, path=None):
+        # Record every pose change, shot and VR input until StopRecording
+        self.StopRecording()
+        if path is None:
+            directory = os.path.join(slicer.app.temporaryPath, 'CarmSimulator')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, datetime.datetime.now().strftime("Session-%Y%m%d-%H%M%S.carmrec"))
+        self.recorder = CarmSimulatorPoseRecorder(path)
+        self.recorder.Start()
+        self.RecordPose()
+        return path
+
+    def StopRecording(self):
+        if self.recorder is None:
+            return None
+        self.recorder.Stop()
+        statistics = self.recorder.GetStatistics()
+        self.recorder = None
+        return statistics
+
+    def RecordPose(self):
+        if self.recorder is not None:
+            self.recorder.RecordPose(self.GetPose())
+
+    def RecordInput(self, inputValues):
+        # Raw controller values, the movement direction can be derived from them
+        if self.recorder is not None:
+            self.recorder.RecordInput(inputValues)
+
+    def StartReplay(self, path, realTime=True):
+        """Replay a recording from StartRecording.
+
+        At real time the events are applied from a timer and the DRR is scheduled
+        as usual. Otherwise every event is applied immediately and its DRR rendered
+        before the next one, and the replay time in seconds is returned.
+        Collected images are written to the results file and the session store
+        as they were, while a training module is running.
+        """
+        self.StopReplay()
+        callbacks = {
+            EventPose: lambda values, value: self.ReplayPose(values),
+            EventShot: lambda values, value: self.ShootFluoro(),
+            EventCollect: lambda values, value: self.ReplayCollect(),
+            EventFieldOfView: lambda values, value: self.ReplayFieldOfView(value),
+        }
+        self.replay = CarmSimulatorReplay(ReadRecording(path), callbacks)
+        if realTime:
+            self.replayElapsedTimer.start()
+            self.replayTimer.start()
+            return None
+
+        def ApplyAndRender(values, value, callback):
+            callback(values, value)
+            self.drrScheduler.Flush()
+        self.replay.callbacks = {eventType: (lambda values, value, callback=callback: ApplyAndRender(values, value, callback))
+                                 for eventType, callback in callbacks.items()}
+        seconds = self.replay.Run()
+        self.replay = None
+        return seconds
+
+    def ReplayPose(self, pose):
+        self.SetPose(pose)
+        if self.replayPoseCallback is not None:
+            self.replayPoseCallback()
+
+    def ReplayFieldOfView(self, fieldOfView):
+        self.ChangeFOV(fieldOfView)
+        if self.replayPoseCallback is not None:
+            self.replayPoseCallback()
+
+    def ReplayCollect(self):
+        # Without a training module there is no target to collect for
+        if self.currentImageLabel is None:
+            logging.warning("Replayed collect skipped, no training module is running")
+            return
+        self.CollectImage(True)
+
+    def OnReplayTimer(self):
+        self.replay.Step(self.replayElapsedTimer.nsecsElapsed() * 1e-9)
+        if self.replay.IsFinished():
+            self.StopReplay()
+
+    def StopReplay(self):
+        self.replayTimer.stop()
+        self.replay = None
+
+    def GetSessionStore(self):
+        if self.sessionStore is None:
+            if self.sessionStorePath is None:
+                settingsDirectory = os.path.dirname(slicer.app.slicerUserSettingsFilePath)
+                self.sessionStorePath = os.path.join(settingsDirectory, 'CarmSimulator', 'Sessions.sqlite')
+            self.sessionStore = CarmSimulatorSessionStore(self.sessionStorePath)
+        return self.sessionStore
+
+    def EndTrainingSession(self, completed):
+        # Stores the totals of the open session, if any; an incomplete one was left for another StartModule
+        if self.sessionId is None:
+            return
+        doseStatistics = self.GetDoseStatistics() or {}
+        self.GetSessionStore().EndSession(self.sessionId, self.numShots, self.moduleTimer.elapsed() / 1000.0,
+                                          doseStatistics.get("doseAreaProduct"), doseStatistics.get("peakSkinDose"),
+                                          completed)
+        self.sessionId = None
+
+    def CloseSessionStore(self):
+        # Writes whatever is still queued, after abandoning the open session
+        self.EndTrainingSession(completed=False)
+        if self.sessionStore is not None:
+            self.sessionStore.Close()
+            self.sessionStore = None
+
+    def GetSessionAnalytics(self):
+        # Aggregates over every stored session
+        store = self.GetSessionStore()
+        store.Flush()
+        return {
+            "timeToTargetPerView": store.GetTimeToTargetPerView(),
+            "shotsPerImage": store.GetShotsPerImage(),
+            "scorePerView": store.GetScorePerView(),
+            "angleErrorPerView": store.GetAngleErrorPerView(),
+            "totalTimeByTrainee": store.GetCohortPercentiles("totalTime"),
+            "totalShotsByTrainee": store.GetCohortPercentiles("totalShots"),
+            "doseAreaProductByTrainee": store.GetCohortPercentiles("doseAreaProduct"),
+            "peakSkinDoseByTrainee": store.GetCohortPercentiles("peakSkinDose"),
+        }
 
     def StartModule(self, value):
         #if self.scene.lumbarSpineVolume is not None:
         #    slicer.mrmlScene.RemoveNode(self.scene.lumbarSpineVolume)
         # Start timer
+        # A session still open was left before its last image, its totals are taken before they are reset
+        self.EndTrainingSession(completed=False)
         self.cleanup()
         self.DRRInitialized = False
         self.toggleDRR = False
-        self.renderer.RemoveVolume(self.volume)
-        slicer.mrmlScene.RemoveNode(self.scene.lumbarSpineVolume)
-        self.scene.loadScoliosisCT()
-        self.volume = self.slicerRenderer.GetVolumes().GetItemAsObject(0)
-        self.renderer.AddVolume(self.volume)
+        self.drrScheduler.Cancel()
+        self.drrRefineTimer.stop()
+        self.SwitchCase(ScoliosisVolumeName)
+        # Every axis at once, resetting them one by one could be refused halfway by the collision check
+        self.SetPose(TrainingPose)
+        self.ChangeFOV(TrainingFieldOfView)
+        self.UpdateTargetReferences()
+        self.LoadOptimalPoses()
         self.renderer.Render()
 
         self.imagesRemaining = ["Left Scotty Dog", "Full Lateral", "Full AP",
@@ -696,49 +1592,89 @@ class CarmSimulatorLogic(ScriptedLoadableModuleLogic):
         #self.scene.CreateImageLabelModel(1063, 898)
 
         self.numShots = 0
+        self.ResetDose()
         self.moduleTimer = qt.QElapsedTimer()
         self.moduleTimer.start()
+        self.lastCollectShots = 0
+        self.lastCollectTime = 0.0
+        self.sessionId = self.GetSessionStore().BeginSession(self.traineeName, ScoliosisVolumeName)
 
-        self.slicerRenderer.Render()
+        self.RenderThreeDView()
 
         # Create Training File
         self.resultsFileName = os.path.join(self.resourcePath, 'Resources\Temp.csv')
         self.resultsFile = open(self.resultsFileName, 'w')
         createdDate = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
         self.resultsFile.write(createdDate + "\n")
-        self.resultsFile.write("C,Gantry,Wag,Table\n")
+        self.resultsFile.write("C,Gantry,Wag,Table,Score,AngleError,TableError\n")
         self.resultsFile.close()
 
 
 
     def CollectImage(self, value):
+        if self.recorder is not None:
+            self.recorder.RecordCollect(self.GetPose())
+
+        # Score of the collected image, empty when there is no reference for the view
+        targetScore = None
+        if self.drrPixels is not None:
+            targetScore = self.targetScorer.Score(self.currentImageLabel, self.drrPixels)
+        score = targetScore["score"] if targetScore is not None else None
+
+        # Distance to the solved optimal pose, empty when the view has not been solved for this case
+        angleError = tableError = None
+        optimum = self.optimalPoses.get(self.currentImageLabel)
+        if optimum is not None:
+            angleError, tableError = PoseError(self.GetPose(), optimum["pose"])
 
         self.resultsFile = open(self.resultsFileName, 'a')
-        line = str(self.zRotationValue) + "," + \
-               str(self.xRotationValue) + "," + \
-               str(self.yRotationValue) + "," + \
-               str(self.tableTranslationValue) + "\n"
+        line = str(self.core.zRotationValue) + "," + \
+               str(self.core.xRotationValue) + "," + \
+               str(self.core.yRotationValue) + "," + \
+               str(self.core.tableTranslationValue) + "," + \
+               ",".join("%.1f" % value if value is not None else "" for value in (score, angleError, tableError)) + "\n"
         self.resultsFile.writelines(line)
         self.resultsFile.close()
 
+        # Queued for the session store's writer thread
+        if self.sessionId is not None:
+            elapsed = self.moduleTimer.elapsed() / 1000.0
+            imageIndex = 8 - len(self.imagesRemaining)
+            self.GetSessionStore().AddShot(self.sessionId, imageIndex, self.currentImageLabel, self.GetPose(),
+                                           self.numShots - self.lastCollectShots, elapsed,
+                                           elapsed - self.lastCollectTime, score, angleError, tableError)
+            self.lastCollectShots = self.numShots
+            self.lastCollectTime = elapsed
+            if len(self.imagesRemaining) == 0:
+                self.EndTrainingSession(completed=True)
 
         if self.imagesRemaining.__len__() == 0:
+            self.currentImageLabel = None
             self.scene.UpdateImageLabelModel("Module Complete")
-            self.slicerRenderer.Render()
+            self.RenderThreeDView()
             self.resultsFile = open(self.resultsFileName, 'a')
             line = str("Number of shots: ") + str(self.numShots) + "\n"
             self.resultsFile.writelines(line)
             line = str("Total Time(ms): ") + str(self.moduleTimer.elapsed()) + "\n"
             self.resultsFile.writelines(line)
+            if self.doseMap is not None:
+                line = "Dose area product (mGy cm2): %.1f\nPeak skin dose (mGy): %.2f\n" % (
+                    self.doseMap.doseAreaProduct, self.doseMap.GetPeakSkinDose())
+                self.resultsFile.writelines(line)
+                # Per vertex skin dose next to the results file
+                self.doseMap.Save(os.path.splitext(self.resultsFileName)[0] + 'SkinDose.npz')
             self.resultsFile.close()
             return
 
         self.currentImageLabel = self.imagesRemaining.pop()
         self.scene.UpdateImageLabelModel(self.currentImageLabel)
-        self.slicerRenderer.Render()
+        self.RenderThreeDView()
 
 
     def cleanup(self):
+        if self.drrWorker is not None:
+            self.drrWorker.Cancel()
+            self.drrWorkerTimer.stop()
         if self.planeModelNode is not None:
             slicer.mrmlScene.RemoveNode(self.planeModelNode)
         if self.scene.imageLabelModelNode is not None:
@@ -757,7 +1693,7 @@ class CarmSimulatorTest(ScriptedLoadableModuleTest):
     def setUp(self):
         """ Do whatever is needed to reset the state - typically a scene clear will be enough.
         """
-        # slicer.mrmlScene.Clear(0)
+        slicer.mrmlScene.Clear(0)
 
     def runTest(self):
         """Run as few or as many tests as needed here.
@@ -766,8 +1702,63 @@ class CarmSimulatorTest(ScriptedLoadableModuleTest):
         self.test_CarmSimulator()
 
     def test_CarmSimulator(self):
+        import numpy as np
         self.delayDisplay("Starting the test")
         logic = CarmSimulatorLogic()
-        result = "Need To Implement"
-        self.assertIsNotNone(result)
+        # Sessions and solved poses of the test stay out of the user's settings
+        testDirectory = os.path.join(slicer.app.temporaryPath, 'CarmSimulatorTest')
+        if not os.path.exists(testDirectory):
+            os.makedirs(testDirectory)
+        logic.sessionStorePath = os.path.join(testDirectory, 'Sessions.sqlite')
+        logic.optimalPosesPath = os.path.join(testDirectory, 'OptimalPoses.json')
+        if os.path.exists(logic.sessionStorePath):
+            os.remove(logic.sessionStorePath)
+        logic.GenerateScene(True)
+        self.delayDisplay("Scene generated")
+
+        # CPU DRRs rendered in the calling thread, so every shot is on the monitor when it returns
+        logic.SetDRRBackend("CPU")
+        logic.drrAsync = False
+        logic.drrProgressive = False
+        logic.StartModule(True)
+        self.assertEqual(logic.GetPose(), TrainingPose)
+        self.assertEqual(logic.core.fieldOfViewValue, TrainingFieldOfView)
+        self.assertEqual(logic.numShots, 0)
+
+        logic.ShootFluoro()
+        self.assertEqual(logic.numShots, 1)
+        self.assertEqual(logic.drrPixels.shape, (logic.drrEngine.height, logic.drrEngine.width, 3))
+        self.assertGreater(logic.drrPixels.std(), 0)
+        shot = logic.drrPixels.copy()
+        self.delayDisplay("First shot")
+
+        # Same pose again is taken from the DRR cache
+        hits = logic.drrCache.GetStatistics()["hits"]
+        logic.ShootFluoro()
+        self.assertEqual(logic.numShots, 2)
+        self.assertEqual(logic.drrCache.GetStatistics()["hits"], hits + 1)
+        np.testing.assert_array_equal(logic.drrPixels, shot)
+
+        # Moving the C-arm changes the image, unchecked so the move cannot be refused
+        logic.SetCollisionMode("Off")
+        logic.SetPose([30.0, 0.0, 0.0, 0.0, TrainingPose[4]])
+        self.assertEqual(logic.GetPose(), [30.0, 0.0, 0.0, 0.0, TrainingPose[4]])
+        logic.ShootFluoro()
+        self.assertFalse(np.array_equal(logic.drrPixels, shot))
+        self.delayDisplay("Second pose")
+
+        # Collected images go to the session store with the shots taken for them
+        label = logic.currentImageLabel
+        logic.CollectImage(True)
+        self.assertNotEqual(logic.currentImageLabel, None)
+        store = logic.GetSessionStore()
+        store.Flush()
+        shots = store.GetShots()
+        self.assertEqual(list(shots["label"]), [label])
+        self.assertEqual(list(shots["shotCount"]), [3])
+
+        logic.CloseSessionStore()
+        logic.StopPoseSolves()
+        logic.core.Shutdown()
+        logic.cleanup()
         self.delayDisplay('Test passed!')
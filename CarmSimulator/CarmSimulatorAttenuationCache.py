@@ -0,0 +1,101 @@
+import hashlib
+import logging
+import os
+import numpy as np
+
+from CarmSimulatorDRR import OpacityToAttenuation
+from CarmSimulatorVolumeIO import ReadMetaImage
+
+#
+# Baked Attenuation Volumes
+#
+# The opacity transfer function is applied to a CT once and the resulting
+# attenuation is stored as uint16 with one scale factor per volume, half the
+# memory of float32. The baked volume is written beside the .mha and reused as
+# long as the transfer function points and the .mha file are unchanged, so
+# cases and batch workers start without reading or converting the CT.
+#
+
+# Bumped whenever the baked format or the conversion changes
+BakeVersion = 1
+
+QuantizationLevels = 65535
+
+
+def BakeAttenuation(scalars, opacityPoints):
+    """uint16 attenuation volume and the scale turning it into attenuation per mm.
+
+    Integer CT volumes are converted through a table over every possible value,
+    so the transfer function is evaluated 65536 times instead of once per voxel.
+    """
+    scalars = np.asarray(scalars)
+    if scalars.dtype.kind in "iu" and scalars.dtype.itemsize <= 2:
+        info = np.iinfo(scalars.dtype)
+        table = OpacityToAttenuation(np.arange(info.min, info.max + 1, dtype=np.float32), opacityPoints)
+        scale = max(float(table.max()), 1e-12) / QuantizationLevels
+        table = np.rint(table / scale).astype(np.uint16)
+        if info.min < 0:
+            # Two's complement: the unsigned view of value v is v - min modulo 2^bits, rotate the table to match
+            table = np.roll(table, info.min)
+            scalars = scalars.view(scalars.dtype.str.replace('i', 'u'))
+        return table[scalars], scale
+    attenuation = OpacityToAttenuation(scalars, opacityPoints)
+    scale = max(float(attenuation.max()), 1e-12) / QuantizationLevels
+    return np.rint(attenuation / scale).astype(np.uint16), scale
+
+
+def GetBakedAttenuationPath(volumePath):
+    return os.path.splitext(volumePath)[0] + '.attenuation.npz'
+
+
+def GetBakeKey(volumePath, opacityPoints):
+    # Changes with the transfer function, the CT file and the baked format
+    status = os.stat(volumePath)
+    digest = hashlib.sha1(np.ascontiguousarray(opacityPoints, dtype=np.float64).tobytes())
+    digest.update(("%d %d %d" % (BakeVersion, status.st_size, status.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+def LoadBakedAttenuation(volumePath, opacityPoints):
+    # (attenuation, scale, ijkToRAS) from the cache, None when missing or stale
+    bakedPath = GetBakedAttenuationPath(volumePath)
+    if not os.path.exists(bakedPath):
+        return None
+    try:
+        with np.load(bakedPath) as baked:
+            if str(baked["key"]) != GetBakeKey(volumePath, opacityPoints):
+                return None
+            return baked["attenuation"], float(baked["scale"]), baked["ijkToRAS"]
+    except (OSError, KeyError, ValueError) as error:
+        logging.warning("Ignoring unreadable baked attenuation %s: %s" % (bakedPath, error))
+        return None
+
+
+def SaveBakedAttenuation(volumePath, opacityPoints, attenuation, scale, ijkToRAS):
+    # Written under a temporary name first, several processes may bake the same volume
+    bakedPath = GetBakedAttenuationPath(volumePath)
+    temporaryPath = "%s.%d.tmp.npz" % (bakedPath, os.getpid())
+    try:
+        np.savez(temporaryPath, key=GetBakeKey(volumePath, opacityPoints), attenuation=attenuation, scale=scale,
+                 ijkToRAS=ijkToRAS)
+        os.replace(temporaryPath, bakedPath)
+    except OSError as error:
+        logging.warning("Could not cache baked attenuation %s: %s" % (bakedPath, error))
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+
+
+def ReadAttenuationVolume(volumePath, opacityPoints, scalars=None, ijkToRAS=None):
+    """Baked (attenuation, scale, ijkToRAS) of a .mha volume, baked and cached if needed.
+
+    scalars and ijkToRAS can be given when the CT is already loaded, otherwise it
+    is only read when the cache is stale.
+    """
+    baked = LoadBakedAttenuation(volumePath, opacityPoints)
+    if baked is None:
+        if scalars is None:
+            scalars, ijkToRAS = ReadMetaImage(volumePath)
+        attenuation, scale = BakeAttenuation(scalars, opacityPoints)
+        baked = (attenuation, scale, np.asarray(ijkToRAS, dtype=np.float64))
+        SaveBakedAttenuation(volumePath, opacityPoints, *baked)
+    return baked
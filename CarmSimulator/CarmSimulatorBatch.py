@@ -0,0 +1,231 @@
+"""Headless batch generation of labeled DRR datasets.
+
+Renders DRRs for a grid or random sample of C-arm poses with the CPU engine,
+spread over all CPU cores with a process pool. Images and pose labels are
+written in compressed chunks, and an interrupted run resumes from the chunks
+already on disk.
+
+Example:
+    python CarmSimulatorBatch.py --volume Resources/LumbarSpinePhantom_CT.mha \\
+        --output /data/drr --c=-15:115:5 --gantry=-55:55:5
+    python CarmSimulatorBatch.py --volume A.mha --volume B.mha --output /data/drr --random 50000
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from CarmSimulatorDRR import CarmSimulatorDRREngine, ReadVolumeProperty
+from CarmSimulatorKinematics import ComputeDRRCameras
+from CarmSimulatorAttenuationCache import ReadAttenuationVolume
+
+# Pose axes in label order, with the slider limits from CarmSimulatorWidget.setup
+PoseAxes = ["c", "gantry", "wag", "table", "zoom"]
+PoseLimits = {
+    "c": (-15.0, 115.0),
+    "gantry": (-55.0, 55.0),
+    "wag": (-40.0, 40.0),
+    "table": (-155.0, 155.0),
+    "zoom": (0.0, 50.0),
+}
+
+
+def ParseAxisSpec(spec):
+    # "value", "start:stop" (sampling range) or "start:stop:step" (inclusive grid)
+    values = [float(v) for v in spec.split(':')]
+    if len(values) == 1:
+        return values[0], values[0], None
+    if len(values) == 2:
+        return values[0], values[1], None
+    return values[0], values[1], values[2]
+
+
+def GeneratePoses(axisSpecs, randomCount=0, seed=0):
+    """Returns an (N, 5) array of C, gantry, wag, table and zoom values.
+
+    With randomCount, poses are sampled uniformly within each axis range.
+    Otherwise the poses are the full grid over all axes.
+    """
+    ranges = [ParseAxisSpec(axisSpecs[axis]) for axis in PoseAxes]
+    if randomCount > 0:
+        generator = np.random.default_rng(seed)
+        low = np.array([r[0] for r in ranges])
+        high = np.array([r[1] for r in ranges])
+        return generator.uniform(low, high, size=(randomCount, len(PoseAxes)))
+
+    axisValues = []
+    for start, stop, step in ranges:
+        if step is None:
+            axisValues.append(np.array([start]))
+        else:
+            axisValues.append(np.arange(start, stop + step * 0.5, step))
+    grid = np.meshgrid(*axisValues, indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=1)
+
+
+#
+# Worker process
+#
+
+workerEngine = None
+workerVolumePath = None
+workerOpacityPoints = None
+
+
+def InitializeWorker(opacityPoints, width, height):
+    global workerEngine, workerOpacityPoints
+    # One process per core, so the engine itself stays single threaded
+    workerEngine = CarmSimulatorDRREngine(width, height, numberOfThreads=1)
+    workerOpacityPoints = opacityPoints
+
+
+def RenderChunk(volumePath, poses, chunkPath):
+    global workerVolumePath
+    if workerVolumePath != volumePath:
+        # The first worker to get here bakes the volume, later runs only load the baked file
+        attenuation, scale, ijkToRAS = ReadAttenuationVolume(volumePath, workerOpacityPoints)
+        workerEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+        workerVolumePath = volumePath
+
+    startTime = time.perf_counter()
+    images = np.empty((len(poses), workerEngine.height, workerEngine.width), dtype=np.uint8)
+    rgb = np.empty((workerEngine.height, workerEngine.width, 3), dtype=np.uint8)
+    positions, focalPoints, viewUps = ComputeDRRCameras(poses)
+    for index in range(len(poses)):
+        workerEngine.Render(positions[index], focalPoints[index], viewUps[index], out=rgb)
+        images[index] = rgb[:, :, 0]
+
+    # Write to a temporary name first so a killed run never leaves a partial chunk behind
+    temporaryPath = chunkPath + ".tmp.npz"
+    np.savez_compressed(temporaryPath, images=images, poses=poses)
+    os.replace(temporaryPath, chunkPath)
+    return len(poses), time.perf_counter() - startTime
+
+
+#
+# Dataset
+#
+
+def PrepareDataset(outputDirectory, volumePaths, poses, settings):
+    # Writes the manifest on the first run, checks it matches when resuming
+    os.makedirs(outputDirectory, exist_ok=True)
+    manifestPath = os.path.join(outputDirectory, "dataset.json")
+    posesPath = os.path.join(outputDirectory, "poses.npy")
+    manifest = dict(settings)
+    manifest["volumes"] = [os.path.abspath(path) for path in volumePaths]
+    manifest["poseAxes"] = PoseAxes
+    manifest["numberOfPoses"] = int(len(poses))
+
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as f:
+            existing = json.load(f)
+        if existing != manifest:
+            raise ValueError("Output directory holds a different dataset: " + outputDirectory)
+        return np.load(posesPath)
+
+    np.save(posesPath, poses)
+    with open(manifestPath, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return poses
+
+
+def ChunkPath(outputDirectory, volumeIndex, chunkIndex):
+    return os.path.join(outputDirectory, "volume%02d_chunk%06d.npz" % (volumeIndex, chunkIndex))
+
+
+def GenerateDataset(volumePaths, outputDirectory, poses, chunkSize=256, numberOfWorkers=None,
+                    volumePropertyPath=None, width=530, height=335, settings=None):
+    numberOfWorkers = numberOfWorkers or os.cpu_count() or 1
+    if volumePropertyPath is None:
+        volumePropertyPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Resources/VolumeProperty.vp')
+    opacityPoints, colorPoints = ReadVolumeProperty(volumePropertyPath)
+
+    settings = dict(settings or {})
+    settings.update({"chunkSize": chunkSize, "width": width, "height": height,
+                     "volumeProperty": os.path.abspath(volumePropertyPath)})
+    poses = PrepareDataset(outputDirectory, volumePaths, poses, settings)
+
+    # Skip chunks finished by an earlier run
+    tasks = []
+    skipped = 0
+    for volumeIndex, volumePath in enumerate(volumePaths):
+        for chunkIndex, start in enumerate(range(0, len(poses), chunkSize)):
+            chunkPath = ChunkPath(outputDirectory, volumeIndex, chunkIndex)
+            if os.path.exists(chunkPath):
+                skipped += 1
+                continue
+            tasks.append((volumePath, poses[start:start + chunkSize], chunkPath))
+    print("Rendering %d chunks (%d already done) on %d processes" % (len(tasks), skipped, numberOfWorkers))
+
+    startTime = time.perf_counter()
+    imageCount = 0
+    workerTime = 0.0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfWorkers, initializer=InitializeWorker,
+                                                initargs=(opacityPoints, width, height)) as executor:
+        futures = [executor.submit(RenderChunk, *task) for task in tasks]
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            count, seconds = future.result()
+            imageCount += count
+            workerTime += seconds
+            elapsed = time.perf_counter() - startTime
+            print("%d/%d chunks, %.1f images/s, %.2f images/s per core" %
+                  (done + 1, len(futures), imageCount / elapsed, imageCount / max(workerTime, 1e-9)))
+
+    elapsed = time.perf_counter() - startTime
+    report = {
+        "images": imageCount,
+        "seconds": elapsed,
+        "workers": numberOfWorkers,
+        "imagesPerSecond": imageCount / elapsed if elapsed > 0 else 0.0,
+        "imagesPerSecondPerCore": imageCount / workerTime if workerTime > 0 else 0.0,
+        "skippedChunks": skipped,
+    }
+    return report
+
+
+def LoadDataset(outputDirectory):
+    # Generator over (volume index, images, poses) for every finished chunk
+    for name in sorted(os.listdir(outputDirectory)):
+        if not name.startswith("volume") or not name.endswith(".npz") or name.endswith(".tmp.npz"):
+            continue
+        with np.load(os.path.join(outputDirectory, name)) as chunk:
+            yield int(name[6:8]), chunk["images"], chunk["poses"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a labeled DRR dataset without the Slicer GUI.")
+    parser.add_argument("--volume", action="append", required=True, help=".mha CT volume, may be repeated")
+    parser.add_argument("--output", required=True, help="Dataset directory, reused to resume a run")
+    for axis in PoseAxes:
+        parser.add_argument("--" + axis, default=None,
+                            help="value, min:max or start:stop:step, use --axis=-10:10 for negative values (default: slider range %g:%g)" % PoseLimits[axis])
+    parser.add_argument("--random", type=int, default=0, help="Sample this many random poses instead of a grid")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("--volume-property", default=None, help=".vp transfer function (default: Resources/VolumeProperty.vp)")
+    parser.add_argument("--size", type=int, nargs=2, default=[530, 335], metavar=("WIDTH", "HEIGHT"))
+    args = parser.parse_args(argv)
+
+    # Grids default to a single value per axis, random sampling to the full slider range
+    axisSpecs = {}
+    for axis in PoseAxes:
+        spec = getattr(args, axis)
+        if spec is None:
+            spec = "%g:%g" % PoseLimits[axis] if args.random > 0 else "0"
+        axisSpecs[axis] = spec
+
+    poses = GeneratePoses(axisSpecs, args.random, args.seed)
+    settings = {"axes": axisSpecs, "random": args.random, "seed": args.seed}
+    report = GenerateDataset(args.volume, args.output, poses, args.chunk_size, args.workers,
+                             args.volume_property, args.size[0], args.size[1], settings)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""Headless performance benchmarks of the C-arm simulator.
+
+Measures scene generation, the first DRR render, steady-state UpdateDRR latency,
+the polychromatic beam against the transfer function and full replays of canned
+C-arm trajectories, and writes the results as JSON.
+With a baseline file the run is compared against it and the exit code is 1 when
+a timing regressed by more than the tolerance.
+
+Example:
+    Slicer --no-main-window --python-script CarmSimulatorBenchmark.py \\
+        --output results.json --baseline baseline.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import slicer
+
+from CarmSimulator import CarmSimulatorLogic
+from CarmSimulatorBatch import PoseAxes, PoseLimits
+from CarmSimulatorScoring import TargetViewPoses
+
+BenchmarkVersion = 1
+
+# Approximate poses (C, gantry, wag, table, zoom) of the StartModule target views
+TargetPoses = TargetViewPoses
+
+# Lower is better for these metrics, they are the ones compared to the baseline
+TimingMetrics = ["seconds", "mean", "p50", "p95", "p99", "max"]
+
+
+def Percentiles(samples):
+    # Latency summary in seconds
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return {"count": 0}
+    return {
+        "count": int(samples.size),
+        "mean": float(samples.mean()),
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max()),
+    }
+
+
+def MakeMove(startPose, endPose, steps):
+    # Poses linearly interpolated from startPose to endPose, both included
+    fractions = np.linspace(0.0, 1.0, steps + 1)[:, np.newaxis]
+    startPose = np.asarray(startPose, dtype=np.float64)
+    return startPose + fractions * (np.asarray(endPose, dtype=np.float64) - startPose)
+
+
+def MakeSweep(axis, step=1.0):
+    # Full slider range of one axis, the others at zero
+    start, stop = PoseLimits[axis]
+    poses = np.zeros((int(round((stop - start) / step)) + 1, len(PoseAxes)))
+    poses[:, PoseAxes.index(axis)] = np.linspace(start, stop, len(poses))
+    return poses
+
+
+def BuildTrajectories():
+    trajectories = collections.OrderedDict()
+    trajectories["CSweep"] = MakeSweep("c")
+    trajectories["GantrySweep"] = MakeSweep("gantry")
+    trajectories["WagSweep"] = MakeSweep("wag")
+    trajectories["TableSweep"] = MakeSweep("table", 2.0)
+    trajectories["APToLateral"] = MakeMove(TargetPoses["Full AP"], TargetPoses["Full Lateral"], 90)
+    trajectories["LateralToAP"] = MakeMove(TargetPoses["Full Lateral"], TargetPoses["Full AP"], 90)
+    return trajectories
+
+
+class CarmSimulatorBenchmark:
+    """Runs the benchmarks on a fresh scene with a new logic."""
+
+    def __init__(self, backend="CPU", latencySamples=200, moveSteps=30, seed=0):
+        self.backend = backend
+        self.latencySamples = latencySamples
+        self.moveSteps = moveSteps
+        self.seed = seed
+        self.logic = None
+
+    def Run(self):
+        results = collections.OrderedDict()
+        results["version"] = BenchmarkVersion
+        results["environment"] = self.GetEnvironment()
+        metrics = collections.OrderedDict()
+        metrics["GenerateScene"] = self.BenchmarkGenerateScene()
+        metrics["ToggleDRRFirstRender"] = self.BenchmarkFirstRender()
+        metrics["UpdateDRR"] = self.BenchmarkUpdateDRR()
+        if self.backend == "CPU":
+            metrics["BeamModels"] = self.BenchmarkBeamModels()
+        metrics["Trajectories"] = collections.OrderedDict(
+            (name, self.BenchmarkTrajectory(poses)) for name, poses in BuildTrajectories().items())
+        metrics["StartModuleProtocol"] = self.BenchmarkStartModule()
+        results["metrics"] = metrics
+        self.logic.cleanup()
+        return results
+
+    def GetEnvironment(self):
+        return {
+            "slicer": slicer.app.applicationVersion,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpuCount": os.cpu_count(),
+            "backend": self.backend,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def BenchmarkGenerateScene(self):
+        slicer.mrmlScene.Clear(0)
+        self.logic = CarmSimulatorLogic()
+        startTime = time.perf_counter()
+        self.logic.GenerateScene(True)
+        seconds = time.perf_counter() - startTime
+        return {"seconds": seconds, "stages": dict(self.logic.scene.loadTimings)}
+
+    def BenchmarkFirstRender(self):
+        # Synchronous rendering so every measured call includes the DRR itself
+        self.logic.drrAsync = False
+        self.logic.drrProgressive = False
+        self.logic.drrBackend = self.backend
+        startTime = time.perf_counter()
+        self.logic.ToggleDRR(True)
+        return {"seconds": time.perf_counter() - startTime}
+
+    def BenchmarkUpdateDRR(self):
+        # Random poses over the slider ranges, so every render misses the cache
+        generator = np.random.default_rng(self.seed)
+        low = np.array([PoseLimits[axis][0] for axis in PoseAxes])
+        high = np.array([PoseLimits[axis][1] for axis in PoseAxes])
+        poses = generator.uniform(low, high, size=(self.latencySamples, len(PoseAxes)))
+
+        latency = collections.OrderedDict()
+        levels = [0]
+        if self.backend == "CPU":
+            levels = range(self.logic.drrEngine.numberOfLevels)
+        for level in levels:
+            samples = []
+            if self.backend == "CPU":
+                self.logic.drrEngine.ResetSkippingStatistics()
+            for pose in poses:
+                self.SetPoseValues(pose)
+                startTime = time.perf_counter()
+                self.logic.UpdateDRR(level)
+                samples.append(time.perf_counter() - startTime)
+            latency["level%d" % level] = Percentiles(samples)
+            if self.backend == "CPU":
+                # Samples saved by cropping and empty space skipping
+                latency["level%d" % level]["skippedFraction"] = \
+                    self.logic.GetDRRSkippingStatistics()["skippedFraction"]
+
+        # Revisiting the last pose is a cache hit
+        samples = []
+        for index in range(self.latencySamples):
+            startTime = time.perf_counter()
+            self.logic.UpdateDRR()
+            samples.append(time.perf_counter() - startTime)
+        latency["cached"] = Percentiles(samples)
+        return latency
+
+    def BenchmarkBeamModels(self, kVps=(80.0,), levels=(0, 1)):
+        # Same random poses with the opacity transfer function and each polychromatic beam
+        generator = np.random.default_rng(self.seed)
+        low = np.array([PoseLimits[axis][0] for axis in PoseAxes])
+        high = np.array([PoseLimits[axis][1] for axis in PoseAxes])
+        poses = generator.uniform(low, high, size=(self.latencySamples, len(PoseAxes)))
+
+        results = collections.OrderedDict()
+        for kVp in (None,) + tuple(kVps):
+            self.logic.SetDRRBeam(kVp)
+            self.logic.UpdateDRREngineVolume()
+            self.logic.drrCache.Invalidate()
+            latency = collections.OrderedDict()
+            for level in levels:
+                samples = []
+                for pose in poses:
+                    self.SetPoseValues(pose)
+                    startTime = time.perf_counter()
+                    self.logic.UpdateDRR(level)
+                    samples.append(time.perf_counter() - startTime)
+                latency["level%d" % level] = Percentiles(samples)
+            results["TransferFunction" if kVp is None else "%gkVp" % kVp] = latency
+        self.logic.SetDRRBeam(None)
+
+        # Cost of the polychromatic path relative to the transfer function
+        reference = results["TransferFunction"]
+        for name, latency in results.items():
+            for level in latency:
+                latency[level]["relativeToTransferFunction"] = latency[level]["p50"] / reference[level]["p50"]
+        return results
+
+    def SetPoseValues(self, pose):
+        self.logic.core.SetPose(pose)
+
+    def ApplyPose(self, pose):
+        # Same path as a replay: transforms are updated and the scheduled DRR is flushed
+        self.logic.SetPose(pose)
+        self.logic.drrScheduler.Flush()
+
+    def BenchmarkTrajectory(self, poses):
+        self.logic.drrCache.Invalidate()
+        samples = []
+        startTime = time.perf_counter()
+        for pose in poses:
+            frameStartTime = time.perf_counter()
+            self.ApplyPose(pose)
+            samples.append(time.perf_counter() - frameStartTime)
+        seconds = time.perf_counter() - startTime
+        return {
+            "frames": len(poses),
+            "seconds": seconds,
+            "framesPerSecond": len(poses) / seconds if seconds > 0 else 0.0,
+            "frameTime": Percentiles(samples),
+        }
+
+    def BenchmarkStartModule(self):
+        # The nine shot protocol: switch to the training case, then move to each target and collect it
+        logic = self.logic
+        startTime = time.perf_counter()
+        try:
+            logic.StartModule(True)
+        except Exception as error:
+            return {"skipped": "StartModule failed: " + str(error)}
+        startModuleSeconds = time.perf_counter() - startTime
+        logic.ToggleDRR(True)
+
+        samples = []
+        pose = logic.GetPose()
+        targets = [logic.currentImageLabel] + logic.imagesRemaining[::-1]
+        protocolStartTime = time.perf_counter()
+        for label in targets:
+            for nextPose in MakeMove(pose, TargetPoses[label], self.moveSteps)[1:]:
+                frameStartTime = time.perf_counter()
+                self.ApplyPose(nextPose)
+                samples.append(time.perf_counter() - frameStartTime)
+            pose = TargetPoses[label]
+            logic.CollectImage(True)
+        protocolSeconds = time.perf_counter() - protocolStartTime
+        return {
+            "startModule": {"seconds": startModuleSeconds},
+            "shots": len(targets),
+            "frames": len(samples),
+            "seconds": protocolSeconds,
+            "frameTime": Percentiles(samples),
+        }
+
+
+def FlattenMetrics(metrics, prefix=""):
+    # {"a": {"b": 1}} -> {"a/b": 1}, numeric leaves only
+    flat = collections.OrderedDict()
+    for name, value in metrics.items():
+        key = prefix + name
+        if isinstance(value, dict):
+            flat.update(FlattenMetrics(value, key + "/"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[key] = value
+    return flat
+
+
+def CompareToBaseline(results, baseline, tolerance=0.1):
+    """Ratio of every timing metric to the baseline.
+
+    A metric regressed when it is more than tolerance (fraction) slower.
+    """
+    current = FlattenMetrics(results["metrics"])
+    reference = FlattenMetrics(baseline["metrics"])
+    comparison = collections.OrderedDict()
+    for key, value in current.items():
+        if key.rsplit("/", 1)[-1] not in TimingMetrics or key not in reference:
+            continue
+        if reference[key] <= 0:
+            continue
+        ratio = value / reference[key]
+        comparison[key] = {
+            "baseline": reference[key],
+            "current": value,
+            "ratio": ratio,
+            "regression": ratio > 1.0 + tolerance,
+        }
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the C-arm simulator without the Slicer GUI.")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown before a regression (default: 0.1)")
+    parser.add_argument("--backend", default="CPU", choices=["CPU", "VTK"],
+                        help="DRR backend, VTK needs a 3D view (default: CPU)")
+    parser.add_argument("--samples", type=int, default=200, help="Poses used for the UpdateDRR latency")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    benchmark = CarmSimulatorBenchmark(args.backend, args.samples, seed=args.seed)
+    results = benchmark.Run()
+
+    returnCode = 0
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        results["comparison"] = CompareToBaseline(results, baseline, args.tolerance)
+        regressions = [key for key, entry in results["comparison"].items() if entry["regression"]]
+        for key in regressions:
+            entry = results["comparison"][key]
+            print("Regression %s: %.2f ms -> %.2f ms (x%.2f)" %
+                  (key, entry["baseline"] * 1000.0, entry["current"] * 1000.0, entry["ratio"]))
+        if regressions:
+            returnCode = 1
+
+    text = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return returnCode
+
+
+if __name__ == "__main__":
+    slicer.util.exit(main(sys.argv[1:]))
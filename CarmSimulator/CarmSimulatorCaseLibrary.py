@@ -0,0 +1,183 @@
+import concurrent.futures
+import time
+
+from CarmSimulatorAttenuationCache import ReadAttenuationVolume
+from CarmSimulatorVolumeIO import ReadMetaImage
+
+#
+# CT Case Library
+#
+# Keeps decoded CT cases resident up to a memory budget so switching the
+# training case is a swap of the active volume node instead of a reload.
+# Cases are decoded on a background thread; their MRML nodes are created on the
+# main thread by Poll() or Activate() through createNodeCallback.
+#
+
+
+class CarmSimulatorCase:
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.node = None
+        # Scalars of the node's image data, not a copy of them
+        self.voxels = None
+        self.ijkToRAS = None
+        self.attenuation = None
+        self.attenuationScale = 1.0
+        # Pyramid of the CPU DRR engine, built the first time the case is shown
+        self.drrLevels = None
+        self.future = None
+        self.loadTime = 0.0
+        self.nodeTime = 0.0
+        self.lastUsed = 0.0
+
+    def GetMemoryBytes(self):
+        if self.voxels is None:
+            return 0
+        attenuationBytes = self.attenuation.nbytes if self.attenuation is not None else 0
+        if self.drrLevels is not None:
+            attenuationBytes += sum(level[0].nbytes for level in self.drrLevels[0])
+        return self.voxels.nbytes + attenuationBytes
+
+    def IsResident(self):
+        return self.node is not None
+
+
+def LoadCase(path, opacityPoints):
+    # Runs on the library thread: decode the volume and load or bake its CPU DRR attenuation
+    startTime = time.perf_counter()
+    voxels, ijkToRAS = ReadMetaImage(path)
+    attenuation, scale = ReadAttenuationVolume(path, opacityPoints, voxels, ijkToRAS)[:2]
+    return voxels, ijkToRAS, (attenuation, scale), time.perf_counter() - startTime
+
+
+class CarmSimulatorCaseLibrary:
+    """Resident CT cases with background prefetch and least recently used eviction.
+
+    createNodeCallback(name, voxels, ijkToRAS) returns the volume node of a case
+    and the array of the node's own scalars, the decoded voxels are dropped once
+    the node has them. removeNodeCallback(node) is called when a case is evicted.
+    """
+
+    def __init__(self, opacityPoints, createNodeCallback, removeNodeCallback, maximumBytes=1024 * 1024 * 1024):
+        self.opacityPoints = opacityPoints
+        self.createNodeCallback = createNodeCallback
+        self.removeNodeCallback = removeNodeCallback
+        self.maximumBytes = maximumBytes
+        self.cases = {}
+        self.activeName = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.evictions = 0
+
+    def AddCase(self, name, path):
+        if name not in self.cases:
+            self.cases[name] = CarmSimulatorCase(name, path)
+
+    def AdoptCase(self, name, node, voxels, ijkToRAS):
+        # Register a volume that was loaded outside the library, e.g. by GenerateScene; voxels are the node's scalars
+        case = self.cases.setdefault(name, CarmSimulatorCase(name, None))
+        case.node = node
+        case.voxels = voxels
+        case.ijkToRAS = ijkToRAS
+        case.lastUsed = time.perf_counter()
+
+    def FindCaseByNode(self, node):
+        for case in self.cases.values():
+            if case.node is node:
+                return case
+        return None
+
+    def Prefetch(self, name):
+        # Start decoding a case on the library thread, returns immediately
+        case = self.cases[name]
+        if case.IsResident() or case.future is not None or case.path is None:
+            return
+        case.future = self.executor.submit(LoadCase, case.path, self.opacityPoints)
+
+    def IsLoading(self):
+        return any(case.future is not None for case in self.cases.values())
+
+    def Poll(self):
+        # Main thread: create the nodes of finished prefetches, returns their names
+        finished = []
+        for case in self.cases.values():
+            if case.future is not None and case.future.done():
+                self.FinishLoad(case)
+                finished.append(case.name)
+        if finished:
+            self.EvictToSize()
+        return finished
+
+    def FinishLoad(self, case):
+        voxels, ijkToRAS, (attenuation, attenuationScale), case.loadTime = case.future.result()
+        case.future = None
+        startTime = time.perf_counter()
+        # The node copies the voxels, only its copy is kept
+        case.node, case.voxels = self.createNodeCallback(case.name, voxels, ijkToRAS)
+        case.nodeTime = time.perf_counter() - startTime
+        case.ijkToRAS = ijkToRAS
+        case.attenuation = attenuation
+        case.attenuationScale = attenuationScale
+        case.lastUsed = time.perf_counter()
+
+    def Activate(self, name):
+        # Make name the active case, loading it now if it was not prefetched
+        case = self.cases[name]
+        if not case.IsResident():
+            self.Prefetch(name)
+            case.future.result()
+            self.FinishLoad(case)
+        self.activeName = name
+        case.lastUsed = time.perf_counter()
+        self.EvictToSize()
+        return case
+
+    def GetMemoryBytes(self):
+        return sum(case.GetMemoryBytes() for case in self.cases.values())
+
+    def EvictToSize(self):
+        # Drop least recently used cases, never the active one
+        candidates = sorted((case for case in self.cases.values() if case.IsResident() and case.name != self.activeName),
+                            key=lambda case: case.lastUsed)
+        while self.GetMemoryBytes() > self.maximumBytes and candidates:
+            self.Evict(candidates.pop(0))
+
+    def Evict(self, case):
+        if case.path is None:
+            # Adopted cases cannot be reloaded by the library
+            return
+        self.removeNodeCallback(case.node)
+        case.node = None
+        case.voxels = None
+        case.ijkToRAS = None
+        case.attenuation = None
+        case.drrLevels = None
+        self.evictions += 1
+
+    def SetMaximumBytes(self, maximumBytes):
+        self.maximumBytes = maximumBytes
+        self.EvictToSize()
+
+    def GetStatistics(self):
+        # Load time and memory of every case
+        cases = {}
+        for name, case in self.cases.items():
+            cases[name] = {
+                "resident": case.IsResident(),
+                "loading": case.future is not None,
+                "loadTime": case.loadTime,
+                "nodeTime": case.nodeTime,
+                "memoryBytes": case.GetMemoryBytes(),
+            }
+        return {
+            "cases": cases,
+            "active": self.activeName,
+            "memoryBytes": self.GetMemoryBytes(),
+            "maximumBytes": self.maximumBytes,
+            "evictions": self.evictions,
+        }
+
+    def Shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,62 @@
+import collections
+import math
+import numpy as np
+
+#
+# Collimation
+#
+# The iris collimator leaves a circular field in the middle of the detector,
+# everything outside it is black on the monitor. Its radius follows the field of
+# view slider as the FieldOfViewMedium.png overlay used to: a hole of 65 pixels
+# in the 1500 pixel image, seen by a camera at 700 - 10 * field of view with a
+# 30 degree view angle. Masks are built once per radius and detector grid.
+#
+
+FieldOfViewHoleRadius = 65.0
+
+
+def CollimationRadius(fieldOfView):
+    # Radius of the open field at a field of view slider value, in detector half heights
+    visibleHalfHeight = math.tan(math.radians(15.0)) * max(700.0 - fieldOfView * 10.0, 1e-6)
+    return FieldOfViewHoleRadius / visibleHalfHeight
+
+
+class CarmSimulatorCollimationMasks:
+    """Open detector pixels of a circular collimator, cached per radius and ray grid.
+
+    With step > 1 the mask is over the grid of one ray per step x step block of
+    pixels, as rendered by the coarse pyramid levels; a block is open when any of
+    it is.
+    """
+
+    def __init__(self, width, height, maximumEntries=32):
+        self.width = width
+        self.height = height
+        self.maximumEntries = maximumEntries
+        self.entries = collections.OrderedDict()
+
+    def Get(self, radius, step=1):
+        # (mask, open ray indices, closed ray indices) of the grid, mask shaped (rows, columns)
+        key = (round(radius, 4), step)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+
+        # Pixel distances from the detector center in half heights, as in CarmSimulatorDRREngine.ComputeRays
+        halfHeight = self.height * 0.5
+        columns = np.arange(0, self.width, step) + step * 0.5 - self.width * 0.5
+        rows = np.arange(0, self.height, step) + step * 0.5 - halfHeight
+        distance = np.hypot(columns[np.newaxis, :], rows[:, np.newaxis]) / halfHeight
+        reach = (step * math.sqrt(0.5) if step > 1 else 0.0) / halfHeight
+        mask = distance <= radius + reach
+
+        entry = (mask, np.flatnonzero(mask), np.flatnonzero(~mask))
+        self.entries[key] = entry
+        if len(self.entries) > self.maximumEntries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def GetOpenFraction(self, radius):
+        mask, openRays, closedRays = self.Get(radius)
+        return len(openRays) / float(mask.size)
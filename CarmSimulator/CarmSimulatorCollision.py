@@ -0,0 +1,228 @@
+import time
+import numpy as np
+
+from CarmSimulatorKinematics import ComputeModelMatrices
+
+#
+# Collision Detection
+#
+# Every model gets a bounding volume hierarchy of axis aligned boxes in its own
+# coordinates, built once. A query only needs the relative pose of two models:
+# both trees are descended together, testing all candidate box pairs of a level
+# at once with the separating axis test for oriented boxes. The trees have four
+# children per node to keep the number of levels, and so of NumPy passes, low.
+# Leaves hold a few triangles, so contacts are resolved to the size of a leaf box.
+#
+
+# Scene transforms driven by the pose, by their key in ComputeModelMatrices
+PoseTransforms = {
+    "CTransform": "C",
+    "GantryTransform": "Gantry",
+    "WagTransform": "Wag",
+    "TableZTranslation": "Table",
+}
+
+# Scene models checked against each other
+CollisionPairs = [
+    ("C", "Stanless steel table"),
+    ("C", "HumanMesh"),
+    ("GantryV3", "Stanless steel table"),
+    ("GantryV3", "HumanMesh"),
+]
+
+
+class CarmSimulatorBVH:
+    """Four-way bounding box tree over the triangles of a mesh.
+
+    boxes[n] holds the center and half size of node n, children[n] its children.
+    The last node is an empty box that overlaps nothing; it pads the children of
+    nodes with fewer than four, and a leaf's children are itself and the empty box,
+    so descending never needs to look at which nodes are leaves.
+    """
+
+    def __init__(self, points, triangles, leafSize=4):
+        vertices = np.asarray(points, dtype=np.float64)[np.asarray(triangles)]
+        self.triangleCount = len(vertices)
+        triangleMin = vertices.min(axis=1)
+        triangleMax = vertices.max(axis=1)
+        triangleCenters = vertices.mean(axis=1)
+
+        boxes = []
+        children = []
+
+        def Split(indices):
+            # Halves at the median of the triangle centers along the longest axis
+            low = triangleMin[indices].min(axis=0)
+            high = triangleMax[indices].max(axis=0)
+            axis = int(np.argmax(high - low))
+            half = len(indices) // 2
+            order = np.argpartition(triangleCenters[indices, axis], half)
+            return [indices[order[:half]], indices[order[half:]]]
+
+        def Build(indices):
+            node = len(boxes)
+            low = triangleMin[indices].min(axis=0)
+            high = triangleMax[indices].max(axis=0)
+            boxes.append(np.concatenate(((low + high) * 0.5, (high - low) * 0.5)))
+            children.append(None)
+            if len(indices) <= leafSize:
+                return node
+            groups = []
+            for half in Split(indices):
+                groups.extend(Split(half) if len(half) > leafSize else [half])
+            children[node] = [Build(group) for group in groups]
+            return node
+
+        Build(np.arange(self.triangleCount))
+        empty = len(boxes)
+        self.boxes = np.array(boxes + [np.concatenate((np.zeros(3), np.full(3, -1e30)))])
+        self.children = np.full((empty + 1, 4), empty, dtype=np.intp)
+        self.isLeaf = np.ones(empty + 1, dtype=bool)
+        for node, nodeChildren in enumerate(children):
+            if nodeChildren is None:
+                self.children[node, 0] = node
+            else:
+                self.children[node, :len(nodeChildren)] = nodeChildren
+                self.isLeaf[node] = False
+
+    def GetNodeCount(self):
+        return len(self.boxes) - 1
+
+
+def BoxesOverlap(rotation, translation, boxesA, boxesB, crossAxes=True):
+    """Separating axis test of box pairs, given as (center, half size) rows.
+
+    Boxes of B are in B's coordinates, rotation and translation map them to A's.
+    Returns a bool per pair. Without crossAxes only the face axes are tested,
+    which is cheaper and never misses an overlap but may not see a separation.
+    """
+    t = boxesB[:, :3].dot(rotation.T) + translation - boxesA[:, :3]
+    absolute = np.abs(rotation) + 1e-9
+    a = boxesA[:, 3:]
+    b = boxesB[:, 3:]
+
+    # Axes of A and of B
+    overlap = (np.abs(t) <= a + b.dot(absolute.T)).all(axis=1)
+    overlap &= (np.abs(t.dot(rotation)) <= a.dot(absolute) + b).all(axis=1)
+    if not crossAxes:
+        return overlap
+
+    # Cross products of the axes of A and B
+    for i in range(3):
+        i1 = (i + 1) % 3
+        i2 = (i + 2) % 3
+        for j in range(3):
+            j1 = (j + 1) % 3
+            j2 = (j + 2) % 3
+            distance = np.abs(t[:, i2] * rotation[i1, j] - t[:, i1] * rotation[i2, j])
+            radius = (a[:, i1] * absolute[i2, j] + a[:, i2] * absolute[i1, j] +
+                      b[:, j1] * absolute[i, j2] + b[:, j2] * absolute[i, j1])
+            overlap &= distance <= radius
+    return overlap
+
+
+def TreesIntersect(treeA, treeB, bToA, batchSize=512):
+    """True when a leaf box of A overlaps a leaf box of B, bToA maps B's coordinates to A's.
+
+    Candidate pairs are processed depth first in batches, so a contact is found
+    without expanding every overlapping pair of the levels above it.
+    """
+    rotation = bToA[:3, :3]
+    translation = bToA[:3, 3]
+    stack = [(np.zeros(1, dtype=np.intp), np.zeros(1, dtype=np.intp))]
+    while stack:
+        nodesA, nodesB = stack.pop()
+        if len(nodesA) > batchSize:
+            stack.append((nodesA[batchSize:], nodesB[batchSize:]))
+            nodesA = nodesA[:batchSize]
+            nodesB = nodesB[:batchSize]
+        overlap = BoxesOverlap(rotation, translation, treeA.boxes[nodesA], treeB.boxes[nodesB], crossAxes=False)
+        nodesA = nodesA[overlap]
+        nodesB = nodesB[overlap]
+
+        # Only pairs of leaves get the full test
+        leaves = treeA.isLeaf[nodesA] & treeB.isLeaf[nodesB]
+        if leaves.any():
+            if BoxesOverlap(rotation, translation, treeA.boxes[nodesA[leaves]], treeB.boxes[nodesB[leaves]]).any():
+                return True
+            nodesA = nodesA[~leaves]
+            nodesB = nodesB[~leaves]
+        if len(nodesA):
+            stack.append((np.repeat(treeA.children[nodesA], 4, axis=1).ravel(),
+                          np.tile(treeB.children[nodesB], (1, 4)).ravel()))
+    return False
+
+
+class CarmSimulatorCollisionChecker:
+    """Checks C-arm poses for collisions between scene models.
+
+    models maps a model name to (points, triangles) in the model's coordinates,
+    chains maps it to the names of its transforms from its parent up to the root,
+    and staticMatrices holds the to-parent matrix of every transform not driven
+    by the pose.
+    """
+
+    def __init__(self, models, chains, staticMatrices, pairs=None, historyLength=1000):
+        self.chains = chains
+        self.staticMatrices = staticMatrices
+        self.pairs = [pair for pair in (pairs or CollisionPairs) if pair[0] in models and pair[1] in models]
+        self.trees = {}
+        startTime = time.perf_counter()
+        for name in set(name for pair in self.pairs for name in pair):
+            points, triangles = models[name]
+            self.trees[name] = CarmSimulatorBVH(points, triangles)
+        self.buildTime = time.perf_counter() - startTime
+
+        # Query times in seconds, the last historyLength of them
+        self.queryTimes = np.zeros(historyLength)
+        self.queryCount = 0
+        self.collisionCount = 0
+
+    def ComputeWorldMatrices(self, pose):
+        poseMatrices = ComputeModelMatrices(pose)
+        worldMatrices = {}
+        for name in self.trees:
+            matrix = np.eye(4)
+            for transformName in self.chains[name]:
+                if transformName in PoseTransforms:
+                    parentMatrix = poseMatrices[PoseTransforms[transformName]]
+                else:
+                    parentMatrix = self.staticMatrices[transformName]
+                matrix = parentMatrix.dot(matrix)
+            worldMatrices[name] = matrix
+        return worldMatrices
+
+    def Check(self, pose, stopAtFirst=False):
+        # Names of the colliding model pairs at pose (C, gantry, wag, table, zoom)
+        startTime = time.perf_counter()
+        worldMatrices = self.ComputeWorldMatrices(pose)
+        collisions = []
+        for nameA, nameB in self.pairs:
+            bToA = np.linalg.solve(worldMatrices[nameA], worldMatrices[nameB])
+            if TreesIntersect(self.trees[nameA], self.trees[nameB], bToA):
+                collisions.append((nameA, nameB))
+                if stopAtFirst:
+                    break
+        self.queryTimes[self.queryCount % len(self.queryTimes)] = time.perf_counter() - startTime
+        self.queryCount += 1
+        if collisions:
+            self.collisionCount += 1
+        return collisions
+
+    def GetStatistics(self):
+        # Query times in milliseconds over the recent history
+        times = self.queryTimes[:min(self.queryCount, len(self.queryTimes))] * 1000.0
+        statistics = {
+            "queries": self.queryCount,
+            "collisions": self.collisionCount,
+            "buildTime": self.buildTime * 1000.0,
+            "nodes": dict((name, tree.GetNodeCount()) for name, tree in self.trees.items()),
+        }
+        if len(times):
+            statistics.update({
+                "mean": float(times.mean()),
+                "p50": float(np.percentile(times, 50)),
+                "p99": float(np.percentile(times, 99)),
+                "max": float(times.max()),
+            })
+        return statistics
@@ -0,0 +1,170 @@
+import os
+
+from CarmSimulatorDRR import CarmSimulatorDRREngine, ReadVolumeProperty
+from CarmSimulatorAttenuationCache import BakeAttenuation, ReadAttenuationVolume
+from CarmSimulatorVolumeIO import ReadMetaImage
+from CarmSimulatorSpectrum import CarmSimulatorPolychromaticBeam
+from CarmSimulatorCollimation import CollimationRadius
+from CarmSimulatorKinematics import ComputeModelMatrices, ComputeDRRCameras
+
+#
+# Headless Simulator Core
+#
+# The C-arm pose, the CT volume and the DRR the monitor shows, with nothing but
+# NumPy underneath: no Slicer, Qt or VTK import, so tests, batch jobs and servers
+# start in a fraction of a second. CarmSimulatorLogic keeps one of these and adds
+# the MRML scene, the VR views and the timers that drive them.
+#
+
+# CT volumes in Resources, as <name>.mha
+LumbarSpineVolumeName = "LumbarSpinePhantom_CT"
+ScoliosisVolumeName = "LumbarSpineScoliosis_CT"
+
+
+class CarmSimulatorCore:
+    """Pose, volume and DRR state of one simulated C-arm.
+
+    Pose values are in CarmSimulatorKinematics order (C, gantry, wag, table,
+    zoom). Volumes are identified by an id chosen by the caller (the volume node
+    ID in Slicer, the file name otherwise), so callers can tell whether the
+    engine holds the volume they are showing.
+    """
+
+    def __init__(self, resourcePath=None, width=530, height=335, numberOfThreads=None):
+        self.resourcePath = resourcePath or os.path.dirname(os.path.abspath(__file__))
+
+        # Pose of the C-arm and field of view slider value
+        self.zRotationValue = 0.0
+        self.xRotationValue = 0.0
+        self.yRotationValue = 0.0
+        self.tableTranslationValue = 0.0
+        self.zoomFactor = 0.0
+        self.fieldOfViewValue = 0.0
+
+        self.opacityPoints, colorPoints = ReadVolumeProperty(self.GetResourceFile('VolumeProperty.vp'))
+        self.drrEngine = CarmSimulatorDRREngine(width, height, numberOfThreads=numberOfThreads)
+        self.drrEngine.SetCollimation(CollimationRadius(self.fieldOfViewValue))
+
+        # Polychromatic beam of the engine, None renders with the opacity transfer function
+        self.beam = None
+
+        # Id of the volume in the engine, None when there is none or it has to be set again
+        self.volumeId = None
+        # .mha file of a volume loaded with LoadVolume, reloaded when the beam needs the CT again
+        self.volumePath = None
+
+    def GetResourceFile(self, fileName):
+        return os.path.join(self.resourcePath, 'Resources', fileName)
+
+    def GetPose(self):
+        # Pose in CarmSimulatorKinematics order: C, gantry, wag, table, zoom
+        return [self.zRotationValue, self.xRotationValue, self.yRotationValue,
+                self.tableTranslationValue, self.zoomFactor]
+
+    def GetPoseWith(self, index, value):
+        pose = self.GetPose()
+        pose[index] = value
+        return pose
+
+    def SetPose(self, pose):
+        self.zRotationValue, self.xRotationValue, self.yRotationValue, \
+            self.tableTranslationValue, self.zoomFactor = [float(value) for value in pose]
+
+    def GetModelMatrices(self):
+        # Matrices to parent of the C, gantry, wag and table transforms
+        return ComputeModelMatrices(self.GetPose())
+
+    def GetDRRCamera(self):
+        # (position, focal point, view up) of the DRR camera
+        return ComputeDRRCameras(self.GetPose())
+
+    def SetFieldOfView(self, value):
+        # Masks are cached per field of view, the engine only traces the rays inside the field
+        self.fieldOfViewValue = value
+        self.drrEngine.SetCollimation(CollimationRadius(value))
+
+    def SetBeam(self, kVp):
+        # Polychromatic X-ray beam at kVp, or None for the opacity transfer function
+        beam = CarmSimulatorPolychromaticBeam(kVp) if kVp is not None else None
+        if beam is not None and self.beam is not None:
+            # Same material volume, only the spectrum lookup changes
+            self.drrEngine.SetBeam(beam)
+            self.beam = beam
+            return
+        self.beam = beam
+        self.volumeId = None
+        if self.volumePath is not None:
+            self.LoadVolume(self.volumePath)
+
+    def GetBeamKVp(self):
+        return self.beam.kVp if self.beam is not None else None
+
+    def SetVolume(self, volumeId, scalars, ijkToRAS, volumePath=None):
+        """Sets a CT (scalars indexed [k, j, i]) as the engine's volume.
+
+        Without a beam the attenuation is baked, through the cache beside
+        volumePath when the CT was read from that .mha, and (attenuation, scale)
+        is returned so callers can keep it. With a beam None is returned.
+        """
+        baked = None
+        if self.beam is not None:
+            # Material volumes are not cached, they are rebuilt from the CT
+            self.drrEngine.SetVolume(scalars, ijkToRAS, self.opacityPoints, self.beam)
+        else:
+            if volumePath is not None and os.path.exists(volumePath):
+                attenuation, scale, fileIJKToRAS = ReadAttenuationVolume(volumePath, self.opacityPoints,
+                                                                          scalars, ijkToRAS)
+            else:
+                attenuation, scale = BakeAttenuation(scalars, self.opacityPoints)
+            self.drrEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+            baked = (attenuation, scale)
+        self.volumeId = volumeId
+        self.volumePath = None
+        return baked
+
+    def SetAttenuationVolume(self, volumeId, attenuation, ijkToRAS, scale=1.0):
+        # Baked volume kept by the caller, e.g. a case library entry
+        self.drrEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+        self.volumeId = volumeId
+        self.volumePath = None
+
+    def GetAttenuationLevels(self):
+        # Pyramid the engine built for the current attenuation volume
+        return self.drrEngine.GetLevels()
+
+    def SetAttenuationLevels(self, volumeId, levels):
+        # Pyramid from GetAttenuationLevels kept by the caller, nothing is cropped or downsampled again
+        self.drrEngine.SetLevels(levels)
+        self.volumeId = volumeId
+        self.volumePath = None
+
+    def LoadVolume(self, path, volumeId=None):
+        # .mha file, or the name of a volume in Resources; only the baked cache is read when it is current
+        if not os.path.splitext(path)[1]:
+            path = self.GetResourceFile(path + '.mha')
+        if volumeId is None:
+            volumeId = os.path.splitext(os.path.basename(path))[0]
+        if self.beam is not None:
+            scalars, ijkToRAS = ReadMetaImage(path)
+            self.drrEngine.SetVolume(scalars, ijkToRAS, self.opacityPoints, self.beam)
+        else:
+            attenuation, scale, ijkToRAS = ReadAttenuationVolume(path, self.opacityPoints)
+            self.drrEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+        self.volumeId = volumeId
+        self.volumePath = path
+
+    def InvalidateVolume(self, volumeId=None):
+        # The volume has to be set again before the next DRR, volumeId limits it to that volume
+        if volumeId is None or volumeId == self.volumeId:
+            self.volumeId = None
+
+    def HasVolume(self):
+        return self.volumeId is not None and self.drrEngine.HasVolume()
+
+    def RenderDRR(self, pose=None, out=None, level=0):
+        # RGB uint8 DRR of the current pose, or of pose without changing the current one
+        position, focalPoint, viewUp = ComputeDRRCameras(self.GetPose() if pose is None else pose)
+        return self.drrEngine.Render(position, focalPoint, viewUp, out=out, level=level)
+
+    def Shutdown(self):
+        self.drrEngine.Shutdown()
@@ -0,0 +1,495 @@
+import math
+import os
+import concurrent.futures
+import threading
+import numpy as np
+
+from CarmSimulatorSpectrum import MaterialVolume
+from CarmSimulatorCollimation import CarmSimulatorCollimationMasks
+
+#
+# CPU DRR Engine
+#
+
+# Edge of the blocks of the empty space occupancy grids, in voxels of their pyramid level
+OccupancyBlockSize = 8
+
+
+def ReadVolumeProperty(path):
+    # Parse a Slicer .vp file and return the scalar opacity (HU, opacity) and
+    # color (HU, r, g, b) transfer function points
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip()]
+    opacity = np.array([float(v) for v in lines[6][1:]]).reshape(-1, 2)
+    color = np.array([float(v) for v in lines[8][1:]]).reshape(-1, 4)
+    return opacity, color
+
+
+def OpacityToAttenuation(scalars, opacityPoints, unitDistance=1.0):
+    # Convert HU to an attenuation coefficient (per mm) so that compositing
+    # absorption matches the VTK ray caster: transmittance (1 - opacity) per unit distance
+    opacity = np.interp(scalars, opacityPoints[:, 0], opacityPoints[:, 1])
+    opacity = np.clip(opacity, 0.0, 0.999)
+    return (-np.log1p(-opacity) / unitDistance).astype(np.float32)
+
+
+def DownsampleVolume(attenuation, ijkToRAS):
+    # Halve every dimension by averaging 2x2x2 blocks, odd dimensions are padded by edge replication
+    pad = [(0, size % 2) for size in attenuation.shape]
+    if any(after for before, after in pad):
+        attenuation = np.pad(attenuation, pad, mode='edge')
+    k, j, i = [size // 2 for size in attenuation.shape]
+    if attenuation.dtype.kind in "iu":
+        # Baked volumes stay quantized with the same scale
+        coarse = attenuation.reshape(k, 2, j, 2, i, 2).mean(axis=(1, 3, 5), dtype=np.float32)
+        coarse = np.rint(coarse).astype(attenuation.dtype)
+    else:
+        coarse = attenuation.reshape(k, 2, j, 2, i, 2).mean(axis=(1, 3, 5), dtype=attenuation.dtype)
+
+    # Coarse voxel n is centered between fine voxels 2n and 2n + 1
+    scale = np.diag([2.0, 2.0, 2.0, 1.0])
+    scale[:3, 3] = 0.5
+    return coarse, np.asarray(ijkToRAS, dtype=np.float64).dot(scale)
+
+
+def OccupiedVoxels(attenuation, scale, threshold):
+    # Voxels attenuating more than threshold per mm, water and bone together for a material volume
+    if np.iscomplexobj(attenuation):
+        return (attenuation.real + attenuation.imag) * np.float32(scale) > threshold
+    return attenuation > threshold / scale
+
+
+def CropVolume(attenuation, ijkToRAS, occupied, margin=1, alignment=1):
+    # Smallest box around the occupied voxels, with a margin so interpolation at its edges is unchanged
+    # With margin and alignment one voxel of the pyramid's coarsest level, the downsampled levels match too
+    # Returns the cropped volume, its ijkToRAS and the (k, j, i) index of its first voxel in the original
+    if not occupied.any():
+        return attenuation, ijkToRAS, np.zeros(3, dtype=np.intp)
+    box = []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(occupied.any(axis=others))
+        start = (indices[0] - margin) // alignment * alignment
+        stop = -(-(indices[-1] + margin + 1) // alignment) * alignment
+        box.append(slice(max(start, 0), min(stop, attenuation.shape[axis])))
+    start = np.array([b.start for b in box])
+    shift = np.eye(4)
+    shift[:3, 3] = start[::-1]
+    return np.ascontiguousarray(attenuation[tuple(box)]), np.asarray(ijkToRAS).dot(shift), start
+
+
+def OccupancyGrid(occupied, blockSize=OccupancyBlockSize):
+    """Occupied blocks of blockSize^3 voxels, indexed (k, j, i) like the volume.
+
+    A sample in a block interpolates voxels up to the first voxel of the next
+    block along every axis, so a block is also marked when its neighbours above
+    it are occupied.
+    """
+    pad = [(0, -size % blockSize) for size in occupied.shape]
+    occupied = np.pad(occupied, pad)
+    k, j, i = [size // blockSize for size in occupied.shape]
+    grid = occupied.reshape(k, blockSize, j, blockSize, i, blockSize).any(axis=(1, 3, 5))
+    grid[:-1] |= grid[1:]
+    grid[:, :-1] |= grid[:, 1:]
+    grid[:, :, :-1] |= grid[:, :, 1:]
+    return grid
+
+
+def SkippedFraction(samples, fullSamples):
+    # Fraction of the samples of a full volume trace that were not taken
+    if fullSamples <= 0:
+        return 0.0
+    return float(min(max(1.0 - samples / float(fullSamples), 0.0), 1.0))
+
+
+def SliceRange(start, slope, lower, upper):
+    # Range of slices s where start + slope * s lies within [lower, upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (lower - start) / slope
+        b = (upper - start) / slope
+    sMin = np.minimum(a, b)
+    sMax = np.maximum(a, b)
+    parallel = slope == 0
+    if np.any(parallel):
+        within = (start >= lower) & (start <= upper)
+        sMin[parallel] = np.where(within[parallel], -np.inf, np.inf)
+        sMax[parallel] = np.where(within[parallel], np.inf, -np.inf)
+    return sMin, sMax
+
+
+class CarmSimulatorDRREngine:
+    """Renders DRRs on the CPU by integrating attenuation along perspective rays.
+
+    Rays are traced with Joseph's method: each ray is stepped one slice at a time
+    along its dominant volume axis and the volume is bilinearly interpolated within
+    the slice. All rays of a tile of detector rows are processed together with NumPy
+    and tiles are distributed over a thread pool.
+
+    Level n of the resolution pyramid traces one ray per 2^n x 2^n detector block
+    through the volume downsampled 2^n times, for fast previews while the pose changes.
+
+    With a polychromatic beam the volume holds water and bone densities as the real
+    and imaginary parts of a complex64 volume, so the same interpolation integrates
+    both path lengths; the beam's lookup table turns them into the line integral.
+
+    Only rays inside the collimated field are traced, the rest of the image is black.
+
+    Attenuation volumes can be float32, or baked to uint16 with a scale factor
+    (see CarmSimulatorAttenuationCache), which halves the memory and the bytes
+    gathered per sample.
+
+    Voxels attenuating less than emptyThreshold per mm count as empty space (air
+    and whatever the transfer function hides). Volumes are cropped to the box
+    around the rest when they are set, and every pyramid level gets a coarse grid
+    of occupied blocks: rays are traced a slab of blocks at a time and skip the
+    slabs where all blocks they cross are empty. Skipped voxels change a line
+    integral by at most emptyThreshold per mm of path. GetSkippingStatistics()
+    reports the samples saved relative to tracing the whole uncropped volume.
+    """
+
+    def __init__(self, width=530, height=335, viewAngle=30.0, numberOfThreads=None):
+        # Detector matches the offscreen VTK render window
+        self.width = width
+        self.height = height
+        self.viewAngle = viewAngle
+        self.numberOfThreads = numberOfThreads or os.cpu_count() or 1
+        self.tileHeight = 16
+
+        # Intensity = 255 * exp(-attenuationScale * line integral)
+        self.attenuationScale = 1.0
+
+        # CarmSimulatorPolychromaticBeam of the material volume, if one is set
+        self.beam = None
+
+        # Radius of the collimated field in detector half heights, None leaves the detector open
+        self.collimation = None
+        self.collimationMasks = CarmSimulatorCollimationMasks(width, height)
+
+        self.attenuation = None
+        self.rasToIJK = None
+        self.attenuationVolumeScale = 1.0
+        self.executor = None
+
+        # (attenuation, rasToIJK, scale, occupancy, bounds) per pyramid level, level 0 being full resolution
+        # bounds are the first and last voxel centers of the uncropped volume in the level's (k, j, i) indices
+        self.numberOfLevels = 3
+        self.levels = []
+
+        # Attenuation per mm below which voxels are skipped, None traces every voxel, read by SetAttenuationVolume
+        self.emptyThreshold = 1e-5
+        self.originalShape = None
+        # Frames are counted from the DRR worker thread and from synchronous renders on the main thread
+        self.statisticsLock = threading.Lock()
+        self.ResetSkippingStatistics()
+
+    def SetVolume(self, scalars, ijkToRAS, opacityPoints, beam=None):
+        # scalars is indexed [k, j, i] as returned by slicer.util.arrayFromVolume
+        # Without a beam the opacity transfer function gives a monochromatic attenuation volume
+        if beam is not None:
+            self.SetMaterialVolume(MaterialVolume(scalars), ijkToRAS, beam)
+        else:
+            self.SetAttenuationVolume(OpacityToAttenuation(scalars, opacityPoints), ijkToRAS)
+
+    def SetMaterialVolume(self, materials, ijkToRAS, beam):
+        # The beam is set first and never cleared, so a frame rendered concurrently finds one for a material volume
+        self.beam = beam
+        self.SetAttenuationVolume(materials, ijkToRAS)
+
+    def SetBeam(self, beam):
+        # Another kVp for the current material volume
+        self.beam = beam
+
+    def SetAttenuationVolume(self, attenuation, ijkToRAS, scale=1.0):
+        # Attenuation per mm is attenuation * scale, scale is for baked integer volumes
+        if np.iscomplexobj(attenuation) or attenuation.dtype == np.uint16:
+            attenuation = np.ascontiguousarray(attenuation)
+        else:
+            attenuation = np.ascontiguousarray(attenuation, dtype=np.float32)
+        ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+        threshold = self.emptyThreshold
+        originalShape = attenuation.shape
+        lower = np.zeros(3)
+        if threshold is not None:
+            attenuation, ijkToRAS, start = CropVolume(attenuation, ijkToRAS,
+                                                      OccupiedVoxels(attenuation, scale, threshold),
+                                                      2 ** (self.numberOfLevels - 1), 2 ** (self.numberOfLevels - 1))
+            lower = -start.astype(np.float64)
+        upper = lower + np.array(originalShape) - 1
+
+        levels = []
+        for level in range(self.numberOfLevels):
+            if level > 0:
+                attenuation, ijkToRAS = DownsampleVolume(attenuation, ijkToRAS)
+                # Coarse voxel n is centered on fine index 2n + 0.5
+                lower = (lower - 0.5) / 2.0
+                upper = (upper - 0.5) / 2.0
+            occupancy = None
+            if threshold is not None:
+                occupancy = OccupancyGrid(OccupiedVoxels(attenuation, scale, threshold))
+            levels.append((attenuation, np.linalg.inv(ijkToRAS), scale, occupancy, (lower, upper)))
+        self.levels = levels
+        self.originalShape = originalShape
+        self.attenuation, self.rasToIJK, self.attenuationVolumeScale = levels[0][:3]
+
+    def GetLevels(self):
+        # Cropped pyramid of the current attenuation volume, SetLevels restores it without rebuilding it
+        return self.levels, self.originalShape
+
+    def SetLevels(self, levels):
+        self.levels, self.originalShape = levels
+        self.attenuation, self.rasToIJK, self.attenuationVolumeScale = self.levels[0][:3]
+
+    def SetCollimation(self, radius):
+        self.collimation = radius
+
+    def ApplyCollimation(self, image, radius):
+        # Blacks out the pixels of a full size image outside the field
+        if radius is None:
+            return
+        mask, openRays, closedRays = self.collimationMasks.Get(radius)
+        image.reshape(mask.size, -1)[closedRays] = 0
+
+    def HasVolume(self):
+        return self.attenuation is not None
+
+    def ComputeRays(self, position, focalPoint, viewUp, step=1):
+        # Ray origins and unit directions (world coordinates) for every detector pixel
+        # Row 0 is the bottom of the image, as in vtkWindowToImageFilter output
+        # With step > 1 there is one ray through the center of each step x step block of pixels
+        position = np.asarray(position, dtype=np.float64)
+        direction = np.asarray(focalPoint, dtype=np.float64) - position
+        direction /= np.linalg.norm(direction)
+        right = np.cross(direction, viewUp)
+        right /= np.linalg.norm(right)
+        up = np.cross(right, direction)
+
+        tanHalfAngle = math.tan(math.radians(self.viewAngle) / 2.0)
+        aspect = self.width / float(self.height)
+        columns = np.arange(0, self.width, step) + (step - 1) * 0.5
+        rows = np.arange(0, self.height, step) + (step - 1) * 0.5
+        x = ((columns + 0.5) * 2.0 / self.width - 1.0) * tanHalfAngle * aspect
+        y = ((rows + 0.5) * 2.0 / self.height - 1.0) * tanHalfAngle
+
+        directions = direction + x[np.newaxis, :, np.newaxis] * right + y[:, np.newaxis, np.newaxis] * up
+        directions /= np.linalg.norm(directions, axis=2)[:, :, np.newaxis]
+        return position, directions
+
+    def RenderLineIntegrals(self, position, focalPoint, viewUp, level=0, collimation=None):
+        # Line integral of attenuation (unitless) for every detector pixel, shape (height, width)
+        # At level n the shape is that of the detector divided by 2^n, rounded up
+        # For a material volume they are complex: water and bone path lengths in g/cm2
+        # With a collimation radius, rays outside the field are not traced and left at zero
+        # Hold on to the current volume so a concurrent SetVolume does not mix volumes in one frame
+        levels = self.levels
+        volume, rasToIJK, scale, occupancy, bounds = levels[min(level, len(levels) - 1)]
+        valueType = np.result_type(volume.dtype, np.float32)
+        origin, directions = self.ComputeRays(position, focalPoint, viewUp, 2 ** level)
+        height, width = directions.shape[:2]
+
+        # Move rays into array index space (k, j, i) so they can index the volume directly
+        originIJK = rasToIJK[:3, :3].dot(origin) + rasToIJK[:3, 3]
+        directions = directions.reshape(-1, 3)
+        openRays = None
+        if collimation is not None:
+            mask, openRays, closedRays = self.collimationMasks.Get(collimation, 2 ** level)
+            directions = directions[openRays]
+        directionsIJK = directions.dot(rasToIJK[:3, :3].T)
+        originIndex = originIJK[::-1].astype(np.float32)
+        directionsIndex = directionsIJK[:, ::-1].astype(np.float32)
+
+        # Tiles are runs of traced rays, about tileHeight detector rows when the field is open
+        values = np.zeros(len(directionsIndex), dtype=valueType)
+        tileSize = self.tileHeight * width
+        tiles = [slice(start, min(start + tileSize, values.size))
+                 for start in range(0, values.size, tileSize)]
+
+        def RenderTile(tile):
+            values[tile], samples, fullSamples = self.IntegrateRays(volume, originIndex, directionsIndex[tile],
+                                                                    occupancy, bounds)
+            return samples, fullSamples
+
+        if self.numberOfThreads > 1:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.numberOfThreads)
+            counts = list(self.executor.map(RenderTile, tiles))
+        else:
+            counts = [RenderTile(tile) for tile in tiles]
+        self.CountSamples(*np.sum(counts, axis=0, dtype=np.int64) if counts else (0, 0))
+        if scale != 1.0:
+            values *= np.float32(scale)
+
+        if openRays is None:
+            return values.reshape(height, width)
+        integrals = np.zeros(width * height, dtype=valueType)
+        integrals[openRays] = values
+        return integrals.reshape(height, width)
+
+    def IntegrateRays(self, attenuation, origin, directions, occupancy=None, bounds=None):
+        # Joseph's method for rays sharing an origin, directions given in index space per mm
+        # Returns the integrals, the number of samples taken and the number tracing the uncropped
+        # volume (bounds) without skipping would take
+        volume = attenuation.ravel()
+        shape = attenuation.shape
+        strides = (shape[1] * shape[2], shape[2], 1)
+        valueType = np.result_type(attenuation.dtype, np.float32)
+        result = np.zeros(directions.shape[0], dtype=valueType)
+        dominantAxis = np.argmax(np.abs(directions), axis=1)
+        samples = 0
+        fullSamples = 0
+
+        for axis in range(3):
+            rays = np.nonzero(dominantAxis == axis)[0]
+            if rays.size == 0:
+                continue
+            uAxis, vAxis = [a for a in range(3) if a != axis]
+            d = directions[rays]
+            stepLength = 1.0 / np.abs(d[:, axis])
+
+            # In-plane coordinates are linear in the slice index: u = uStart + uSlope * s
+            uSlope = d[:, uAxis] / d[:, axis]
+            vSlope = d[:, vAxis] / d[:, axis]
+            uStart = origin[uAxis] - origin[axis] * uSlope
+            vStart = origin[vAxis] - origin[axis] * vSlope
+
+            # Only step through slices in front of the source
+            first = 0
+            last = shape[axis] - 1
+            forward = d[:, axis] > 0
+            mixed = False
+            if np.all(forward):
+                first = max(first, int(math.ceil(origin[axis])))
+            elif not np.any(forward):
+                last = min(last, int(math.floor(origin[axis])))
+            else:
+                mixed = True
+
+            if bounds is not None:
+                fullSamples += self.CountRaySamples(origin, axis, uAxis, vAxis, forward, uStart, uSlope,
+                                                    vStart, vSlope, bounds)
+
+            accumulated = np.zeros(rays.size, dtype=valueType)
+            uMax = shape[uAxis] - 1
+            vMax = shape[vAxis] - 1
+            uOffset = strides[uAxis] if uMax > 0 else 0
+            vOffset = strides[vAxis] if vMax > 0 else 0
+
+            def AccumulateSlices(firstSlice, lastSlice, traced):
+                # Adds the samples of slices firstSlice..lastSlice to the traced rays, returns their number
+                uStartTraced, uSlopeTraced = uStart[traced], uSlope[traced]
+                vStartTraced, vSlopeTraced = vStart[traced], vSlope[traced]
+                forwardTraced = forward[traced]
+                total = np.zeros(len(uStartTraced), dtype=valueType)
+                count = 0
+                for s in range(firstSlice, lastSlice + 1):
+                    u = uStartTraced + uSlopeTraced * s
+                    v = vStartTraced + vSlopeTraced * s
+                    inside = (u >= 0) & (u <= uMax) & (v >= 0) & (v <= vMax)
+                    if mixed:
+                        inside &= forwardTraced == (s > origin[axis])
+                    inside = np.nonzero(inside)[0]
+                    if inside.size == 0:
+                        continue
+                    u = u[inside]
+                    v = v[inside]
+                    u0 = np.minimum(u.astype(np.intp), max(uMax - 1, 0))
+                    v0 = np.minimum(v.astype(np.intp), max(vMax - 1, 0))
+                    fu = u - u0
+                    fv = v - v0
+
+                    index = s * strides[axis] + u0 * strides[uAxis] + v0 * strides[vAxis]
+                    value = ((volume[index] * (1 - fv) + volume[index + vOffset] * fv) * (1 - fu) +
+                             (volume[index + uOffset] * (1 - fv) + volume[index + uOffset + vOffset] * fv) * fu)
+                    total[inside] += value
+                    count += inside.size
+                accumulated[traced] += total
+                return count
+
+            if occupancy is None:
+                samples += AccumulateSlices(first, last, slice(None))
+                result[rays] = accumulated * stepLength
+                continue
+
+            # Slabs one block thick: a ray moves less than a block in u and v across a slab, as its
+            # slopes are at most one, so it crosses at most 2 x 2 blocks of the slab
+            blocks = occupancy.transpose(axis, uAxis, vAxis)
+            blockSize = OccupancyBlockSize
+            uLastBlock = blocks.shape[1] - 1
+            vLastBlock = blocks.shape[2] - 1
+            for slabStart in range(first - first % blockSize, last + 1, blockSize):
+                slab = blocks[slabStart // blockSize]
+                if not slab.any():
+                    continue
+                firstSlice = max(slabStart, first)
+                lastSlice = min(slabStart + blockSize - 1, last)
+                uFirst = uStart + uSlope * firstSlice
+                uLast = uStart + uSlope * lastSlice
+                vFirst = vStart + vSlope * firstSlice
+                vLast = vStart + vSlope * lastSlice
+                u0 = np.clip(np.floor(np.minimum(uFirst, uLast) / blockSize), 0, uLastBlock).astype(np.intp)
+                u1 = np.clip(np.floor(np.maximum(uFirst, uLast) / blockSize), 0, uLastBlock).astype(np.intp)
+                v0 = np.clip(np.floor(np.minimum(vFirst, vLast) / blockSize), 0, vLastBlock).astype(np.intp)
+                v1 = np.clip(np.floor(np.maximum(vFirst, vLast) / blockSize), 0, vLastBlock).astype(np.intp)
+                traced = np.nonzero(slab[u0, v0] | slab[u1, v0] | slab[u0, v1] | slab[u1, v1])[0]
+                if traced.size:
+                    samples += AccumulateSlices(firstSlice, lastSlice, traced)
+
+            result[rays] = accumulated * stepLength
+
+        return result, samples, fullSamples
+
+    def CountRaySamples(self, origin, axis, uAxis, vAxis, forward, uStart, uSlope, vStart, vSlope, bounds):
+        # Samples rays of one dominant axis take through the volume within bounds, in front of the source
+        lower, upper = bounds
+        first = np.full(len(forward), math.ceil(lower[axis]), dtype=np.float64)
+        last = np.full(len(forward), math.floor(upper[axis]), dtype=np.float64)
+        first[forward] = np.maximum(first[forward], math.ceil(origin[axis]))
+        last[~forward] = np.minimum(last[~forward], math.floor(origin[axis]))
+        for start, slope, a in ((uStart, uSlope, uAxis), (vStart, vSlope, vAxis)):
+            sMin, sMax = SliceRange(start, slope, lower[a], upper[a])
+            first = np.maximum(first, np.ceil(sMin))
+            last = np.minimum(last, np.floor(sMax))
+        return int(np.maximum(last - first + 1, 0).sum())
+
+    def CountSamples(self, samples, fullSamples):
+        with self.statisticsLock:
+            statistics = self.skippingStatistics
+            statistics["frames"] += 1
+            statistics["samples"] += int(samples)
+            statistics["fullSamples"] += int(fullSamples)
+            statistics["lastFrameSkippedFraction"] = SkippedFraction(samples, fullSamples)
+
+    def GetSkippingStatistics(self):
+        with self.statisticsLock:
+            statistics = dict(self.skippingStatistics)
+        statistics["skippedFraction"] = SkippedFraction(statistics["samples"], statistics["fullSamples"])
+        statistics["originalShape"] = self.originalShape
+        statistics["croppedShape"] = self.attenuation.shape if self.attenuation is not None else None
+        occupancy = self.levels[0][3] if self.levels else None
+        statistics["occupiedBlockFraction"] = float(occupancy.mean()) if occupancy is not None else None
+        return statistics
+
+    def ResetSkippingStatistics(self):
+        with self.statisticsLock:
+            self.skippingStatistics = {"frames": 0, "samples": 0, "fullSamples": 0, "lastFrameSkippedFraction": 0.0}
+
+    def Render(self, position, focalPoint, viewUp, out=None, level=0):
+        # Render an RGB uint8 DRR of shape (height, width, 3), optionally into out
+        # Levels above 0 are rendered coarse and scaled up to the full size by pixel replication
+        collimation = self.collimation
+        integrals = self.RenderLineIntegrals(position, focalPoint, viewUp, level, collimation)
+        if np.iscomplexobj(integrals):
+            integrals = self.beam.LineIntegrals(integrals.real, integrals.imag)
+        intensity = (np.exp(-self.attenuationScale * integrals) * 255.0).astype(np.uint8)
+        if level > 0:
+            step = 2 ** level
+            intensity = intensity.repeat(step, axis=0).repeat(step, axis=1)[:self.height, :self.width]
+        if out is None:
+            out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        out[...] = intensity[:, :, np.newaxis]
+        self.ApplyCollimation(out, collimation)
+        return out
+
+    def Shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,89 @@
+import collections
+import numpy as np
+
+#
+# DRR Cache
+#
+
+
+class CarmSimulatorDRRCache:
+    """LRU cache of rendered DRR images keyed by the quantized C-arm pose.
+
+    Poses are quantized so that revisiting a pose through the sliders or the
+    trackpad maps to the same key. Entries are evicted least recently used first
+    once the stored images exceed maximumBytes.
+    """
+
+    def __init__(self, maximumBytes=256 * 1024 * 1024, angleStep=0.01, translationStep=0.05, zoomStep=0.1):
+        self.maximumBytes = maximumBytes
+        self.angleStep = angleStep
+        self.translationStep = translationStep
+        self.zoomStep = zoomStep
+        self.entries = collections.OrderedDict()
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def MakeKey(self, cRotation, gantryRotation, wagRotation, tableTranslation, zoomFactor, volumeId, *extra):
+        # Extra values (e.g. backend, field of view) are appended to the key unchanged
+        return (int(round(cRotation / self.angleStep)),
+                int(round(gantryRotation / self.angleStep)),
+                int(round(wagRotation / self.angleStep)),
+                int(round(tableTranslation / self.translationStep)),
+                int(round(zoomFactor / self.zoomStep)),
+                volumeId) + tuple(extra)
+
+    def Get(self, key):
+        image = self.entries.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return image
+
+    def Put(self, key, image):
+        if image.nbytes > self.maximumBytes:
+            return
+        if key in self.entries:
+            self.currentBytes -= self.entries.pop(key).nbytes
+        self.entries[key] = np.array(image, copy=True)
+        self.currentBytes += image.nbytes
+        self.EvictToSize(self.maximumBytes)
+
+    def EvictToSize(self, maximumBytes):
+        while self.currentBytes > maximumBytes and self.entries:
+            key, image = self.entries.popitem(last=False)
+            self.currentBytes -= image.nbytes
+            self.evictions += 1
+
+    def SetMaximumBytes(self, maximumBytes):
+        self.maximumBytes = maximumBytes
+        self.EvictToSize(maximumBytes)
+
+    def Invalidate(self, volumeId=None):
+        # Drop every entry rendered from volumeId, or everything if no volume is given
+        if volumeId is None:
+            self.entries.clear()
+            self.currentBytes = 0
+            return
+        for key in [key for key in self.entries if key[5] == volumeId]:
+            self.currentBytes -= self.entries.pop(key).nbytes
+
+    def GetStatistics(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.currentBytes,
+            "maximumBytes": self.maximumBytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / float(lookups) if lookups else 0.0,
+        }
+
+    def ResetStatistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+
+from CarmSimulatorProfiler import CarmSimulatorProfiler
+
+#
+# DRR Worker
+#
+
+
+class CarmSimulatorDRRWorker:
+    """Renders DRRs with the CPU engine on a background thread.
+
+    The worker owns two image buffers. The front buffer is the one shown on the
+    monitor and is never written by the worker; the back buffer receives the next
+    render. TakeResult() is called on the main thread and swaps the buffers once a
+    render has finished.
+
+    Only the latest request is kept. A request that has not started rendering is
+    replaced by a newer one, and a finished image that has not been taken yet is
+    discarded as soon as a newer pose starts rendering. Cancel() discards everything
+    in flight, e.g. when the main thread shows a cached image instead.
+    """
+
+    def __init__(self, engine, buffers, profiler=None):
+        # buffers holds the two (height, width, 3) uint8 arrays rendered into, buffers[0] starts as front
+        self.engine = engine
+        self.buffers = buffers
+        self.frontIndex = 0
+        self.profiler = profiler if profiler is not None else CarmSimulatorProfiler()
+
+        self.condition = threading.Condition()
+        self.pendingRequest = None
+        self.rendering = False
+        self.resultReady = False
+        self.resultKey = None
+        self.generation = 0
+        self.running = False
+        self.thread = None
+
+        self.ResetStatistics()
+
+    def Start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.Run, name="CarmSimulatorDRRWorker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Stop(self):
+        with self.condition:
+            self.running = False
+            self.pendingRequest = None
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def Submit(self, key, position, focalPoint, viewUp, level=0):
+        # Queue a render of the given camera at a pyramid level of the engine,
+        # replacing any request that has not started
+        with self.condition:
+            if self.pendingRequest is not None:
+                self.supersededCount += 1
+            self.pendingRequest = (self.generation, key, position, focalPoint, viewUp, level)
+            self.submittedCount += 1
+            self.condition.notify()
+        self.Start()
+
+    def Cancel(self):
+        # Drop the pending request, the render in progress and any result not yet taken
+        with self.condition:
+            if self.pendingRequest is not None:
+                self.supersededCount += 1
+            self.pendingRequest = None
+            if self.resultReady:
+                self.discardedCount += 1
+            self.resultReady = False
+            self.generation += 1
+
+    def IsBusy(self):
+        with self.condition:
+            return self.rendering or self.pendingRequest is not None or self.resultReady
+
+    def Run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pendingRequest is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                generation, key, position, focalPoint, viewUp, level = self.pendingRequest
+                self.pendingRequest = None
+                if self.resultReady:
+                    # Finished image was never shown and a newer pose is on its way
+                    self.discardedCount += 1
+                    self.resultReady = False
+                self.rendering = True
+                backBuffer = self.buffers[1 - self.frontIndex]
+
+            startTime = time.perf_counter()
+            try:
+                with self.profiler.Stage("CPU render level %d (worker)" % level):
+                    self.engine.Render(position, focalPoint, viewUp, out=backBuffer, level=level)
+            except Exception:
+                logging.exception("DRR worker failed to render")
+                with self.condition:
+                    self.rendering = False
+                continue
+            renderTime = time.perf_counter() - startTime
+
+            with self.condition:
+                self.rendering = False
+                self.lastRenderTime = renderTime
+                self.completedCount += 1
+                # A newer request will overwrite the back buffer, so this image is already stale
+                if self.pendingRequest is not None or generation != self.generation:
+                    self.discardedCount += 1
+                    continue
+                self.resultReady = True
+                self.resultKey = key
+
+    def TakeResult(self):
+        # Main thread: swap in a finished render. Returns (front buffer, key) or None
+        with self.condition:
+            if not self.resultReady:
+                return None
+            self.resultReady = False
+            self.frontIndex = 1 - self.frontIndex
+            self.swappedCount += 1
+            return self.buffers[self.frontIndex], self.resultKey
+
+    def GetFrontBuffer(self):
+        return self.buffers[self.frontIndex]
+
+    def GetStatistics(self):
+        with self.condition:
+            return {
+                "submitted": self.submittedCount,
+                "superseded": self.supersededCount,
+                "completed": self.completedCount,
+                "discarded": self.discardedCount,
+                "swapped": self.swappedCount,
+                "lastRenderTime": self.lastRenderTime,
+                "busy": self.rendering or self.pendingRequest is not None,
+            }
+
+    def ResetStatistics(self):
+        self.submittedCount = 0
+        self.supersededCount = 0
+        self.completedCount = 0
+        self.discardedCount = 0
+        self.swappedCount = 0
+        self.lastRenderTime = 0.0
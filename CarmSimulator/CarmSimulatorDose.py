@@ -0,0 +1,125 @@
+import math
+import time
+import numpy as np
+
+from CarmSimulatorCollimation import CollimationRadius
+
+#
+# Radiation Dose
+#
+# Every fluoro shot deposits dose on the vertices of the patient's skin mesh that
+# lie inside the X-ray beam. The beam has its apex at the source of the Cone
+# model and runs along its axis, opened to the field the DRR camera images
+# through the collimation the field of view setting shows on the monitor, which
+# can be wider than the Cone model itself. Dose falls off with the square of the distance to the source from the
+# air kerma at the interventional reference point; skin facing away from the
+# source only gets the small fraction of the beam that exits the patient. One
+# shot is a handful of NumPy operations over all vertices.
+#
+
+# Cone.stl: base of this radius at z = 0, apex (the source) at z = ConeHeight
+ConeHeight = 1199.9
+ConeBaseRadius = 164.85
+
+# Interventional reference point, 15 cm from the isocenter towards the source
+ReferenceDistance = 705.81 - 150.0
+
+
+# Vertical view angle of the DRR camera, whose detector half height the collimation radius is measured in
+DetectorViewAngle = 30.0
+# Width over height of the DRR detector, the open field ends at its corners
+DetectorAspectRatio = 530.0 / 335.0
+
+
+def CollimationFraction(fieldOfView):
+    # Tangent of the imaged field at a field of view slider value, relative to the Cone model's tangent
+    # Above 1 the beam is wider than the Cone model, as the field seen on the monitor is
+    radius = min(CollimationRadius(fieldOfView), math.hypot(1.0, DetectorAspectRatio))
+    tangent = math.tan(math.radians(DetectorViewAngle / 2.0)) * radius
+    return tangent * ConeHeight / ConeBaseRadius
+
+
+def VertexNormals(points, triangles):
+    # Area weighted average of the normals of the triangles around each vertex
+    vertices = points[triangles]
+    faceNormals = np.cross(vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 0])
+    normals = np.zeros_like(points)
+    for corner in range(3):
+        np.add.at(normals, triangles[:, corner], faceNormals)
+    lengths = np.linalg.norm(normals, axis=1)
+    return normals / np.maximum(lengths, 1e-12)[:, np.newaxis]
+
+
+class CarmSimulatorDoseMap:
+    """Cumulative skin dose (mGy) per vertex of a mesh and dose area product (mGy cm2).
+
+    points and triangles are the mesh in its own coordinates. Deposit() takes the
+    world matrices of the cone and of the mesh, so the map stays attached to the
+    skin when the table moves.
+    """
+
+    def __init__(self, points, triangles, airKermaPerShot=1.0, exitFraction=0.01, historyLength=1000):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.triangles = np.asarray(triangles, dtype=np.intp)
+        self.normals = VertexNormals(self.points, self.triangles)
+
+        # Air kerma (mGy) at the reference point of one shot
+        self.airKermaPerShot = airKermaPerShot
+        self.exitFraction = exitFraction
+
+        self.skinDose = np.zeros(len(self.points))
+        self.doseAreaProduct = 0.0
+        self.shotCount = 0
+
+        # Deposit times in seconds, the last historyLength of them
+        self.depositTimes = np.zeros(historyLength)
+
+    def Reset(self):
+        self.skinDose[:] = 0.0
+        self.doseAreaProduct = 0.0
+        self.shotCount = 0
+
+    def Deposit(self, coneToWorld, meshToWorld, collimation=1.0):
+        # Adds one shot, returns the number of vertices it reached; collimation scales the Cone model's tangent
+        startTime = time.perf_counter()
+        coneToMesh = np.linalg.solve(meshToWorld, coneToWorld)
+        source = coneToMesh[:3, :3].dot([0.0, 0.0, ConeHeight]) + coneToMesh[:3, 3]
+        axis = -coneToMesh[:3, 2] / np.linalg.norm(coneToMesh[:3, 2])
+        tangent = ConeBaseRadius / ConeHeight * collimation
+
+        offsets = self.points - source
+        depth = offsets.dot(axis)
+        distanceSquared = np.einsum('ij,ij->i', offsets, offsets)
+        inBeam = (depth > 0.0) & (distanceSquared - depth * depth <= (depth * tangent) ** 2)
+        indices = np.flatnonzero(inBeam)
+
+        # Inverse square law from the reference point, skin facing away gets the exit fraction
+        dose = self.airKermaPerShot * ReferenceDistance * ReferenceDistance / distanceSquared[indices]
+        facingSource = np.einsum('ij,ij->i', self.normals[indices], offsets[indices]) < 0.0
+        dose[~facingSource] *= self.exitFraction
+        self.skinDose[indices] += dose
+
+        # Beam area at the reference point in cm2
+        self.doseAreaProduct += self.airKermaPerShot * math.pi * (ReferenceDistance * tangent) ** 2 / 100.0
+        self.depositTimes[self.shotCount % len(self.depositTimes)] = time.perf_counter() - startTime
+        self.shotCount += 1
+        return len(indices)
+
+    def GetPeakSkinDose(self):
+        return float(self.skinDose.max()) if len(self.skinDose) else 0.0
+
+    def Save(self, path):
+        # Mesh and dose together, so the map can be inspected without the scene
+        np.savez_compressed(path, points=self.points, triangles=self.triangles, skinDose=self.skinDose,
+                            doseAreaProduct=self.doseAreaProduct, shotCount=self.shotCount)
+
+    def GetStatistics(self):
+        times = self.depositTimes[:min(self.shotCount, len(self.depositTimes))] * 1000.0
+        return {
+            "shots": self.shotCount,
+            "vertices": len(self.points),
+            "doseAreaProduct": self.doseAreaProduct,
+            "peakSkinDose": self.GetPeakSkinDose(),
+            "exposedVertices": int(np.count_nonzero(self.skinDose)),
+            "meanDepositTime": float(times.mean()) if len(times) else 0.0,
+        }
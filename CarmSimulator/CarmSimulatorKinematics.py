@@ -0,0 +1,112 @@
+import numpy as np
+
+#
+# C-arm Kinematics
+#
+# A pose is (C rotation, gantry rotation, wag rotation, table translation, zoom factor),
+# angles in degrees. Every function accepts a single pose or an (N, 5) array of poses
+# and computes all of them in one batched NumPy pass.
+#
+
+# Pivots of the scene model (mm)
+# TO DO: Read in Hardcoded values from Config
+CPivot = np.array([1262.2704, 337.5527, -5.7])
+GantryPivot = np.array([0.0, 337.5527, 0.0])
+WagPivot = np.array([500.0, 0.0, 0.0])
+
+# DRR camera: source distance from the focal point and its change per zoom unit
+SourceDistance = 705.81
+ZoomStep = 16.0
+
+
+def Translation(vectors):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    matrices = np.zeros(vectors.shape[:-1] + (4, 4))
+    matrices[..., [0, 1, 2, 3], [0, 1, 2, 3]] = 1.0
+    matrices[..., :3, 3] = vectors
+    return matrices
+
+
+def Rotation(axis, angles):
+    # Right handed rotation about the X (0), Y (1) or Z (2) axis, as vtkTransform.RotateX/Y/Z
+    radians = np.radians(np.asarray(angles, dtype=np.float64))
+    c = np.cos(radians)
+    s = np.sin(radians)
+    i, j = [a for a in range(3) if a != axis]
+    if axis == 1:
+        # Keep the cyclic order (z, x) for Y so the sign convention matches X and Z
+        i, j = j, i
+    matrices = np.zeros(radians.shape + (4, 4))
+    matrices[..., axis, axis] = 1.0
+    matrices[..., 3, 3] = 1.0
+    matrices[..., i, i] = c
+    matrices[..., i, j] = -s
+    matrices[..., j, i] = s
+    matrices[..., j, j] = c
+    return matrices
+
+
+def RotationAbout(axis, angles, pivot):
+    # Rotation about an axis through pivot: T(pivot) R T(-pivot)
+    matrices = Rotation(axis, angles)
+    rotated = np.einsum('...ij,j->...i', matrices[..., :3, :3], pivot)
+    matrices[..., :3, 3] = pivot - rotated
+    return matrices
+
+
+def SplitPoses(poses):
+    poses = np.asarray(poses, dtype=np.float64)
+    single = poses.ndim == 1
+    poses = np.atleast_2d(poses)
+    return single, poses[:, 0], poses[:, 1], poses[:, 2], poses[:, 3], poses[:, 4]
+
+
+def ComputeModelMatrices(poses):
+    """Matrices to parent of the C, gantry, wag and table transforms.
+
+    Returns a dict of (N, 4, 4) arrays, or (4, 4) arrays for a single pose.
+    """
+    single, cRotation, gantryRotation, wagRotation, tableTranslation, zoomFactor = SplitPoses(poses)
+    tableVectors = np.zeros((len(tableTranslation), 3))
+    tableVectors[:, 1] = tableTranslation
+    matrices = {
+        "C": RotationAbout(2, cRotation, CPivot),
+        "Gantry": RotationAbout(0, gantryRotation, GantryPivot),
+        "Wag": RotationAbout(1, wagRotation, WagPivot),
+        "Table": Translation(tableVectors),
+    }
+    if single:
+        matrices = {name: matrix[0] for name, matrix in matrices.items()}
+    return matrices
+
+
+def ComputeDRRCameras(poses):
+    """DRR camera positions, focal points and view up vectors.
+
+    Returns three (N, 3) arrays, or three 3-vectors for a single pose.
+    """
+    single, cRotation, gantryRotation, wagRotation, tableTranslation, zoomFactor = SplitPoses(poses)
+
+    # Source on the C: pulled towards the detector by the zoom, then C, gantry and wag rotations
+    # The camera wag is applied as T(-500) Ry T(500), i.e. about the mirrored pivot
+    sourceVectors = np.zeros((len(zoomFactor), 3))
+    sourceVectors[:, 1] = -SourceDistance + zoomFactor * ZoomStep
+    camera = RotationAbout(1, -wagRotation, -WagPivot) @ Rotation(0, gantryRotation) @ \
+        Rotation(2, -cRotation) @ Translation(sourceVectors)
+    positions = camera[:, :3, 3]
+    viewUps = camera[:, :3, 2]
+
+    # Focal point follows the wag and the table
+    tableVectors = np.zeros((len(tableTranslation), 3))
+    tableVectors[:, 2] = -tableTranslation
+    focal = RotationAbout(1, wagRotation, WagPivot) @ Translation(tableVectors)
+    focalPoints = focal[:, :3, 3]
+
+    if single:
+        return positions[0], focalPoints[0], viewUps[0]
+    return positions, focalPoints, viewUps
+
+
+def ComputeDRRCamera(cRotation, gantryRotation, wagRotation, tableTranslation, zoomFactor):
+    # Camera pose used to render the DRR for the given C-arm pose
+    return ComputeDRRCameras([cRotation, gantryRotation, wagRotation, tableTranslation, zoomFactor])
@@ -0,0 +1,151 @@
+import math
+import vtk
+
+#
+# Level Of Detail
+#
+
+
+def DecimatePolyData(polyData, reduction):
+    # Quadric decimation keeping (1 - reduction) of the triangles
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputData(polyData)
+    decimate = vtk.vtkQuadricDecimation()
+    decimate.SetInputConnection(triangles.GetOutputPort())
+    decimate.SetTargetReduction(reduction)
+    decimate.VolumePreservationOn()
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(decimate.GetOutputPort())
+    normals.SplittingOff()
+    normals.Update()
+    output = vtk.vtkPolyData()
+    output.DeepCopy(normals.GetOutput())
+    return output
+
+
+class CarmSimulatorLODModel:
+    """Decimated versions of one model, level 0 being the full resolution mesh."""
+
+    def __init__(self, name, polyData, levelFractions):
+        self.name = name
+        self.levels = [polyData]
+        for fraction in levelFractions[1:]:
+            self.levels.append(DecimatePolyData(polyData, 1.0 - fraction))
+        self.activeLevel = 0
+        bounds = polyData.GetBounds()
+        self.radius = 0.5 * math.sqrt((bounds[1] - bounds[0]) ** 2 + (bounds[3] - bounds[2]) ** 2 +
+                                      (bounds[5] - bounds[4]) ** 2)
+
+    def GetTriangleCounts(self):
+        return [level.GetNumberOfPolys() for level in self.levels]
+
+
+class CarmSimulatorLODManager:
+    """Switches scene models between decimated levels of detail.
+
+    Two policies are available:
+    - "FrameTime": every model uses the same level, coarsened when the view's last
+      render time exceeds the frame budget and refined when well under it.
+    - "ScreenSize": each model picks the level whose size matches its projected
+      size in pixels in the view.
+    """
+
+    def __init__(self, levelFractions=(1.0, 0.5, 0.25, 0.1)):
+        self.levelFractions = levelFractions
+        self.models = {}
+        self.modelNodes = {}
+        self.policy = "FrameTime"
+
+        # Models held at a fixed level whatever the policy, by name
+        self.lockedLevels = {}
+
+        # 90 Hz headset, coarsen above the budget, refine below refineFraction of it
+        self.targetFrameTime = 1.0 / 90.0
+        self.refineFraction = 0.6
+        self.globalLevel = 0
+
+        # Screen size policy: projected diameter in pixels needed for each level
+        self.levelPixelThresholds = (400.0, 200.0, 80.0)
+
+    def AddModel(self, name, modelNode):
+        # Decimated levels are computed from the mesh currently on the node
+        self.models[name] = CarmSimulatorLODModel(name, modelNode.GetPolyData(), self.levelFractions)
+        self.modelNodes[name] = modelNode
+
+    def RemoveAllModels(self):
+        self.SetLevelForAll(0)
+        self.models = {}
+        self.modelNodes = {}
+
+    def SetModelLevel(self, name, level):
+        model = self.models[name]
+        level = self.lockedLevels.get(name, level)
+        level = max(0, min(level, len(model.levels) - 1))
+        if level == model.activeLevel:
+            return
+        model.activeLevel = level
+        self.modelNodes[name].SetAndObservePolyData(model.levels[level])
+
+    def SetLevelForAll(self, level):
+        for name in self.models:
+            self.SetModelLevel(name, level)
+
+    def LockModelLevel(self, name, level):
+        # Holds a model at level, None releases it to the policy again
+        if level is None:
+            self.lockedLevels.pop(name, None)
+            return
+        self.lockedLevels[name] = level
+        if name in self.models:
+            self.SetModelLevel(name, level)
+
+    def Update(self, renderer):
+        # Call periodically with the renderer of the view being optimized
+        if self.policy == "ScreenSize":
+            self.UpdateScreenSize(renderer)
+        else:
+            self.UpdateFrameTime(renderer.GetLastRenderTimeInSeconds())
+
+    def UpdateFrameTime(self, frameTime):
+        if frameTime <= 0.0:
+            return
+        if frameTime > self.targetFrameTime:
+            self.globalLevel = min(self.globalLevel + 1, len(self.levelFractions) - 1)
+        elif frameTime < self.targetFrameTime * self.refineFraction:
+            self.globalLevel = max(self.globalLevel - 1, 0)
+        self.SetLevelForAll(self.globalLevel)
+
+    def UpdateScreenSize(self, renderer):
+        camera = renderer.GetActiveCamera()
+        viewHeight = renderer.GetSize()[1]
+        if viewHeight <= 0:
+            return
+        cameraPosition = camera.GetPosition()
+        pixelsPerRadian = viewHeight / math.radians(camera.GetViewAngle())
+        for name, model in self.models.items():
+            bounds = [0.0] * 6
+            self.modelNodes[name].GetRASBounds(bounds)
+            center = [(bounds[0] + bounds[1]) * 0.5, (bounds[2] + bounds[3]) * 0.5, (bounds[4] + bounds[5]) * 0.5]
+            distance = math.sqrt(vtk.vtkMath.Distance2BetweenPoints(cameraPosition, center))
+            projectedSize = 2.0 * math.atan2(model.radius, max(distance, 1e-6)) * pixelsPerRadian
+            level = len(self.levelPixelThresholds)
+            for index, threshold in enumerate(self.levelPixelThresholds):
+                if projectedSize >= threshold:
+                    level = index
+                    break
+            self.SetModelLevel(name, level)
+
+    def GetStatistics(self):
+        # Triangle counts per level and the active level of every model
+        statistics = {}
+        for name, model in self.models.items():
+            counts = model.GetTriangleCounts()
+            statistics[name] = {
+                "activeLevel": model.activeLevel,
+                "triangleCounts": counts,
+                "activeTriangles": counts[model.activeLevel],
+            }
+        return statistics
+
+    def GetActiveTriangleCount(self):
+        return sum(model.GetTriangleCounts()[model.activeLevel] for model in self.models.values())
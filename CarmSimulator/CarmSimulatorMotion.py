@@ -0,0 +1,121 @@
+import collections
+import time
+import numpy as np
+import qt
+
+#
+# Motion Controller
+#
+
+
+class CarmSimulatorMotionController:
+    """Moves the C-arm at a constant speed while a trackpad direction is held.
+
+    The controller ticks at a fixed interval and integrates the axis velocity over
+    the real time elapsed since the previous tick, so the motion speed does not
+    depend on how fast the machine is. The timer is stopped while no direction is
+    active.
+    """
+
+    # Trackpad direction -> (axis, sign)
+    Directions = {
+        1: ("C", -1.0),
+        2: ("C", 1.0),
+        3: ("Gantry", -1.0),
+        4: ("Gantry", 1.0),
+        5: ("Wag", 1.0),
+        6: ("Wag", -1.0),
+        7: ("Table", 1.0),
+        8: ("Table", -1.0),
+    }
+
+    def __init__(self, stepCallback, tickInterval=16):
+        # stepCallback(axis, delta) applies a delta in degrees (mm for the table)
+        self.stepCallback = stepCallback
+        self.tickInterval = tickInterval
+
+        # Degrees per second, mm per second for the table
+        self.velocities = {"C": 30.0, "Gantry": 30.0, "Wag": 6.0, "Table": 30.0}
+
+        self.direction = 0
+        self.elapsed = qt.QElapsedTimer()
+        self.timer = qt.QTimer()
+        self.timer.setTimerType(qt.Qt.PreciseTimer)
+        self.timer.setInterval(tickInterval)
+        self.timer.connect('timeout()', self.OnTick)
+
+        self.ResetStatistics()
+
+    def SetDirection(self, direction):
+        if direction not in self.Directions:
+            direction = 0
+        if direction == self.direction:
+            return
+        wasActive = self.direction != 0
+        self.direction = direction
+
+        if direction == 0:
+            self.Suspend()
+        elif not wasActive:
+            self.elapsed.start()
+            self.activeWallStart = time.perf_counter()
+            self.activeCPUStart = time.process_time()
+            self.timer.start()
+
+    def SetTickInterval(self, tickInterval):
+        self.tickInterval = tickInterval
+        self.timer.setInterval(tickInterval)
+
+    def Suspend(self):
+        if not self.timer.isActive():
+            return
+        self.timer.stop()
+        self.activeWallTime += time.perf_counter() - self.activeWallStart
+        self.activeCPUTime += time.process_time() - self.activeCPUStart
+
+    def OnTick(self):
+        # Seconds since the previous tick
+        dt = self.elapsed.nsecsElapsed() * 1e-9
+        self.elapsed.restart()
+        self.tickCount += 1
+        self.tickIntervals.append(dt)
+
+        axis, sign = self.Directions.get(self.direction, (None, 0.0))
+        if axis is None:
+            return
+        self.stepCallback(axis, sign * self.velocities[axis] * dt)
+
+    def GetStatistics(self):
+        # Tick timing and CPU usage of the process while motion was active
+        wallTime = self.activeWallTime
+        cpuTime = self.activeCPUTime
+        if self.timer.isActive():
+            wallTime += time.perf_counter() - self.activeWallStart
+            cpuTime += time.process_time() - self.activeCPUStart
+
+        intervals = np.array(self.tickIntervals) * 1000.0
+        jitter = np.abs(intervals - self.tickInterval)
+        return {
+            "active": self.timer.isActive(),
+            "tickInterval": self.tickInterval,
+            "ticks": self.tickCount,
+            "meanTickInterval": float(intervals.mean()) if intervals.size else 0.0,
+            "meanJitter": float(jitter.mean()) if jitter.size else 0.0,
+            "p95Jitter": float(np.percentile(jitter, 95)) if jitter.size else 0.0,
+            "maxJitter": float(jitter.max()) if jitter.size else 0.0,
+            "activeTime": wallTime,
+            "cpuPercent": 100.0 * cpuTime / wallTime if wallTime > 0 else 0.0,
+        }
+
+    def ResetStatistics(self):
+        # Intervals in seconds of the most recent ticks
+        self.tickIntervals = collections.deque(maxlen=1000)
+        self.tickCount = 0
+        self.activeWallTime = 0.0
+        self.activeCPUTime = 0.0
+        self.activeWallStart = time.perf_counter()
+        self.activeCPUStart = time.process_time()
+
+    def Stop(self):
+        self.direction = 0
+        self.Suspend()
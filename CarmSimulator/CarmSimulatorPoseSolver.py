@@ -0,0 +1,254 @@
+"""Search for the C-arm pose whose DRR best matches a target view.
+
+Nelder-Mead runs from several start poses in parallel, one process per core.
+Each run starts on the coarsest DRR pyramid level and restarts with a smaller
+simplex on the finer levels, the last stage at full resolution. The objective is
+the CarmSimulatorTargetScorer score of the DRR against the reference image, so
+the candidates have to be rendered with the zoom, collimation and beam the
+reference was taken with.
+
+Example:
+    python CarmSimulatorPoseSolver.py --volume Resources/LumbarSpinePhantom_CT.mha \\
+        --reference "Full AP.png" --label "Full AP" --zoom 27 --fov 46 --output OptimalPoses.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+from CarmSimulatorBatch import PoseLimits
+from CarmSimulatorDRR import CarmSimulatorDRREngine, ReadVolumeProperty
+from CarmSimulatorKinematics import ComputeDRRCameras
+from CarmSimulatorScoring import CarmSimulatorTargetScorer, TargetViewPoses, ReadReferenceImage
+from CarmSimulatorAttenuationCache import ReadAttenuationVolume
+from CarmSimulatorCollimation import CollimationRadius
+from CarmSimulatorSpectrum import CarmSimulatorPolychromaticBeam
+from CarmSimulatorVolumeIO import ReadMetaImage
+
+# Searched axes, the zoom stays fixed
+SolverAxes = ["c", "gantry", "wag", "table"]
+SolverLow = np.array([PoseLimits[axis][0] for axis in SolverAxes])
+SolverHigh = np.array([PoseLimits[axis][1] for axis in SolverAxes])
+
+# (pyramid level, evaluations, initial simplex size in degrees / mm) of each stage
+DefaultSchedule = [(2, 120, [10.0, 10.0, 10.0, 20.0]), (1, 50, [3.0, 3.0, 3.0, 6.0]), (0, 25, [1.0, 1.0, 1.0, 2.0])]
+
+
+def NelderMead(function, start, scale, maximumEvaluations, tolerance=1e-3):
+    """Minimizes function from start with an axis aligned initial simplex of size scale.
+
+    Returns the best point, its value and the number of evaluations.
+    """
+    start = np.asarray(start, dtype=np.float64)
+    simplex = [start] + [start + np.eye(len(start))[axis] * scale[axis] for axis in range(len(start))]
+    values = [function(point) for point in simplex]
+    evaluations = len(simplex)
+
+    while evaluations < maximumEvaluations:
+        order = np.argsort(values)
+        simplex = [simplex[index] for index in order]
+        values = [values[index] for index in order]
+        if values[-1] - values[0] < tolerance:
+            break
+
+        centroid = np.mean(simplex[:-1], axis=0)
+        reflected = centroid + (centroid - simplex[-1])
+        reflectedValue = function(reflected)
+        evaluations += 1
+        if reflectedValue < values[0]:
+            expanded = centroid + 2.0 * (centroid - simplex[-1])
+            expandedValue = function(expanded)
+            evaluations += 1
+            if expandedValue < reflectedValue:
+                simplex[-1], values[-1] = expanded, expandedValue
+            else:
+                simplex[-1], values[-1] = reflected, reflectedValue
+            continue
+        if reflectedValue < values[-2]:
+            simplex[-1], values[-1] = reflected, reflectedValue
+            continue
+
+        # Contract towards the better of the worst and the reflected point
+        if reflectedValue < values[-1]:
+            contracted = centroid + 0.5 * (reflected - centroid)
+        else:
+            contracted = centroid + 0.5 * (simplex[-1] - centroid)
+        contractedValue = function(contracted)
+        evaluations += 1
+        if contractedValue < min(reflectedValue, values[-1]):
+            simplex[-1], values[-1] = contracted, contractedValue
+            continue
+
+        # Shrink towards the best point
+        for index in range(1, len(simplex)):
+            simplex[index] = simplex[0] + 0.5 * (simplex[index] - simplex[0])
+            values[index] = function(simplex[index])
+        evaluations += len(simplex) - 1
+
+    best = int(np.argmin(values))
+    return simplex[best], values[best], evaluations
+
+
+def PoseError(pose, optimum):
+    # Angle (degrees, over C, gantry and wag) and table (mm) distance between two poses
+    difference = np.asarray(pose[:4], dtype=np.float64) - np.asarray(optimum[:4], dtype=np.float64)
+    return float(np.linalg.norm(difference[:3])), float(abs(difference[3]))
+
+
+#
+# Worker process
+#
+
+workerEngine = None
+workerScorer = None
+workerZoom = 0.0
+
+
+def InitializeWorker(volumePath, ijkToRAS, opacityPoints, reference, width, height, zoom, fieldOfView, kVp):
+    global workerEngine, workerScorer, workerZoom
+    # One process per start, so the engine itself stays single threaded
+    workerEngine = CarmSimulatorDRREngine(width, height, numberOfThreads=1)
+    if fieldOfView is not None:
+        workerEngine.SetCollimation(CollimationRadius(fieldOfView))
+    if kVp is not None:
+        scalars, fileIJKToRAS = ReadMetaImage(volumePath)
+        workerEngine.SetVolume(scalars, fileIJKToRAS if ijkToRAS is None else ijkToRAS, opacityPoints,
+                               CarmSimulatorPolychromaticBeam(kVp))
+    else:
+        attenuation, scale, fileIJKToRAS = ReadAttenuationVolume(volumePath, opacityPoints)
+        workerEngine.SetAttenuationVolume(attenuation, fileIJKToRAS if ijkToRAS is None else ijkToRAS, scale)
+    workerScorer = CarmSimulatorTargetScorer()
+    workerScorer.SetReference("target", reference)
+    workerZoom = zoom
+
+
+def EvaluatePose(point, level):
+    # Negative score of the DRR at point, points outside the slider limits are clamped
+    pose = np.append(np.clip(point, SolverLow, SolverHigh), workerZoom)
+    position, focalPoint, viewUp = ComputeDRRCameras(pose)
+    image = workerEngine.Render(position, focalPoint, viewUp, level=level)
+    return -workerScorer.Score("target", image)["score"]
+
+
+def SolveFromStart(start, schedule):
+    startTime = time.perf_counter()
+    point = np.asarray(start, dtype=np.float64)
+    evaluations = 0
+    for level, maximumEvaluations, scale in schedule:
+        point, bestValue, count = NelderMead(lambda p: EvaluatePose(p, level), point, scale, maximumEvaluations)
+        point = np.clip(point, SolverLow, SolverHigh)
+        evaluations += count
+    return {
+        "start": [float(value) for value in start],
+        "pose": [float(value) for value in point] + [workerZoom],
+        "score": -float(bestValue),
+        "evaluations": evaluations,
+        "seconds": time.perf_counter() - startTime,
+    }
+
+
+#
+# Solver
+#
+
+def MakeStarts(numberOfStarts, hint=None, seed=0):
+    # The hint pose first, if any, the others uniform within the slider limits
+    generator = np.random.default_rng(seed)
+    starts = generator.uniform(SolverLow, SolverHigh, size=(numberOfStarts, len(SolverAxes)))
+    if hint is not None and numberOfStarts > 0:
+        starts[0] = np.clip(np.asarray(hint, dtype=np.float64)[:len(SolverAxes)], SolverLow, SolverHigh)
+    return starts
+
+
+def SolvePose(volumePath, reference, ijkToRAS=None, zoom=0.0, hint=None, numberOfStarts=8, numberOfWorkers=None,
+              schedule=None, seed=0, opacityPoints=None, width=530, height=335, fieldOfView=None, kVp=None):
+    """Best pose (C, gantry, wag, table, zoom) for a reference image, and the result of every start.
+
+    ijkToRAS overrides the volume file's geometry, e.g. to include the parent transform
+    of the volume node in the scene. zoom, fieldOfView (None for no collimation) and
+    kVp (None for the opacity transfer function) must be those of the reference.
+    """
+    numberOfWorkers = numberOfWorkers or os.cpu_count() or 1
+    schedule = schedule or DefaultSchedule
+    if opacityPoints is None:
+        volumePropertyPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Resources/VolumeProperty.vp')
+        opacityPoints, colorPoints = ReadVolumeProperty(volumePropertyPath)
+    starts = MakeStarts(numberOfStarts, hint, seed)
+
+    # Workers are spawned rather than forked, so this is safe to call from within Slicer
+    startTime = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(numberOfWorkers, len(starts)), mp_context=multiprocessing.get_context("spawn"),
+            initializer=InitializeWorker,
+            initargs=(volumePath, ijkToRAS, opacityPoints, np.asarray(reference), width, height, zoom,
+                      fieldOfView, kVp)) as executor:
+        results = list(executor.map(SolveFromStart, starts, [schedule] * len(starts)))
+
+    best = max(results, key=lambda result: result["score"])
+    return {
+        "pose": best["pose"],
+        "score": best["score"],
+        "seconds": time.perf_counter() - startTime,
+        "evaluations": sum(result["evaluations"] for result in results),
+        "starts": results,
+    }
+
+
+def LoadOptimalPoses(path):
+    # {case name: {target label: solution}}
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def SaveOptimalPose(path, caseName, label, solution):
+    # Only the pose and score are kept, not the individual starts
+    optimalPoses = LoadOptimalPoses(path)
+    optimalPoses.setdefault(caseName, {})[label] = {
+        "pose": solution["pose"],
+        "score": solution["score"],
+        "solved": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temporaryPath = path + ".tmp"
+    with open(temporaryPath, 'w') as f:
+        json.dump(optimalPoses, f, indent=2)
+    os.replace(temporaryPath, path)
+    return optimalPoses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find the C-arm pose that best reproduces a reference image.")
+    parser.add_argument("--volume", required=True, help=".mha CT volume")
+    parser.add_argument("--reference", required=True, help="Reference PNG of the target view")
+    parser.add_argument("--label", default=None, help="Target view label, its approximate pose is used as a start")
+    parser.add_argument("--zoom", type=float, default=0.0, help="Zoom the reference was taken with")
+    parser.add_argument("--fov", type=float, default=None, help="Field of view of the reference (default: not collimated)")
+    parser.add_argument("--kvp", type=float, default=None, help="Beam of the reference (default: transfer function)")
+    parser.add_argument("--starts", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Store the solution in this optimal poses JSON file")
+    args = parser.parse_args(argv)
+
+    hint = TargetViewPoses.get(args.label)
+    solution = SolvePose(args.volume, ReadReferenceImage(args.reference), zoom=args.zoom, hint=hint,
+                         numberOfStarts=args.starts, numberOfWorkers=args.workers, seed=args.seed,
+                         fieldOfView=args.fov, kVp=args.kvp)
+    if args.output is not None:
+        caseName = os.path.splitext(os.path.basename(args.volume))[0]
+        SaveOptimalPose(args.output, caseName, args.label or os.path.basename(args.reference), solution)
+    print(json.dumps(solution, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
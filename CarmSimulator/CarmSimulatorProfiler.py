@@ -0,0 +1,129 @@
+import collections
+import json
+import os
+import threading
+import time
+import numpy as np
+
+#
+# Profiler
+#
+# Timing hooks for the DRR pipeline. Stages are timed with
+#     with profiler.Stage("name"):
+#         ...
+# When the profiler is disabled Stage() returns a shared object whose enter and
+# exit do nothing, so the hooks can stay in the hot path.
+#
+# UpdateDRR times the camera setup, the cache lookup and copy, the CPU render of
+# each pyramid level (also on the DRR worker thread) and, for the VTK backend,
+# renderWindow.Render, the framebuffer readback into the monitor texture and the
+# collimation. Slicer's own 3D view renders are timed through their render
+# window's Start and End events.
+#
+
+
+class NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NullStageInstance = NullStage()
+
+
+class ProfilerStage:
+    __slots__ = ('profiler', 'name', 'startTime')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.Record(self.name, self.startTime, time.perf_counter() - self.startTime)
+        return False
+
+
+class CarmSimulatorProfiler:
+    """Rolling per-stage timings and a trace of the most recent stage events."""
+
+    def __init__(self, enabled=False, historyLength=600, traceLength=100000):
+        self.enabled = enabled
+        self.historyLength = historyLength
+        self.traceLength = traceLength
+        self.Reset()
+
+    def SetEnabled(self, enabled):
+        self.enabled = enabled
+
+    def Stage(self, name):
+        if not self.enabled:
+            return NullStageInstance
+        return ProfilerStage(self, name)
+
+    def Record(self, name, startTime, duration):
+        # Called from any thread, deque appends are atomic
+        history = self.histories.get(name)
+        if history is None:
+            history = self.histories.setdefault(name, collections.deque(maxlen=self.historyLength))
+        history.append(duration)
+        self.trace.append((name, threading.get_ident(), startTime, duration))
+
+    def Reset(self):
+        self.histories = collections.OrderedDict()
+        self.trace = collections.deque(maxlen=self.traceLength)
+        self.startTime = time.perf_counter()
+
+    def GetStatistics(self):
+        # Milliseconds over the last historyLength samples of every stage
+        statistics = collections.OrderedDict()
+        for name, history in list(self.histories.items()):
+            samples = np.array(history) * 1000.0
+            if samples.size == 0:
+                continue
+            statistics[name] = {
+                "count": int(samples.size),
+                "mean": float(samples.mean()),
+                "p50": float(np.percentile(samples, 50)),
+                "p95": float(np.percentile(samples, 95)),
+                "max": float(samples.max()),
+            }
+        return statistics
+
+    def GetHistogram(self, name, binEdges=None):
+        # Counts of the recent durations of a stage in ms, by default one bin below 10 us
+        # then logarithmic bins up to 1 s
+        if binEdges is None:
+            binEdges = np.concatenate(([0.0], np.logspace(-2, 3, 21)))
+        counts, binEdges = np.histogram(np.array(self.histories.get(name, ())) * 1000.0, bins=binEdges)
+        return counts, binEdges
+
+    def GetReport(self):
+        # One line per stage, used by the on-screen overlay
+        lines = ["%-28s %7s %7s %7s" % ("Stage (ms)", "mean", "p95", "max")]
+        for name, entry in self.GetStatistics().items():
+            lines.append("%-28s %7.2f %7.2f %7.2f" % (name, entry["mean"], entry["p95"], entry["max"]))
+        return "\n".join(lines)
+
+    def ExportChromeTrace(self, path):
+        # Complete ("X") events in microseconds, viewable in chrome://tracing or Perfetto
+        processId = os.getpid()
+        events = []
+        for name, threadId, startTime, duration in list(self.trace):
+            events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (startTime - self.startTime) * 1e6,
+                "dur": duration * 1e6,
+                "pid": processId,
+                "tid": threadId,
+            })
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return len(events)
@@ -0,0 +1,211 @@
+import struct
+import threading
+import time
+import numpy as np
+
+#
+# Session Recorder
+#
+# A recording is a header followed by fixed size little endian records:
+#     time (float64, seconds since the start of the recording)
+#     event type (uint8) and 3 bytes of padding
+#     values (5 float32): the pose (C, gantry, wag, table, zoom) for pose, shot and
+#         collect events, the raw controller values for input events
+#     value (float32): event specific, e.g. the shot number of a shot event or the
+#         field of view of a field of view event
+#
+# Version 1 recordings stored value as an int32, ReadRecording converts them.
+#
+
+RecordingMagic = b'CARMREC1'
+RecordingVersion = 2
+HeaderStruct = struct.Struct('<8sII')
+RecordStruct = struct.Struct('<dB3x5ff')
+
+EventPose = 1
+EventShot = 2
+EventCollect = 3
+EventInput = 4
+EventFieldOfView = 5
+
+RecordDType = np.dtype([
+    ('time', '<f8'),
+    ('type', 'u1'),
+    ('padding', 'V3'),
+    ('values', '<f4', (5,)),
+    ('value', '<f4'),
+])
+RecordDTypeVersion1 = np.dtype([
+    ('time', '<f8'),
+    ('type', 'u1'),
+    ('padding', 'V3'),
+    ('values', '<f4', (5,)),
+    ('value', '<i4'),
+])
+
+
+class CarmSimulatorPoseRecorder:
+    """Append-only recording of pose changes, shots and VR input events.
+
+    Record*() only packs the event into a preallocated ring buffer, a background
+    thread appends the buffered records to the file every flushInterval seconds.
+    Events that arrive while the ring is full are counted as dropped.
+    """
+
+    def __init__(self, path, capacity=65536, flushInterval=0.25):
+        self.path = path
+        self.capacity = capacity
+        self.flushInterval = flushInterval
+        self.ring = bytearray(capacity * RecordStruct.size)
+
+        # Only the recording thread advances writeCount, only the flush thread advances flushCount
+        self.writeCount = 0
+        self.flushCount = 0
+        self.droppedCount = 0
+        self.flushedBytes = 0
+        self.startTime = None
+        self.file = None
+        self.thread = None
+        self.stopEvent = threading.Event()
+
+    def Start(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(HeaderStruct.pack(RecordingMagic, RecordingVersion, RecordStruct.size))
+        self.startTime = time.perf_counter()
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.Run, name="CarmSimulatorPoseRecorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+        self.file = None
+
+    def IsRecording(self):
+        return self.thread is not None
+
+    def RecordEvent(self, eventType, values, value=0):
+        if self.thread is None:
+            return
+        if self.writeCount - self.flushCount >= self.capacity:
+            self.droppedCount += 1
+            return
+        offset = (self.writeCount % self.capacity) * RecordStruct.size
+        RecordStruct.pack_into(self.ring, offset, time.perf_counter() - self.startTime, eventType,
+                               values[0], values[1], values[2], values[3], values[4], value)
+        self.writeCount += 1
+
+    def RecordPose(self, pose):
+        self.RecordEvent(EventPose, pose)
+
+    def RecordShot(self, pose, shotNumber):
+        self.RecordEvent(EventShot, pose, shotNumber)
+
+    def RecordCollect(self, pose):
+        self.RecordEvent(EventCollect, pose)
+
+    def RecordInput(self, inputValues, direction=0):
+        # inputValues: trackpad x, trackpad y, device, input and action of the controller event
+        self.RecordEvent(EventInput, inputValues, direction)
+
+    def RecordFieldOfView(self, pose, fieldOfView):
+        self.RecordEvent(EventFieldOfView, pose, fieldOfView)
+
+    def Run(self):
+        while not self.stopEvent.wait(self.flushInterval):
+            self.Flush()
+        self.Flush()
+
+    def Flush(self):
+        # Flush thread: append the records written since the last flush
+        writeCount = self.writeCount
+        start = self.flushCount % self.capacity
+        count = writeCount - self.flushCount
+        if count == 0:
+            return
+        end = start + count
+        view = memoryview(self.ring)
+        if end <= self.capacity:
+            self.file.write(view[start * RecordStruct.size:end * RecordStruct.size])
+        else:
+            self.file.write(view[start * RecordStruct.size:])
+            self.file.write(view[:(end - self.capacity) * RecordStruct.size])
+        self.file.flush()
+        self.flushedBytes += count * RecordStruct.size
+        self.flushCount = writeCount
+
+    def GetStatistics(self):
+        return {
+            "recorded": self.writeCount,
+            "flushed": self.flushCount,
+            "dropped": self.droppedCount,
+            "bytes": self.flushedBytes + HeaderStruct.size,
+        }
+
+
+def ReadRecording(path):
+    # Structured array of the records, with fields time, type, values and value
+    with open(path, 'rb') as f:
+        magic, version, recordSize = HeaderStruct.unpack(f.read(HeaderStruct.size))
+    if magic != RecordingMagic or recordSize != RecordStruct.size or version not in (1, RecordingVersion):
+        raise ValueError("Not a C-arm simulator recording: " + path)
+    # A recording cut short may end with a partial record, which fromfile drops
+    if version == 1:
+        return np.fromfile(path, dtype=RecordDTypeVersion1, offset=HeaderStruct.size).astype(RecordDType)
+    return np.fromfile(path, dtype=RecordDType, offset=HeaderStruct.size)
+
+
+class CarmSimulatorReplay:
+    """Plays recorded events back through callbacks keyed by event type.
+
+    Step(elapsed) applies every event up to elapsed seconds into the recording,
+    so driving it from a timer replays at real time. Run() replays without
+    waiting, as fast as the callbacks allow.
+    """
+
+    def __init__(self, events, callbacks):
+        self.events = events
+        self.callbacks = callbacks
+        self.index = 0
+        self.appliedCount = 0
+
+    def GetDuration(self):
+        if len(self.events) == 0:
+            return 0.0
+        return float(self.events['time'][-1])
+
+    def IsFinished(self):
+        return self.index >= len(self.events)
+
+    def Apply(self, event):
+        callback = self.callbacks.get(int(event['type']))
+        if callback is not None:
+            callback(event['values'].astype(np.float64), float(event['value']))
+            self.appliedCount += 1
+
+    def Step(self, elapsed):
+        # Apply the events due at elapsed seconds, returns how many were due
+        end = int(np.searchsorted(self.events['time'], elapsed, side='right'))
+        for index in range(self.index, end):
+            self.Apply(self.events[index])
+        count = max(end - self.index, 0)
+        self.index = max(end, self.index)
+        return count
+
+    def Run(self, realTime=False):
+        # Blocking replay of the remaining events, returns the seconds it took
+        startTime = time.perf_counter()
+        offset = float(self.events['time'][self.index]) if not self.IsFinished() else 0.0
+        while not self.IsFinished():
+            if realTime:
+                delay = float(self.events['time'][self.index]) - offset - (time.perf_counter() - startTime)
+                if delay > 0:
+                    time.sleep(delay)
+            self.Apply(self.events[self.index])
+            self.index += 1
+        return time.perf_counter() - startTime
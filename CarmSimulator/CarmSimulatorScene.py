@@ -1,5 +1,37 @@
 import vtk, qt, ctk, slicer
+import collections
+import logging
 import os
+import time
+from CarmSimulatorSceneBundle import CarmSimulatorSceneBundle
+from CarmSimulatorCore import LumbarSpineVolumeName, ScoliosisVolumeName
+
+# Models loaded by GenerateScene: node name, file in Resources, color, opacity, parent transform, attribute
+SceneModels = [
+    ("C", "C.stl", (0.91, 0.91, 0.91), 1.0, "CTransform", "cModel"),
+    ("Cone", "Cone.stl", (1, 0, 0), 0.5, "ConeTransform", "coneModel"),
+    ("GantryV3", "GantryV3.stl", (0.79, 0.79, 0.79), 1.0, "GantryTransform", "gantryModel"),
+    ("Floor", "Floor.stl", (1, 1, 1), 1.0, "FloorTransform", "floorModel"),
+    ("FluoroDisplayV2", "FluoroDisplayV2.stl", (0.5, 0.5, 0.5), 1.0, "FluoroDisplayTransform", "fluoroDisplayModel"),
+    ("HumanMesh", "HumanMesh2.stl", (0.7, 0.48, 0.4), 1.0, "SurfaceMeshTransform", "surfaceMesh"),
+    ("Stanless steel table", "Stanless steel table.stl", (0.5, 0.5, 0.5), 1.0, "TableZTranslation", "tableModel"),
+    ("Support", "Support.stl", (0.96, 0.96, 0.96), 1.0, "WagTransform", "supportModel"),
+]
+
+# Transforms loaded by GenerateScene: node name, file in Resources, parent transform, attribute
+SceneTransforms = [
+    ("CTransform", "CTransform.h5", "GantryTransform", "cTransform"),
+    ("ConeTransform", "ConeTransform.h5", "CTransform", "coneTransform"),
+    ("GantryTransform", "GantryTransform.h5", "WagTransform", "gantryTransform"),
+    ("DRRToMonitor", "DRRToMonitor.h5", "FluoroDisplayTransform", "dRRToMonitorTransform"),
+    ("FloorTransform", "FloorTransform.h5", "SceneTransform", "floorTransform"),
+    ("FluoroDisplayTransform", "FluoroDisplayTransform.h5", "SceneTransform", "fluoroDisplayTransform"),
+    ("SceneTransform", "SceneTransform.h5", None, "sceneTransform"),
+    ("TableTransform", "TableTransform.h5", "SceneTransform", "tableTransform"),
+    ("SurfaceMeshTransform", "SurfaceMeshTransform.h5", "TableZTranslation", "surfaceMeshTransform"),
+    ("TableZTranslation", "TableZTranslation.h5", "TableTransform", "tableZTranslation"),
+    ("WagTransform", "WagTransform.h5", "SceneTransform", "wagTransform"),
+]
 
 
 class CarmSimulatorScene:
@@ -22,192 +54,173 @@ class CarmSimulatorScene:
         self.tableTransform = None
         self.sceneTransform = None
         self.lumbarSpineVolume = None
+        self.volumePropertyNode = None
 
         self.imageLabelModelNode = None
 
+        # Precompiled copy of the scene assets, rebuilt when a resource file changes
+        self.useSceneBundle = True
+        self.bundlePath = os.path.join(slicer.app.cachePath, 'CarmSimulator', 'SceneBundle')
+        self.loadTimings = collections.OrderedDict()
+
         # self.fovPath = os.path.join(self.resourcePath, 'Resources\FieldOfViewMedium.png')
 
+    def GetResourceFile(self, fileName):
+        return os.path.join(self.resourcePath, 'Resources', fileName)
+
+    def GetBundleSourcePaths(self):
+        paths = [self.GetResourceFile(fileName) for name, fileName, color, opacity, parent, attribute in SceneModels]
+        paths += [self.GetResourceFile(fileName) for name, fileName, parent, attribute in SceneTransforms]
+        paths.append(self.GetResourceFile(LumbarSpineVolumeName + '.mha'))
+        return paths
+
+    def GetSceneHierarchy(self):
+        # Parent transform name of every model and transform of the tables
+        hierarchy = {name: parent for name, fileName, parent, attribute in SceneTransforms}
+        hierarchy.update({name: parent for name, fileName, color, opacity, parent, attribute in SceneModels})
+        return hierarchy
+
+    def FindSceneNodes(self):
+        # Nodes of the scene tables and the phantom that are in the scene already, by name
+        names = [name for name, fileName, color, opacity, parent, attribute in SceneModels]
+        names += [name for name, fileName, parent, attribute in SceneTransforms]
+        names.append(LumbarSpineVolumeName)
+        nodes = {}
+        for name in names:
+            try:
+                nodes[name] = slicer.util.getNode(name)
+            except:
+                pass
+        return nodes
+
     def GenerateScene(self):
+        sceneStartTime = time.perf_counter()
+        self.loadTimings = collections.OrderedDict()
+
+        # Nodes in the scene already are kept, only the missing ones are loaded
+        existingNodes = self.FindSceneNodes()
+        missingNodes = len(SceneModels) + len(SceneTransforms) + 1 - len(existingNodes)
+        loadedFromFiles = not existingNodes
+
+        # Use the scene bundle if it matches the resources, it is rebuilt below otherwise
+        bundle = CarmSimulatorSceneBundle(self.bundlePath)
+        bundleModels = None
+        hierarchy = self.GetSceneHierarchy()
+        if missingNodes and self.useSceneBundle and bundle.IsValid(self.GetBundleSourcePaths()):
+            bundleModels, bundleTransforms, hierarchy, bundleVolumes, bundleTimings = bundle.Load()
+            for name, seconds in bundleTimings.items():
+                self.loadTimings[name + " (bundle)"] = seconds
 
         # Load in models from resources folder if they are not in the scene already
-        try:
-            self.cModel = slicer.util.getNode("C")
-        except:
-            self.cModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/C.stl'))
-            self.cModel.GetDisplayNode().SetColor(0.91, 0.91, 0.91)
-        self.cModel.SetSelectable(False)
-
-        try:
-            self.coneModel = slicer.util.getNode("Cone")
-        except:
-            self.coneModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/Cone.stl'))
-            self.coneModel.GetDisplayNode().SetColor(1,0,0)
-            self.coneModel.GetDisplayNode().SetOpacity(0.5)
-        self.coneModel.SetSelectable(False)
-
-
-        try:
-            self.gantryModel = slicer.util.getNode("GantryV3")
-        except:
-            self.gantryModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/GantryV3.stl'))
-            self.gantryModel.GetDisplayNode().SetColor(0.79, 0.79, 0.79)
-        self.gantryModel.SetSelectable(False)
-
-        try:
-            self.floorModel = slicer.util.getNode("Floor")
-        except:
-            self.floorModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/Floor.stl'))
-            self.floorModel.GetDisplayNode().SetColor(1, 1, 1)
-        self.floorModel.SetSelectable(False)
-
-        try:
-            self.fluoroDisplayModel = slicer.util.getNode("FluoroDisplayV2")
-        except:
-            self.fluoroDisplayModel = slicer.util.loadModel(
-                os.path.join(self.resourcePath, 'Resources/FluoroDisplayV2.stl'))
-            self.fluoroDisplayModel.GetDisplayNode().SetColor(0.5, 0.5, 0.5)
-        self.fluoroDisplayModel.SetSelectable(False)
-
-        try:
-            self.surfaceMesh = slicer.util.getNode("HumanMesh")
-        except:
-            self.surfaceMesh = slicer.util.loadModel(
-                os.path.join(self.resourcePath, 'Resources/HumanMesh2.stl'))
-            self.surfaceMesh.GetDisplayNode().SetColor(0.7, 0.48, 0.4)
-        self.surfaceMesh.SetSelectable(False)
-
-        try:
-            self.tableModel = slicer.util.getNode("Stanless steel table")
-        except:
-            self.tableModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/Stanless steel table.stl'))
-            self.tableModel.GetDisplayNode().SetColor(0.5, 0.5, 0.5)
-        self.tableModel.SetSelectable(False)
-
-        try:
-            self.supportModel = slicer.util.getNode("Support")
-        except:
-            self.supportModel = slicer.util.loadModel(os.path.join(self.resourcePath, 'Resources/Support.stl'))
-            self.supportModel.GetDisplayNode().SetColor(0.96, 0.96, 0.96)
-        self.supportModel.SetSelectable(False)
+        for name, fileName, color, opacity, parent, attribute in SceneModels:
+            startTime = time.perf_counter()
+            model = existingNodes.get(name)
+            if model is None:
+                if bundleModels is not None:
+                    model = slicer.modules.models.logic().AddModel(bundleModels[name])
+                else:
+                    model = slicer.util.loadModel(self.GetResourceFile(fileName))
+                model.SetName(name)
+                model.GetDisplayNode().SetColor(*color)
+                model.GetDisplayNode().SetOpacity(opacity)
+            model.SetSelectable(False)
+            setattr(self, attribute, model)
+            self.loadTimings[name] = time.perf_counter() - startTime
 
         # Load in transforms if they are not already in the scene
-        try:
-            self.cTransform = slicer.util.getNode("CTransform")
-        except:
-            self.cTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/CTransform.h5'))
-
-
-        try:
-            self.coneTransform = slicer.util.getNode("ConeTransform")
-        except:
-            self.coneTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/ConeTransform.h5'))
+        for name, fileName, parent, attribute in SceneTransforms:
+            startTime = time.perf_counter()
+            transform = existingNodes.get(name)
+            if transform is None:
+                if bundleModels is not None:
+                    transform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', name)
+                    slicer.util.updateTransformMatrixFromArray(transform, bundleTransforms[name])
+                else:
+                    transform = slicer.util.loadTransform(self.GetResourceFile(fileName))
+                    transform.SetName(name)
+            setattr(self, attribute, transform)
+            self.loadTimings[name] = time.perf_counter() - startTime
+
+        # Set up transform hierarchy, as stored in the bundle when it was loaded
+        transformNodes = {name: getattr(self, attribute) for name, fileName, parent, attribute in SceneTransforms}
+        for name, fileName, parent, attribute in SceneTransforms:
+            if hierarchy[name] is not None:
+                transformNodes[name].SetAndObserveTransformNodeID(transformNodes[hierarchy[name]].GetID())
+        for name, fileName, color, opacity, parent, attribute in SceneModels:
+            getattr(self, attribute).SetAndObserveTransformNodeID(transformNodes[hierarchy[name]].GetID())
 
-        try:
-            self.gantryTransform = slicer.util.getNode("GantryTransform")
-        except:
-            self.gantryTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/GantryTransform.h5'))
-
-        try:
-            self.dRRToMonitorTransform = slicer.util.getNode("DRRToMonitor")
-        except:
-            self.dRRToMonitorTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/DRRToMonitor.h5'))
-
-        try:
-            self.floorTransform = slicer.util.getNode("FloorTransform")
-        except:
-            self.floorTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/FloorTransform.h5'))
-
-        try:
-            self.fluoroDisplayTransform = slicer.util.getNode("FluoroDisplayTransform")
-        except:
-            self.fluoroDisplayTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/FluoroDisplayTransform.h5'))
-
-        try:
-            self.sceneTransform = slicer.util.getNode("SceneTransform")
-        except:
-            self.sceneTransform = slicer.util.loadTransform(os.path.join(self.resourcePath, 'Resources/SceneTransform.h5'))
-
-        try:
-            self.tableTransform = slicer.util.getNode("TableTransform")
-        except:
-            self.tableTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/TableTransform.h5'))
-
-        try:
-            self.surfaceMeshTransform = slicer.util.getNode("SurfaceMeshTransform")
-        except:
-            self.surfaceMeshTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/SurfaceMeshTransform.h5'))
+        # Load volume and set transfer function if not in scene already
+        startTime = time.perf_counter()
+        self.lumbarSpineVolume = existingNodes.get(LumbarSpineVolumeName)
+        if self.lumbarSpineVolume is None:
+            if bundleModels is not None:
+                voxels, ijkToRAS = bundleVolumes[LumbarSpineVolumeName]
+                self.lumbarSpineVolume = slicer.util.addVolumeFromArray(voxels, ijkToRAS, LumbarSpineVolumeName)
+            else:
+                self.lumbarSpineVolume = slicer.util.loadVolume(self.GetResourceFile(LumbarSpineVolumeName + '.mha'))
+            self.SetUpVolumeRendering(self.lumbarSpineVolume)
+        self.loadTimings[LumbarSpineVolumeName] = time.perf_counter() - startTime
 
-        try:
-            self.tableZTranslation = slicer.util.getNode("TableZTranslation")
-        except:
-            self.tableZTranslation = slicer.util.loadTransform(os.path.join(self.resourcePath, 'Resources/TableZTranslation.h5'))
+        self.CreatePlaneModel(678,2550)
+        #self.CreatePlaneModel(200,1000)
 
+        # Build the bundle from a scene freshly loaded from the resource files
+        if self.useSceneBundle and bundleModels is None and loadedFromFiles:
+            startTime = time.perf_counter()
+            self.WriteSceneBundle(bundle)
+            self.loadTimings["Write scene bundle"] = time.perf_counter() - startTime
+
+        self.loadTimings["Total"] = time.perf_counter() - sceneStartTime
+
+    def WriteSceneBundle(self, bundle):
+        transforms = {}
+        for name, fileName, parent, attribute in SceneTransforms:
+            transform = getattr(self, attribute)
+            if not transform.IsLinear():
+                logging.warning("Scene bundle not written, " + name + " is not a linear transform")
+                return
+            transforms[name] = slicer.util.arrayFromTransformMatrix(transform)
+        hierarchy = self.GetSceneHierarchy()
+        models = {name: getattr(self, attribute).GetPolyData()
+                  for name, fileName, color, opacity, parent, attribute in SceneModels}
+        ijkToRAS = vtk.vtkMatrix4x4()
+        self.lumbarSpineVolume.GetIJKToRASMatrix(ijkToRAS)
+        volumes = {LumbarSpineVolumeName: (slicer.util.arrayFromVolume(self.lumbarSpineVolume),
+                                           slicer.util.arrayFromVTKMatrix(ijkToRAS))}
         try:
-            self.wagTransform = slicer.util.getNode("WagTransform")
-        except:
-            self.wagTransform = slicer.util.loadTransform(
-                os.path.join(self.resourcePath, 'Resources/WagTransform.h5'))
-
-
-        # Set up transform hierarchy
-        self.cTransform.SetAndObserveTransformNodeID(self.gantryTransform.GetID())
-        self.coneModel.SetAndObserveTransformNodeID(self.coneTransform.GetID())
-        self.coneTransform.SetAndObserveTransformNodeID(self.cTransform.GetID())
-        self.tableTransform.SetAndObserveTransformNodeID(self.sceneTransform.GetID())
-        self.surfaceMeshTransform.SetAndObserveTransformNodeID(self.tableZTranslation.GetID())
-        self.fluoroDisplayTransform.SetAndObserveTransformNodeID(self.sceneTransform.GetID())
-        self.gantryTransform.SetAndObserveTransformNodeID(self.wagTransform.GetID())
-        self.dRRToMonitorTransform.SetAndObserveTransformNodeID(self.fluoroDisplayTransform.GetID())
-        self.wagTransform.SetAndObserveTransformNodeID(self.sceneTransform.GetID())
-        self.floorTransform.SetAndObserveTransformNodeID(self.sceneTransform.GetID())
-        self.tableZTranslation.SetAndObserveTransformNodeID(self.tableTransform.GetID())
-
-        self.supportModel.SetAndObserveTransformNodeID(self.wagTransform.GetID())
-        self.cModel.SetAndObserveTransformNodeID(self.cTransform.GetID())
-        self.floorModel.SetAndObserveTransformNodeID(self.floorTransform.GetID())
-        self.fluoroDisplayModel.SetAndObserveTransformNodeID(self.fluoroDisplayTransform.GetID())
-        self.gantryModel.SetAndObserveTransformNodeID(self.gantryTransform.GetID())
-        self.surfaceMesh.SetAndObserveTransformNodeID(self.surfaceMeshTransform.GetID())
-        self.tableModel.SetAndObserveTransformNodeID(self.tableZTranslation.GetID())
-
-
-        # Load volume and set transfer function if not in scene already
+            bundle.Write(models, transforms, hierarchy, volumes, self.GetBundleSourcePaths())
+        except (IOError, OSError) as error:
+            logging.warning("Could not write scene bundle: " + str(error))
+
+    def GetLoadTimingReport(self):
+        return "\n".join("%-30s %8.1f ms" % (name, seconds * 1000.0) for name, seconds in self.loadTimings.items())
+
+    def SetUpVolumeRendering(self, volumeNode):
+        logic = slicer.modules.volumerendering.logic()
+        logic.CreateDefaultVolumeRenderingNodes(volumeNode)
+        # All cases share one transfer function, parse the .vp file only once
+        if self.volumePropertyNode is None or not slicer.mrmlScene.IsNodePresent(self.volumePropertyNode):
+            self.volumePropertyNode = logic.AddVolumePropertyFromFile(self.GetResourceFile('VolumeProperty.vp'))
+        volumeNode.GetNthDisplayNode(1).SetAndObserveVolumePropertyNodeID(self.volumePropertyNode.GetID())
+        volumeNode.SetDisplayVisibility(1)
+
+    def CreateCaseVolume(self, name, voxels, ijkToRAS):
+        # Volume node of a case library entry, kept hidden until the case is shown
         try:
-            self.lumbarSpineVolume = slicer.util.getNode("LumbarSpinePhantom_CT")
+            volumeNode = slicer.util.getNode(name)
         except:
-            self.lumbarSpineVolume = slicer.util.loadVolume(
-                os.path.join(self.resourcePath, 'Resources\LumbarSpinePhantom_CT.mha'))
-            logic = slicer.modules.volumerendering.logic()
-            slicer.modules.volumerendering.logic().CreateDefaultVolumeRenderingNodes(self.lumbarSpineVolume)
-            volumeProp = logic.AddVolumePropertyFromFile(
-                os.path.join(self.resourcePath, 'Resources\VolumeProperty.vp'))
-            self.lumbarSpineVolume.GetNthDisplayNode(1).SetAndObserveVolumePropertyNodeID(volumeProp.GetID())
-            self.lumbarSpineVolume.SetDisplayVisibility(1)
-
-        self.CreatePlaneModel(678,2550)
-        #self.CreatePlaneModel(200,1000)
+            volumeNode = slicer.util.addVolumeFromArray(voxels, ijkToRAS, name)
+            self.SetUpVolumeRendering(volumeNode)
+        volumeNode.SetDisplayVisibility(0)
+        return volumeNode
 
     def loadScoliosisCT(self):
         # Load Scoliosis volume and set transfer function
         try:
-            self.lumbarSpineVolume = slicer.util.getNode("LumbarSpineScoliosis_CT")
+            self.lumbarSpineVolume = slicer.util.getNode(ScoliosisVolumeName)
         except:
-            self.lumbarSpineVolume = slicer.util.loadVolume(
-                os.path.join(self.resourcePath, 'Resources\LumbarSpineScoliosis_CT.mha'))
-            logic = slicer.modules.volumerendering.logic()
-            slicer.modules.volumerendering.logic().CreateDefaultVolumeRenderingNodes(self.lumbarSpineVolume)
-            volumeProp = logic.AddVolumePropertyFromFile(
-                os.path.join(self.resourcePath, 'Resources\VolumeProperty.vp'))
-            self.lumbarSpineVolume.GetNthDisplayNode(1).SetAndObserveVolumePropertyNodeID(volumeProp.GetID())
-            self.lumbarSpineVolume.SetDisplayVisibility(1)
+            self.lumbarSpineVolume = slicer.util.loadVolume(self.GetResourceFile(ScoliosisVolumeName + '.mha'))
+            self.SetUpVolumeRendering(self.lumbarSpineVolume)
 
     def CreatePlaneModel(self, width, height):
         # Create Instruction Transform Node if not in scene already
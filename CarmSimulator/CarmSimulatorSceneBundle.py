@@ -0,0 +1,184 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+#
+# Scene Bundle
+#
+# A directory holding the scene geometry as .npy arrays plus a manifest with the
+# transform matrices and hierarchy. The manifest records a
+# content hash of the source files so a changed resource invalidates the bundle.
+#
+
+BundleVersion = 1
+
+
+def ComputeSourceSignature(paths):
+    # Cheap check (size and modification time) used to skip hashing when nothing changed
+    signature = {}
+    for path in paths:
+        status = os.stat(path)
+        signature[os.path.basename(path)] = [status.st_size, status.st_mtime_ns]
+    return signature
+
+
+def ComputeContentHash(paths):
+    contentHash = hashlib.sha1()
+    for path in sorted(paths, key=os.path.basename):
+        contentHash.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                contentHash.update(block)
+    return contentHash.hexdigest()
+
+
+class CarmSimulatorSceneBundle:
+    """Reads and writes the precompiled scene bundle in bundlePath."""
+
+    def __init__(self, bundlePath):
+        self.bundlePath = bundlePath
+        self.manifestPath = os.path.join(bundlePath, 'manifest.json')
+
+    def ReadManifest(self):
+        try:
+            with open(self.manifestPath) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if manifest.get("version") != BundleVersion:
+            return None
+        return manifest
+
+    def IsValid(self, sourcePaths):
+        manifest = self.ReadManifest()
+        if manifest is None:
+            return False
+        if not all(os.path.exists(path) for path in sourcePaths):
+            return False
+        signature = ComputeSourceSignature(sourcePaths)
+        if signature == manifest["sourceSignature"]:
+            return True
+
+        # Files were touched, only rebuild if their content actually changed
+        if ComputeContentHash(sourcePaths) != manifest["contentHash"]:
+            return False
+        manifest["sourceSignature"] = signature
+        with open(self.manifestPath, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return True
+
+    def Write(self, models, transforms, hierarchy, volumes, sourcePaths):
+        """Write a new bundle.
+
+        models maps node name to vtkPolyData, transforms maps node name to a 4x4
+        matrix to parent, hierarchy maps model and transform names to their parent
+        transform name and volumes maps node name to (voxels, ijkToRAS).
+        """
+        temporaryPath = self.bundlePath + '.tmp'
+        shutil.rmtree(temporaryPath, ignore_errors=True)
+        os.makedirs(temporaryPath)
+
+        manifest = {
+            "version": BundleVersion,
+            "contentHash": ComputeContentHash(sourcePaths),
+            "sourceSignature": ComputeSourceSignature(sourcePaths),
+            "models": {},
+            "transforms": {},
+            "hierarchy": dict(hierarchy),
+            "volumes": {},
+        }
+        for index, (name, polyData) in enumerate(models.items()):
+            prefix = 'model%02d_' % index
+            arrays = {
+                "points": numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()),
+                "offsets": numpy_support.vtk_to_numpy(polyData.GetPolys().GetOffsetsArray()),
+                "connectivity": numpy_support.vtk_to_numpy(polyData.GetPolys().GetConnectivityArray()),
+            }
+            normals = polyData.GetPointData().GetNormals()
+            if normals is not None:
+                arrays["normals"] = numpy_support.vtk_to_numpy(normals)
+            manifest["models"][name] = {}
+            for arrayName, array in arrays.items():
+                fileName = prefix + arrayName + '.npy'
+                np.save(os.path.join(temporaryPath, fileName), np.ascontiguousarray(array))
+                manifest["models"][name][arrayName] = fileName
+
+        for name, matrix in transforms.items():
+            manifest["transforms"][name] = np.asarray(matrix, dtype=np.float64).ravel().tolist()
+
+        for index, (name, (voxels, ijkToRAS)) in enumerate(volumes.items()):
+            fileName = 'volume%02d.npy' % index
+            np.save(os.path.join(temporaryPath, fileName), np.ascontiguousarray(voxels))
+            manifest["volumes"][name] = {
+                "voxels": fileName,
+                "ijkToRAS": np.asarray(ijkToRAS, dtype=np.float64).ravel().tolist(),
+            }
+
+        with open(os.path.join(temporaryPath, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+        # Swap the finished bundle into place
+        shutil.rmtree(self.bundlePath, ignore_errors=True)
+        os.rename(temporaryPath, self.bundlePath)
+
+    def LoadPolyData(self, files):
+        # Read into memory rather than mapped, every point is read when the model is first rendered anyway
+        def Load(key):
+            return np.load(os.path.join(self.bundlePath, files[key]))
+
+        polyData = vtk.vtkPolyData()
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(Load("points")))
+        polyData.SetPoints(points)
+
+        cells = vtk.vtkCellArray()
+        offsets = numpy_support.numpy_to_vtk(Load("offsets"), array_type=vtk.VTK_ID_TYPE)
+        connectivity = numpy_support.numpy_to_vtk(Load("connectivity"), array_type=vtk.VTK_ID_TYPE)
+        cells.SetData(offsets, connectivity)
+        polyData.SetPolys(cells)
+
+        if "normals" in files:
+            normals = numpy_support.numpy_to_vtk(Load("normals"))
+            normals.SetName("Normals")
+            polyData.GetPointData().SetNormals(normals)
+        return polyData
+
+    def LoadVolume(self, entry):
+        voxels = np.load(os.path.join(self.bundlePath, entry["voxels"]))
+        return voxels, np.array(entry["ijkToRAS"]).reshape(4, 4)
+
+    def Load(self, numberOfThreads=None):
+        """Load every asset of the bundle, independent assets in parallel.
+
+        Each model is read and built into a vtkPolyData, and each volume read, on
+        its own pool thread; file reads release the GIL, so the reads overlap.
+
+        Returns models (name -> vtkPolyData), transforms (name -> 4x4 array), the
+        hierarchy (name -> parent transform name), volumes (name -> (voxels, ijkToRAS))
+        and the load time in seconds of each asset.
+        """
+        manifest = self.ReadManifest()
+        timings = {}
+
+        def Timed(name, function, *args):
+            startTime = time.perf_counter()
+            result = function(*args)
+            timings[name] = time.perf_counter() - startTime
+            return name, result
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+            modelFutures = [executor.submit(Timed, name, self.LoadPolyData, files)
+                            for name, files in manifest["models"].items()]
+            volumeFutures = [executor.submit(Timed, name, self.LoadVolume, entry)
+                             for name, entry in manifest["volumes"].items()]
+            models = dict(future.result() for future in modelFutures)
+            volumes = dict(future.result() for future in volumeFutures)
+
+        transforms = {name: np.array(values).reshape(4, 4) for name, values in manifest["transforms"].items()}
+        return models, transforms, manifest["hierarchy"], volumes, timings
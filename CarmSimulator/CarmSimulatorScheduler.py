@@ -0,0 +1,93 @@
+import collections
+import time
+import qt
+
+#
+# DRR Update Scheduler
+#
+
+
+class CarmSimulatorDRRScheduler:
+    """Coalesces DRR update requests so at most one DRR is rendered per display frame.
+
+    Pose changes from the sliders, VR callbacks and the motion timer call Request(),
+    which only marks the DRR dirty. A single-shot timer renders once the frame
+    interval for targetRate has elapsed since the previous render.
+    """
+
+    def __init__(self, renderCallback, targetRate=30.0):
+        self.renderCallback = renderCallback
+        self.targetRate = targetRate
+        self.dirty = False
+        self.lastRenderTime = None
+
+        self.requestCount = 0
+        self.renderCount = 0
+        self.mergedCount = 0
+        self.droppedCount = 0
+        self.recentRenderTimes = collections.deque(maxlen=60)
+
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.connect('timeout()', self.OnTimeout)
+
+    def SetTargetRate(self, targetRate):
+        self.targetRate = targetRate
+
+    def Request(self):
+        self.requestCount += 1
+        if self.dirty:
+            # Already waiting for the next frame, this change is rendered with it
+            self.mergedCount += 1
+            return
+        self.dirty = True
+
+        delay = 0
+        if self.lastRenderTime is not None and self.targetRate > 0:
+            remaining = 1.0 / self.targetRate - (time.perf_counter() - self.lastRenderTime)
+            delay = max(0, int(remaining * 1000))
+        self.timer.start(delay)
+
+    def OnTimeout(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.lastRenderTime = time.perf_counter()
+        self.recentRenderTimes.append(self.lastRenderTime)
+        self.renderCount += 1
+        self.renderCallback()
+
+    def Flush(self):
+        # Render a pending update immediately
+        self.timer.stop()
+        self.OnTimeout()
+
+    def Cancel(self):
+        # Drop a pending update, e.g. when the DRR is hidden before the frame is due
+        self.timer.stop()
+        if self.dirty:
+            self.droppedCount += 1
+        self.dirty = False
+
+    def GetStatistics(self):
+        # Render rate over the last recentRenderTimes renders
+        achievedRate = 0.0
+        if len(self.recentRenderTimes) > 1:
+            span = self.recentRenderTimes[-1] - self.recentRenderTimes[0]
+            achievedRate = (len(self.recentRenderTimes) - 1) / max(span, 1e-9)
+        return {
+            "targetRate": self.targetRate,
+            "requests": self.requestCount,
+            "renders": self.renderCount,
+            "merged": self.mergedCount,
+            "dropped": self.droppedCount,
+            "pending": self.dirty,
+            "achievedRate": achievedRate,
+        }
+
+    def ResetStatistics(self):
+        self.requestCount = 0
+        self.renderCount = 0
+        self.mergedCount = 0
+        self.droppedCount = 0
+        self.recentRenderTimes.clear()
@@ -0,0 +1,152 @@
+import time
+import numpy as np
+
+#
+# Target View Scoring
+#
+# Compares the monitor image with a reference image of the view the trainee is
+# asked to collect. Both are reduced to a small grayscale pyramid; on every
+# level the normalized cross correlation of the intensities and of the gradient
+# magnitudes is computed. Reference features are computed once per reference, a
+# frame costs two small matrix products per level and a few dot products.
+#
+
+# Approximate poses (C, gantry, wag, table, zoom) of the StartModule target views, at the
+# zoom the module is trained with, used to render the reference images when no reference file is given
+TargetViewPoses = {
+    "Full AP": [0.0, 0.0, 0.0, 0.0, 27.0],
+    "Full Lateral": [90.0, 0.0, 0.0, 0.0, 27.0],
+    "Left Scotty Dog": [35.0, 0.0, 0.0, 0.0, 27.0],
+}
+
+
+def ResizeMatrix(inputSize, outputSize):
+    # (outputSize, inputSize) matrix averaging the input samples each output sample covers
+    edges = np.linspace(0.0, inputSize, outputSize + 1)
+    starts = np.arange(inputSize)
+    overlap = np.minimum(edges[1:, np.newaxis], starts + 1.0) - np.maximum(edges[:-1, np.newaxis], starts)
+    weights = np.clip(overlap, 0.0, None)
+    return (weights / weights.sum(axis=1)[:, np.newaxis]).astype(np.float32)
+
+
+def ToGrayscale(image):
+    image = np.asarray(image)
+    if image.ndim == 3:
+        # Alpha, if any, is ignored
+        return image[:, :, :3].mean(axis=2, dtype=np.float32)
+    return image.astype(np.float32)
+
+
+def GradientMagnitude(image):
+    # Central differences, one sided at the borders
+    gradientY = np.empty_like(image)
+    gradientX = np.empty_like(image)
+    gradientY[1:-1] = (image[2:] - image[:-2]) * 0.5
+    gradientY[0] = image[1] - image[0]
+    gradientY[-1] = image[-1] - image[-2]
+    gradientX[:, 1:-1] = (image[:, 2:] - image[:, :-2]) * 0.5
+    gradientX[:, 0] = image[:, 1] - image[:, 0]
+    gradientX[:, -1] = image[:, -1] - image[:, -2]
+    return np.sqrt(gradientX * gradientX + gradientY * gradientY)
+
+
+def Normalize(values):
+    # Zero mean, unit length vector, so a dot product is the correlation coefficient
+    values = values.ravel() - values.mean()
+    norm = np.linalg.norm(values)
+    if norm < 1e-6:
+        return np.zeros_like(values)
+    return values / norm
+
+
+def ReadReferenceImage(path):
+    # PNG as a (rows, columns, channels) array with row 0 at the bottom, as drrPixels
+    import vtk
+    from vtk.util import numpy_support
+    reader = vtk.vtkPNGReader()
+    reader.SetFileName(path)
+    reader.Update()
+    columns, rows = reader.GetOutput().GetDimensions()[:2]
+    pixels = numpy_support.vtk_to_numpy(reader.GetOutput().GetPointData().GetScalars())
+    return pixels.reshape(rows, columns, -1)
+
+
+class CarmSimulatorTargetScorer:
+    """Live similarity of the monitor image to reference images of the target views.
+
+    Images are (rows, columns) or (rows, columns, channels) arrays with row 0 at
+    the bottom, as drrPixels. Score() returns the intensity correlation, the
+    gradient correlation and a combined score from 0 to 100.
+    """
+
+    def __init__(self, width=132, height=84, numberOfLevels=2):
+        # Working size of the finest pyramid level, each further level is half the size
+        self.width = width
+        self.height = height
+        self.numberOfLevels = numberOfLevels
+        self.gradientWeight = 0.5
+
+        self.references = {}
+        self.resizeMatrices = {}
+
+        self.scoredFrames = 0
+        self.scoreTime = 0.0
+
+    def GetResizeMatrices(self, shape):
+        # Row and column resize matrices per level for images of this shape, built once
+        matrices = self.resizeMatrices.get(shape)
+        if matrices is None:
+            matrices = []
+            for level in range(self.numberOfLevels):
+                width = max(self.width >> level, 2)
+                height = max(self.height >> level, 2)
+                matrices.append((ResizeMatrix(shape[0], height), ResizeMatrix(shape[1], width).T.copy()))
+            self.resizeMatrices[shape] = matrices
+        return matrices
+
+    def ComputeFeatures(self, image):
+        # Normalized intensity and gradient magnitude vectors of every pyramid level of a grayscale image
+        image = image.astype(np.float32)
+        features = []
+        for rows, columns in self.GetResizeMatrices(image.shape[:2]):
+            resized = rows.dot(image).dot(columns)
+            features.append((Normalize(resized), Normalize(GradientMagnitude(resized))))
+        return features
+
+    def SetReference(self, label, image):
+        self.references[label] = self.ComputeFeatures(ToGrayscale(image))
+
+    def HasReference(self, label):
+        return label in self.references
+
+    def RemoveAllReferences(self):
+        self.references = {}
+
+    def Score(self, label, image):
+        if label not in self.references:
+            return None
+        startTime = time.perf_counter()
+        image = np.asarray(image)
+        if image.ndim == 3:
+            # DRRs are gray, every channel holds the same value
+            image = image[:, :, 0]
+        features = self.ComputeFeatures(image)
+        reference = self.references[label]
+        intensity = np.mean([float(a.dot(b)) for (a, _), (b, _) in zip(features, reference)])
+        gradient = np.mean([float(a.dot(b)) for (_, a), (_, b) in zip(features, reference)])
+        combined = (1.0 - self.gradientWeight) * intensity + self.gradientWeight * gradient
+        self.scoreTime += time.perf_counter() - startTime
+        self.scoredFrames += 1
+        return {
+            "label": label,
+            "intensity": float(intensity),
+            "gradient": float(gradient),
+            "score": float(np.clip(combined, 0.0, 1.0) * 100.0),
+        }
+
+    def GetStatistics(self):
+        return {
+            "references": sorted(self.references),
+            "scoredFrames": self.scoredFrames,
+            "meanScoreTime": self.scoreTime / self.scoredFrames if self.scoredFrames else 0.0,
+        }
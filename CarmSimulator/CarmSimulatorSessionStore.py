@@ -0,0 +1,311 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import numpy as np
+
+#
+# Session Store
+#
+# Training results in a SQLite database: one row per session and one per
+# collected image. Rows are queued by the UI thread and written in batched
+# transactions by a writer thread. Analytics load the shot table into NumPy
+# columns once, then only fetch rows added since, and aggregate with sorting
+# and bincount instead of per row Python code.
+#
+
+SessionSchema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    trainee TEXT,
+    caseName TEXT,
+    startedAt REAL,
+    completed INTEGER DEFAULT 0,
+    totalShots INTEGER,
+    totalTime REAL,
+    doseAreaProduct REAL,
+    peakSkinDose REAL
+);
+CREATE TABLE IF NOT EXISTS shots (
+    id INTEGER PRIMARY KEY,
+    sessionId TEXT REFERENCES sessions(id),
+    imageIndex INTEGER,
+    label TEXT,
+    c REAL,
+    gantry REAL,
+    wag REAL,
+    tableTranslation REAL,
+    zoom REAL,
+    shotCount INTEGER,
+    elapsed REAL,
+    timeToTarget REAL,
+    score REAL,
+    angleError REAL,
+    tableError REAL
+);
+CREATE INDEX IF NOT EXISTS shotsSession ON shots(sessionId);
+CREATE INDEX IF NOT EXISTS shotsLabel ON shots(label);
+CREATE INDEX IF NOT EXISTS sessionsTrainee ON sessions(trainee);
+"""
+
+ShotColumns = ["id", "sessionId", "imageIndex", "label", "c", "gantry", "wag", "tableTranslation", "zoom",
+               "shotCount", "elapsed", "timeToTarget", "score", "angleError", "tableError"]
+
+# Shot columns added after the first release, created in older databases on open
+AddedShotColumns = [("score", "REAL"), ("angleError", "REAL"), ("tableError", "REAL")]
+AddedSessionColumns = [("doseAreaProduct", "REAL"), ("peakSkinDose", "REAL")]
+
+
+def GroupedPercentiles(groups, values, percentiles):
+    """Percentiles of values within each group, computed for all groups at once.
+
+    Returns the unique groups, their counts, means and a (groups, percentiles)
+    array interpolated linearly as numpy.percentile does.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return np.array([]), np.array([], dtype=np.intp), np.array([]), np.zeros((0, len(percentiles)))
+    uniqueGroups, inverse = np.unique(groups, return_inverse=True)
+    order = np.lexsort((values, inverse))
+    sortedValues = values[order]
+    counts = np.bincount(inverse, minlength=len(uniqueGroups))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    means = np.bincount(inverse, weights=values, minlength=len(uniqueGroups)) / counts
+
+    positions = starts[:, np.newaxis] + np.asarray(percentiles, dtype=np.float64) / 100.0 * (counts[:, np.newaxis] - 1)
+    lower = np.floor(positions).astype(np.intp)
+    upper = np.minimum(lower + 1, (starts + counts - 1)[:, np.newaxis])
+    fraction = positions - lower
+    result = sortedValues[lower] * (1.0 - fraction) + sortedValues[upper] * fraction
+    return uniqueGroups, counts, means, result
+
+
+class CarmSimulatorSessionStore:
+    """Session results database, written off the UI thread."""
+
+    def __init__(self, path, batchInterval=0.5):
+        self.path = path
+        self.batchInterval = batchInterval
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SessionSchema)
+        for table, addedColumns in (("shots", AddedShotColumns), ("sessions", AddedSessionColumns)):
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(%s)" % table)]
+            for name, columnType in addedColumns:
+                if name not in columns:
+                    connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, columnType))
+        connection.close()
+
+        self.queue = queue.Queue()
+        self.writtenCount = 0
+        self.batchCount = 0
+        self.thread = threading.Thread(target=self.Run, name="CarmSimulatorSessionStore")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Analytics read through their own connection and keep the shot columns loaded
+        self.readConnection = None
+        self.shotColumns = None
+        self.lastShotId = 0
+
+        # Labels are grouped by integer code, labelNames[code] is the label
+        self.labelNames = []
+        self.labelCodes = {}
+
+    #
+    # Writing (UI thread)
+    #
+
+    def BeginSession(self, trainee, caseName):
+        sessionId = uuid.uuid4().hex
+        self.queue.put(("INSERT INTO sessions (id, trainee, caseName, startedAt) VALUES (?, ?, ?, ?)",
+                        (sessionId, trainee, caseName, time.time())))
+        return sessionId
+
+    def AddShot(self, sessionId, imageIndex, label, pose, shotCount, elapsed, timeToTarget, score=None,
+                angleError=None, tableError=None):
+        # pose is (C, gantry, wag, table, zoom), times in seconds, score is the target view match (0-100),
+        # angleError (degrees) and tableError (mm) the distance to the solved optimal pose
+        optional = tuple(float(value) if value is not None else None for value in (score, angleError, tableError))
+        self.queue.put(("INSERT INTO shots (sessionId, imageIndex, label, c, gantry, wag, tableTranslation, zoom, "
+                        "shotCount, elapsed, timeToTarget, score, angleError, tableError) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (sessionId, imageIndex, label) + tuple(float(value) for value in pose) +
+                        (int(shotCount), float(elapsed), float(timeToTarget)) + optional))
+
+    def EndSession(self, sessionId, totalShots, totalTime, doseAreaProduct=None, peakSkinDose=None, completed=True):
+        # Dose area product in mGy cm2, peak skin dose in mGy
+        # Sessions left before the last image keep their totals but stay out of the cohort percentiles
+        dose = tuple(float(value) if value is not None else None for value in (doseAreaProduct, peakSkinDose))
+        self.queue.put(("UPDATE sessions SET completed = ?, totalShots = ?, totalTime = ?, doseAreaProduct = ?, "
+                        "peakSkinDose = ? WHERE id = ?",
+                        (int(completed), int(totalShots), float(totalTime)) + dose + (sessionId,)))
+
+    #
+    # Writer thread
+    #
+
+    def Run(self):
+        connection = sqlite3.connect(self.path)
+        running = True
+        while running:
+            statements = [self.queue.get()]
+            # Gather everything queued within the batch interval into one transaction
+            deadline = time.perf_counter() + self.batchInterval
+            while True:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    statements.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if None in statements:
+                running = False
+            self.WriteBatch(connection, [statement for statement in statements if statement is not None])
+            for statement in statements:
+                self.queue.task_done()
+        connection.close()
+
+    def WriteBatch(self, connection, statements):
+        if not statements:
+            return
+        try:
+            with connection:
+                # Consecutive rows of the same statement go through one executemany
+                index = 0
+                while index < len(statements):
+                    sql = statements[index][0]
+                    end = index
+                    while end < len(statements) and statements[end][0] == sql:
+                        end += 1
+                    connection.executemany(sql, [parameters for _, parameters in statements[index:end]])
+                    index = end
+        except sqlite3.Error as error:
+            # The batch is rolled back and its rows are lost, log them so they can be recovered
+            logging.error("Session store failed to write %d rows: %s\n%s" %
+                          (len(statements), error, "\n".join("%s %r" % statement for statement in statements)))
+            return
+        self.writtenCount += len(statements)
+        self.batchCount += 1
+
+    def Flush(self):
+        # Block until everything queued so far is in the database
+        self.queue.join()
+
+    def Close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.readConnection is not None:
+            self.readConnection.close()
+            self.readConnection = None
+
+    #
+    # Analytics
+    #
+
+    def GetShots(self):
+        """Every shot as NumPy columns, keyed by column name.
+
+        Only rows added since the previous call are read from the database.
+        """
+        if self.readConnection is None:
+            self.readConnection = sqlite3.connect(self.path, check_same_thread=False)
+        rows = self.readConnection.execute("SELECT %s FROM shots WHERE id > ? ORDER BY id" % ", ".join(ShotColumns),
+                                           (self.lastShotId,)).fetchall()
+        if rows or self.shotColumns is None:
+            columns = list(zip(*rows)) if rows else [()] * len(ShotColumns)
+            newColumns = {}
+            for name, values in zip(ShotColumns, columns):
+                dtype = str if name in ("sessionId", "label") else np.float64
+                newColumns[name] = np.array(values, dtype=dtype)
+            newColumns["labelCode"] = self.EncodeLabels(newColumns["label"])
+            if self.shotColumns is None:
+                self.shotColumns = newColumns
+            else:
+                self.shotColumns = {name: np.concatenate((self.shotColumns[name], newColumns[name]))
+                                    for name in newColumns}
+            if rows:
+                self.lastShotId = int(rows[-1][0])
+        return self.shotColumns
+
+    def EncodeLabels(self, labels):
+        uniqueLabels, inverse = np.unique(labels, return_inverse=True)
+        for label in uniqueLabels:
+            if label not in self.labelCodes:
+                self.labelCodes[label] = len(self.labelNames)
+                self.labelNames.append(str(label))
+        codes = np.array([self.labelCodes[label] for label in uniqueLabels], dtype=np.intp)
+        return codes[inverse] if len(codes) else np.zeros(0, dtype=np.intp)
+
+    def GetSessions(self):
+        if self.readConnection is None:
+            self.readConnection = sqlite3.connect(self.path, check_same_thread=False)
+        rows = self.readConnection.execute(
+            "SELECT id, trainee, caseName, totalShots, totalTime, doseAreaProduct, peakSkinDose FROM sessions "
+            "WHERE completed = 1").fetchall()
+        columns = list(zip(*rows)) if rows else [()] * 7
+        return {
+            "id": np.array(columns[0], dtype=str),
+            "trainee": np.array(columns[1], dtype=str),
+            "caseName": np.array(columns[2], dtype=str),
+            "totalShots": np.array(columns[3], dtype=np.float64),
+            "totalTime": np.array(columns[4], dtype=np.float64),
+            "doseAreaProduct": np.array(columns[5], dtype=np.float64),
+            "peakSkinDose": np.array(columns[6], dtype=np.float64),
+        }
+
+    def SummarizeByGroup(self, groups, values, percentiles, groupNames=None):
+        uniqueGroups, counts, means, result = GroupedPercentiles(groups, values, percentiles)
+        summary = {}
+        for index, group in enumerate(uniqueGroups):
+            entry = {"count": int(counts[index]), "mean": float(means[index])}
+            for column, percentile in enumerate(percentiles):
+                entry["p%g" % percentile] = float(result[index, column])
+            summary[groupNames[group] if groupNames is not None else str(group)] = entry
+        return summary
+
+    def GetTimeToTargetPerView(self, percentiles=(50, 90)):
+        # Seconds from the previous collected image (or module start) to collecting each view
+        shots = self.GetShots()
+        return self.SummarizeByGroup(shots["labelCode"], shots["timeToTarget"], percentiles, self.labelNames)
+
+    def GetShotsPerImage(self, percentiles=(50, 90)):
+        # Fluoro shots taken to collect each view
+        shots = self.GetShots()
+        return self.SummarizeByGroup(shots["labelCode"], shots["shotCount"], percentiles, self.labelNames)
+
+    def GetScorePerView(self, percentiles=(50, 90)):
+        # Target view match of the collected images
+        return self.SummarizeColumnByView("score", percentiles)
+
+    def GetAngleErrorPerView(self, percentiles=(50, 90)):
+        # Degrees from the optimal pose of each view
+        return self.SummarizeColumnByView("angleError", percentiles)
+
+    def SummarizeColumnByView(self, column, percentiles):
+        # Shots without a value in column (NULL) are left out
+        shots = self.GetShots()
+        valid = np.isfinite(shots[column])
+        return self.SummarizeByGroup(shots["labelCode"][valid], shots[column][valid], percentiles, self.labelNames)
+
+    def GetCohortPercentiles(self, metric="totalTime", groupBy="trainee", percentiles=(25, 50, 75)):
+        # Percentiles of a per-session metric (totalTime, totalShots, doseAreaProduct or peakSkinDose)
+        # within each cohort, sessions without a value are left out
+        sessions = self.GetSessions()
+        valid = np.isfinite(sessions[metric])
+        return self.SummarizeByGroup(sessions[groupBy][valid], sessions[metric][valid], percentiles)
+
+    def GetStatistics(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.writtenCount,
+            "batches": self.batchCount,
+        }
@@ -0,0 +1,113 @@
+import math
+import numpy as np
+
+#
+# Polychromatic Beam
+#
+# CT numbers are split into a water and a cortical bone density, so a DRR ray
+# only has to integrate two material path lengths (g/cm2) instead of attenuation
+# at every energy. The tube spectrum for a kVp is integrated once into a table
+# of the detected log attenuation over a grid of water and bone path lengths;
+# a frame then costs one bilinear lookup per pixel. Beam hardening and the
+# energy dependence of bone contrast come from the table.
+#
+
+# Mass attenuation coefficients (cm2/g, NIST XCOM, with coherent scattering)
+AttenuationEnergies = np.array([10.0, 15.0, 20.0, 30.0, 40.0, 50.0, 60.0, 80.0, 100.0, 150.0])
+WaterMassAttenuation = np.array([5.329, 1.673, 0.8096, 0.3756, 0.2683, 0.2269, 0.2059, 0.1837, 0.1707, 0.1505])
+BoneMassAttenuation = np.array([28.51, 9.032, 4.001, 1.331, 0.6655, 0.4242, 0.3148, 0.2229, 0.1855, 0.1480])
+AluminiumMassAttenuation = np.array([26.23, 7.955, 3.441, 1.128, 0.5685, 0.3681, 0.2778, 0.2018, 0.1704, 0.1378])
+
+# Cortical bone (ICRU 44) and aluminium densities in g/cm3
+BoneDensity = 1.92
+AluminiumDensity = 2.699
+
+# CT number of pure cortical bone, voxels in between are a water / bone mixture
+CorticalBoneHU = 1900.0
+
+# Path length ranges covered by the lookup table, in g/cm2
+WaterPathMax = 60.0
+BonePathMax = 30.0
+
+
+def MassAttenuation(table, energies):
+    # Log-log interpolation of a mass attenuation table
+    return np.exp(np.interp(np.log(energies), np.log(AttenuationEnergies), np.log(table)))
+
+
+def TubeSpectrum(kVp, filtration=2.5, energyStep=1.0):
+    """Energies (keV) and detected weights of a tungsten tube spectrum, weights summing to one.
+
+    Kramers' law bremsstrahlung behind filtration mm of aluminium, seen by an
+    energy integrating detector.
+    """
+    energies = np.arange(10.0, kVp, energyStep) + energyStep * 0.5
+    photons = (kVp - energies) / energies
+    photons *= np.exp(-MassAttenuation(AluminiumMassAttenuation, energies) * AluminiumDensity * filtration / 10.0)
+    weights = photons * energies
+    return energies, weights / weights.sum()
+
+
+def MaterialVolume(scalars):
+    """Water and bone density of every voxel, per mm of path, as a complex64 volume.
+
+    The real part is the water and the imaginary part the bone density in
+    g/cm3 / 10, so integrating along a ray in mm gives both path lengths in g/cm2
+    in a single pass.
+    """
+    scalars = np.asarray(scalars, dtype=np.float32)
+    boneFraction = np.clip(scalars / np.float32(CorticalBoneHU), 0.0, None)
+    water = np.clip(1.0 + scalars / np.float32(1000.0), 0.0, 1.0) * np.clip(1.0 - boneFraction, 0.0, 1.0)
+    materials = np.empty(scalars.shape, dtype=np.complex64)
+    materials.real = water * np.float32(0.1)
+    materials.imag = boneFraction * np.float32(BoneDensity * 0.1)
+    return materials
+
+
+class CarmSimulatorPolychromaticBeam:
+    """Detected log attenuation of a kVp spectrum as a function of water and bone path lengths.
+
+    LineIntegrals() returns values to use in place of the monochromatic line
+    integral, scaled by the exposure so that referenceWater g/cm2 of water comes
+    out at half intensity, as the C-arm's automatic brightness control would.
+    """
+
+    def __init__(self, kVp=80.0, filtration=2.5, waterSamples=257, boneSamples=129, referenceWater=20.0):
+        self.kVp = kVp
+        self.filtration = filtration
+        energies, weights = TubeSpectrum(kVp, filtration)
+        waterAttenuation = MassAttenuation(WaterMassAttenuation, energies)
+        boneAttenuation = MassAttenuation(BoneMassAttenuation, energies)
+
+        # -log of the spectrum weighted transmission, summed in the log domain to avoid underflow
+        self.waterPaths = np.linspace(0.0, WaterPathMax, waterSamples)
+        self.bonePaths = np.linspace(0.0, BonePathMax, boneSamples)
+        table = np.empty((waterSamples, boneSamples))
+        logWeights = np.log(weights)
+        for row, water in enumerate(self.waterPaths):
+            exponents = logWeights - water * waterAttenuation - self.bonePaths[:, np.newaxis] * boneAttenuation
+            largest = exponents.max(axis=1)
+            table[row] = -(largest + np.log(np.exp(exponents - largest[:, np.newaxis]).sum(axis=1)))
+
+        referenceAttenuation = np.interp(referenceWater, self.waterPaths, table[:, 0])
+        self.exposureScale = math.log(2.0) / referenceAttenuation
+        self.table = (table * self.exposureScale).astype(np.float32).ravel()
+        self.waterScale = np.float32((waterSamples - 1) / WaterPathMax)
+        self.boneScale = np.float32((boneSamples - 1) / BonePathMax)
+        self.boneSamples = boneSamples
+        self.waterLimit = np.float32(waterSamples - 1.001)
+        self.boneLimit = np.float32(boneSamples - 1.001)
+
+    def LineIntegrals(self, waterPaths, bonePaths):
+        # Bilinear lookup, path lengths beyond the table are clamped to its edge
+        x = np.clip(waterPaths * self.waterScale, 0.0, self.waterLimit)
+        y = np.clip(bonePaths * self.boneScale, 0.0, self.boneLimit)
+        x0 = x.astype(np.intp)
+        y0 = y.astype(np.intp)
+        fx = x - x0
+        fy = y - y0
+        index = x0 * self.boneSamples + y0
+        table = self.table
+        bottom = table[index] * (1 - fy) + table[index + 1] * fy
+        top = table[index + self.boneSamples] * (1 - fy) + table[index + self.boneSamples + 1] * fy
+        return bottom * (1 - fx) + top * fx
@@ -0,0 +1,77 @@
+import os
+import zlib
+import numpy as np
+
+#
+# Volume IO
+#
+
+MetaImageTypes = {
+    "MET_CHAR": np.int8,
+    "MET_UCHAR": np.uint8,
+    "MET_SHORT": np.int16,
+    "MET_USHORT": np.uint16,
+    "MET_INT": np.int32,
+    "MET_UINT": np.uint32,
+    "MET_FLOAT": np.float32,
+    "MET_DOUBLE": np.float64,
+}
+
+
+def ReadMetaImageHeader(path):
+    # Returns the header fields and the byte offset of the pixel data
+    header = {}
+    with open(path, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            key, _, value = line.decode('latin-1').partition('=')
+            key = key.strip()
+            header[key] = value.strip()
+            if key == "ElementDataFile":
+                break
+        header["DataOffset"] = f.tell()
+    return header
+
+
+def ReadMetaImage(path):
+    """Read a 3D .mha/.mhd volume without Slicer.
+
+    Returns the voxels indexed [k, j, i] (as slicer.util.arrayFromVolume does) and
+    the 4x4 IJK to RAS matrix. MetaImage geometry is LPS and is converted to RAS
+    the same way Slicer does on load.
+    """
+    header = ReadMetaImageHeader(path)
+    dimensions = [int(v) for v in header["DimSize"].split()]
+    if len(dimensions) != 3:
+        raise ValueError("Only 3D MetaImage volumes are supported: " + path)
+    spacing = [float(v) for v in header.get("ElementSpacing", "1 1 1").split()]
+    origin = [float(v) for v in header.get("Offset", header.get("Origin", "0 0 0")).split()]
+    direction = [float(v) for v in header.get("TransformMatrix", "1 0 0 0 1 0 0 0 1").split()]
+    components = int(header.get("ElementNumberOfChannels", "1"))
+    dtype = np.dtype(MetaImageTypes[header["ElementType"]])
+    if header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False")) == "True":
+        dtype = dtype.newbyteorder('>')
+
+    dataFile = header["ElementDataFile"]
+    if dataFile == "LOCAL":
+        with open(path, 'rb') as f:
+            f.seek(header["DataOffset"])
+            data = f.read()
+    else:
+        with open(os.path.join(os.path.dirname(path), dataFile), 'rb') as f:
+            data = f.read()
+    if header.get("CompressedData", "False") == "True":
+        data = zlib.decompress(data)
+
+    shape = dimensions[::-1] + ([components] if components > 1 else [])
+    voxels = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    voxels = voxels.astype(dtype.newbyteorder('='), copy=False)
+
+    # TransformMatrix columns are the IJK axis directions
+    ijkToLPS = np.eye(4)
+    ijkToLPS[:3, :3] = np.array(direction).reshape(3, 3).T * np.array(spacing)
+    ijkToLPS[:3, 3] = origin
+    lpsToRAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+    return voxels, lpsToRAS.dot(ijkToLPS)
@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+ModuleDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, ModuleDirectory)
+
+from CarmSimulatorDRR import OpacityToAttenuation, ReadVolumeProperty
+from CarmSimulatorAttenuationCache import BakeAttenuation, ReadAttenuationVolume, GetBakedAttenuationPath
+from CarmSimulatorVolumeIO import ReadMetaImage
+from CarmSimulatorTestVolumes import WriteMetaImage
+
+
+class CarmSimulatorAttenuationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.opacityPoints, colorPoints = ReadVolumeProperty(os.path.join(ModuleDirectory, 'Resources', 'VolumeProperty.vp'))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def AssertBaked(self, scalars):
+        # Baked values are the transfer function's attenuation to within half a quantization step
+        attenuation, scale = BakeAttenuation(scalars, self.opacityPoints)
+        self.assertEqual(attenuation.dtype, np.uint16)
+        self.assertEqual(attenuation.shape, scalars.shape)
+        expected = OpacityToAttenuation(scalars.astype(np.float32), self.opacityPoints)
+        np.testing.assert_allclose(attenuation * scale, expected, rtol=0, atol=scale * 0.5 + 1e-9,
+                                   err_msg=str(scalars.dtype))
+
+    def test_IntegerTables(self):
+        # Table lookups of every integer type, signed ones through their unsigned view, including the extremes
+        for dtype in (np.int8, np.uint8, np.int16, np.uint16):
+            info = np.iinfo(dtype)
+            values = np.concatenate((np.arange(info.min, info.max + 1, max((info.max - info.min) // 4096, 1)),
+                                     [info.min, -1 if info.min < 0 else 1, 0, info.max]))
+            self.AssertBaked(values.astype(dtype).reshape(-1, 1, 1))
+
+    def test_FloatVolume(self):
+        values = np.linspace(-1024.0, 3071.0, 5000, dtype=np.float32)
+        self.AssertBaked(values.reshape(10, 20, 25))
+
+    def test_CachedBesideVolume(self):
+        scalars = np.full((6, 8, 10), -1000, dtype=np.int16)
+        scalars[2:4, 2:6, 3:7] = 1200
+        path = os.path.join(self.directory, "Phantom.mha")
+        WriteMetaImage(path, scalars, spacing=(1.0, 2.0, 3.0))
+        attenuation, scale, ijkToRAS = ReadAttenuationVolume(path, self.opacityPoints)
+        self.assertTrue(os.path.exists(GetBakedAttenuationPath(path)))
+        np.testing.assert_array_equal(ijkToRAS, ReadMetaImage(path)[1])
+
+        # Read back from the cache, without the CT
+        cached = ReadAttenuationVolume(path, self.opacityPoints)
+        np.testing.assert_array_equal(cached[0], attenuation)
+        self.assertEqual(cached[1], scale)
+
+        # Another transfer function makes the cache stale
+        opacityPoints = np.array(self.opacityPoints, dtype=np.float64)
+        opacityPoints[:, 1] *= 0.5
+        rebaked, rebakedScale, rebakedIJKToRAS = ReadAttenuationVolume(path, opacityPoints)
+        np.testing.assert_allclose(rebaked * rebakedScale, OpacityToAttenuation(scalars, opacityPoints),
+                                   rtol=0, atol=rebakedScale * 0.5 + 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorBatch import GenerateDataset, GeneratePoses, LoadDataset, ChunkPath, ParseAxisSpec
+from CarmSimulatorTestVolumes import CreatePhantom, WriteMetaImage
+
+
+class CarmSimulatorBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.volumePath = os.path.join(self.directory, "Phantom.mha")
+        scalars, ijkToRAS = CreatePhantom()
+        WriteMetaImage(self.volumePath, scalars, spacing=(2.5, 2.5, 3.5))
+        self.outputDirectory = os.path.join(self.directory, "dataset")
+        self.poses = GeneratePoses({"c": "0:40:10", "gantry": "0", "wag": "0", "table": "0", "zoom": "0"})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def Generate(self, poses):
+        return GenerateDataset([self.volumePath], self.outputDirectory, poses, chunkSize=2, numberOfWorkers=1,
+                               width=66, height=42)
+
+    def test_Poses(self):
+        self.assertEqual(ParseAxisSpec("5"), (5.0, 5.0, None))
+        np.testing.assert_array_equal(self.poses[:, 0], [0, 10, 20, 30, 40])
+        self.assertEqual(GeneratePoses({"c": "0:10:5", "gantry": "-5:5:5", "wag": "0", "table": "0", "zoom": "0"}).shape,
+                         (9, 5))
+        random = GeneratePoses({"c": "0:10", "gantry": "0", "wag": "0", "table": "-5:5", "zoom": "0"}, randomCount=20)
+        self.assertTrue(((random[:, 0] >= 0) & (random[:, 0] <= 10)).all())
+        self.assertTrue((np.abs(random[:, 3]) <= 5).all())
+
+    def test_Resume(self):
+        report = self.Generate(self.poses)
+        self.assertEqual(report["images"], 5)
+        self.assertEqual(report["skippedChunks"], 0)
+        chunks = list(LoadDataset(self.outputDirectory))
+        self.assertEqual(len(chunks), 3)
+        firstImages = np.concatenate([images for volumeIndex, images, poses in chunks])
+        np.testing.assert_array_equal(np.concatenate([poses for volumeIndex, images, poses in chunks]), self.poses)
+        self.assertEqual(firstImages.shape, (5, 42, 66))
+        self.assertLess(firstImages.min(), 255)
+
+        # An interrupted run: the last chunk is missing and a partial one was left behind
+        os.remove(ChunkPath(self.outputDirectory, 0, 2))
+        with open(ChunkPath(self.outputDirectory, 0, 2) + ".tmp.npz", 'wb') as f:
+            f.write(b'partial')
+        report = self.Generate(self.poses)
+        self.assertEqual(report["skippedChunks"], 2)
+        self.assertEqual(report["images"], 1)
+        images = np.concatenate([images for volumeIndex, images, poses in LoadDataset(self.outputDirectory)])
+        np.testing.assert_array_equal(images, firstImages)
+
+    def test_ManifestMismatch(self):
+        self.Generate(self.poses[:2])
+        with self.assertRaises(ValueError):
+            self.Generate(self.poses)
+        with self.assertRaises(ValueError):
+            GenerateDataset([self.volumePath], self.outputDirectory, self.poses[:2], chunkSize=2, numberOfWorkers=1,
+                            width=66, height=84)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorCollision import CarmSimulatorBVH, CarmSimulatorCollisionChecker, BoxesOverlap, TreesIntersect
+from CarmSimulatorKinematics import Rotation
+
+
+def CreateSphere(radius, center=(0.0, 0.0, 0.0), rings=16, segments=24):
+    # (points, triangles) of a UV sphere
+    theta = np.linspace(0.0, np.pi, rings + 1)[1:-1]
+    phi = np.linspace(0.0, 2.0 * np.pi, segments, endpoint=False)
+    points = [[0.0, 0.0, radius]]
+    for t in theta:
+        points.extend([[radius * np.sin(t) * np.cos(p), radius * np.sin(t) * np.sin(p), radius * np.cos(t)] for p in phi])
+    points.append([0.0, 0.0, -radius])
+    triangles = []
+    for s in range(segments):
+        triangles.append([0, 1 + s, 1 + (s + 1) % segments])
+    for ring in range(rings - 2):
+        first = 1 + ring * segments
+        for s in range(segments):
+            a, b = first + s, first + (s + 1) % segments
+            triangles.extend([[a, a + segments, b], [b, a + segments, b + segments]])
+    last = len(points) - 1
+    first = 1 + (rings - 2) * segments
+    for s in range(segments):
+        triangles.append([first + s, last, first + (s + 1) % segments])
+    return np.array(points) + center, np.array(triangles)
+
+
+def LeafBoxes(tree):
+    # Leaf boxes, without the empty box that pads the tree
+    return tree.boxes[:-1][tree.isLeaf[:-1]]
+
+
+class CarmSimulatorCollisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sphereA = CreateSphere(50.0)
+        self.sphereB = CreateSphere(30.0, center=(5.0, -3.0, 2.0), rings=10, segments=14)
+        self.treeA = CarmSimulatorBVH(*self.sphereA)
+        self.treeB = CarmSimulatorBVH(*self.sphereB)
+
+    def test_Hierarchy(self):
+        # The root bounds the mesh and every triangle ends up in exactly one leaf
+        points, triangles = self.sphereA
+        np.testing.assert_allclose(self.treeA.boxes[0, :3] - self.treeA.boxes[0, 3:], points.min(axis=0))
+        np.testing.assert_allclose(self.treeA.boxes[0, :3] + self.treeA.boxes[0, 3:], points.max(axis=0))
+        self.assertEqual(self.treeA.triangleCount, len(triangles))
+        self.assertGreaterEqual(len(LeafBoxes(self.treeA)), len(triangles) // 4)
+
+    def test_MatchesBruteForce(self):
+        # The tree descent finds an overlapping leaf pair exactly when testing all leaf pairs does
+        leavesA = LeafBoxes(self.treeA)
+        leavesB = LeafBoxes(self.treeB)
+        indicesA = np.repeat(np.arange(len(leavesA)), len(leavesB))
+        indicesB = np.tile(np.arange(len(leavesB)), len(leavesA))
+        generator = np.random.default_rng(3)
+        outcomes = set()
+        for trial in range(60):
+            bToA = Rotation(0, generator.uniform(0.0, 360.0)).dot(Rotation(2, generator.uniform(0.0, 360.0)))
+            direction = generator.normal(size=3)
+            # Centers from well inside to well outside of contact, so both outcomes come up
+            bToA[:3, 3] = direction / np.linalg.norm(direction) * generator.uniform(0.0, 100.0)
+            bruteForce = bool(BoxesOverlap(bToA[:3, :3], bToA[:3, 3], leavesA[indicesA], leavesB[indicesB]).any())
+            self.assertEqual(TreesIntersect(self.treeA, self.treeB, bToA), bruteForce, "trial %d" % trial)
+            outcomes.add(bruteForce)
+        self.assertEqual(outcomes, {True, False})
+
+    def test_FaceAxesAreConservative(self):
+        # Without the cross axes a pair may be reported overlapping, never separated, when it overlaps
+        generator = np.random.default_rng(5)
+        boxesA = np.column_stack((generator.normal(size=(2000, 3)), generator.uniform(0.1, 1.0, size=(2000, 3))))
+        boxesB = np.column_stack((generator.normal(size=(2000, 3)), generator.uniform(0.1, 1.0, size=(2000, 3))))
+        rotation = Rotation(2, 30.0)[:3, :3].dot(Rotation(0, 45.0)[:3, :3])
+        translation = np.array([0.5, -0.2, 0.1])
+        full = BoxesOverlap(rotation, translation, boxesA, boxesB)
+        faces = BoxesOverlap(rotation, translation, boxesA, boxesB, crossAxes=False)
+        self.assertTrue(faces[full].all())
+        self.assertTrue(full.any() and not full.all())
+        self.assertGreater(faces.sum(), full.sum())
+
+    def test_Checker(self):
+        # The patient rides on the table translation, the C stays put at zero C rotation
+        models = {"C": self.sphereA, "HumanMesh": CreateSphere(30.0, center=(0.0, 150.0, 0.0))}
+        chains = {"C": ["CTransform"], "HumanMesh": ["TableZTranslation"]}
+        checker = CarmSimulatorCollisionChecker(models, chains, {}, pairs=[("C", "HumanMesh")])
+        self.assertEqual(checker.Check([0, 0, 0, 0, 0]), [])
+        self.assertEqual(checker.Check([0, 0, 0, -100, 0]), [("C", "HumanMesh")])
+        self.assertEqual(checker.Check([0, 0, 0, -150, 0], stopAtFirst=True), [("C", "HumanMesh")])
+        statistics = checker.GetStatistics()
+        self.assertEqual(statistics["queries"], 3)
+        self.assertEqual(statistics["collisions"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorCore import CarmSimulatorCore
+from CarmSimulatorKinematics import ComputeModelMatrices
+from CarmSimulatorTestVolumes import CreatePhantom, WriteMetaImage
+
+
+class CarmSimulatorCoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scalars, self.ijkToRAS = CreatePhantom()
+        self.core = CarmSimulatorCore(width=66, height=42, numberOfThreads=1)
+
+    def tearDown(self):
+        self.core.Shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_Pose(self):
+        self.core.SetPose([10, 20, -5, 30, 27])
+        self.assertEqual(self.core.GetPose(), [10.0, 20.0, -5.0, 30.0, 27.0])
+        self.assertEqual(self.core.GetPoseWith(1, 0.0), [10.0, 0.0, -5.0, 30.0, 27.0])
+        self.assertEqual(self.core.GetPose()[1], 20.0)
+        np.testing.assert_array_equal(self.core.GetModelMatrices()["Gantry"],
+                                      ComputeModelMatrices([10, 20, -5, 30, 27])["Gantry"])
+
+    def test_Volumes(self):
+        self.assertFalse(self.core.HasVolume())
+        attenuation, scale = self.core.SetVolume("phantom", self.scalars, self.ijkToRAS)
+        self.assertTrue(self.core.HasVolume())
+        image = self.core.RenderDRR([20, 0, 0, 0, 27])
+        self.assertEqual(image.shape, (42, 66, 3))
+        self.assertLess(image.min(), 255)
+        # Rendering another pose leaves the current one alone
+        self.assertEqual(self.core.GetPose(), [0.0] * 5)
+
+        # Levels kept by the caller restore the same images
+        levels = self.core.GetAttenuationLevels()
+        self.core.SetAttenuationVolume("empty", np.zeros((8, 8, 8), dtype=np.uint16), np.eye(4), scale)
+        self.core.SetAttenuationLevels("phantom", levels)
+        np.testing.assert_array_equal(self.core.RenderDRR([20, 0, 0, 0, 27]), image)
+
+        self.core.InvalidateVolume("other")
+        self.assertTrue(self.core.HasVolume())
+        self.core.InvalidateVolume("phantom")
+        self.assertFalse(self.core.HasVolume())
+
+    def test_LoadVolumeAndBeam(self):
+        path = os.path.join(self.directory, "Phantom.mha")
+        WriteMetaImage(path, self.scalars, spacing=(2.5, 2.5, 3.5))
+        self.core.LoadVolume(path)
+        self.assertEqual(self.core.volumeId, "Phantom")
+        self.assertIsNone(self.core.GetBeamKVp())
+        monochromatic = self.core.RenderDRR()
+
+        # The beam reloads the CT from the file, and back again for the transfer function
+        self.core.SetBeam(80)
+        self.assertTrue(self.core.HasVolume())
+        self.assertEqual(self.core.GetBeamKVp(), 80)
+        self.assertLess(self.core.RenderDRR().min(), 255)
+        self.core.SetBeam(None)
+        np.testing.assert_array_equal(self.core.RenderDRR(), monochromatic)
+
+    def test_FieldOfView(self):
+        self.core.SetVolume("phantom", self.scalars, self.ijkToRAS)
+        self.core.SetFieldOfView(0.0)
+        collimated = self.core.RenderDRR()
+        self.core.SetFieldOfView(46.0)
+        open = self.core.RenderDRR()
+        # Corners are outside the field at the narrowest collimation
+        self.assertEqual(collimated[0, 0].max(), 0)
+        self.assertGreater((collimated == 0).sum(), (open == 0).sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorDRRCache import CarmSimulatorDRRCache
+
+
+class CarmSimulatorDRRCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Room for three 100 byte images
+        self.cache = CarmSimulatorDRRCache(maximumBytes=300)
+        self.keys = [self.cache.MakeKey(angle, 0.0, 0.0, 0.0, 0.0, "volume") for angle in range(5)]
+
+    def Image(self, value):
+        return np.full(100, value, dtype=np.uint8)
+
+    def test_EvictsLeastRecentlyUsed(self):
+        for index in range(3):
+            self.cache.Put(self.keys[index], self.Image(index))
+        # Using the oldest entry makes the second one the least recently used
+        self.assertIsNotNone(self.cache.Get(self.keys[0]))
+        self.cache.Put(self.keys[3], self.Image(3))
+        self.assertIsNone(self.cache.Get(self.keys[1]))
+        for index in (0, 2, 3):
+            self.assertEqual(self.cache.Get(self.keys[index])[0], index)
+        self.cache.Put(self.keys[4], self.Image(4))
+        self.assertIsNone(self.cache.Get(self.keys[0]))
+        self.assertEqual(list(self.cache.entries), [self.keys[2], self.keys[3], self.keys[4]])
+        statistics = self.cache.GetStatistics()
+        self.assertEqual(statistics["evictions"], 2)
+        self.assertEqual(statistics["bytes"], 300)
+
+    def test_ReplacingKeepsSize(self):
+        self.cache.Put(self.keys[0], self.Image(0))
+        self.cache.Put(self.keys[0], self.Image(7))
+        self.assertEqual(self.cache.currentBytes, 100)
+        self.assertEqual(self.cache.Get(self.keys[0])[0], 7)
+
+    def test_StoresCopies(self):
+        image = self.Image(1)
+        self.cache.Put(self.keys[0], image)
+        image[:] = 9
+        self.assertEqual(self.cache.Get(self.keys[0])[0], 1)
+
+    def test_QuantizedKeys(self):
+        # Poses closer than the quantization steps share a key, other extras do not
+        self.assertEqual(self.cache.MakeKey(10.001, 0, 0, 0.01, 0, "volume"), self.cache.MakeKey(10.0, 0, 0, 0, 0, "volume"))
+        self.assertNotEqual(self.cache.MakeKey(10.0, 0, 0, 0, 0, "volume", 46.0),
+                            self.cache.MakeKey(10.0, 0, 0, 0, 0, "volume", 46.1))
+
+    def test_TooLargeAndInvalidate(self):
+        self.cache.Put(self.keys[0], np.zeros(301, dtype=np.uint8))
+        self.assertEqual(len(self.cache.entries), 0)
+        self.cache.Put(self.keys[0], self.Image(0))
+        self.cache.Put(self.cache.MakeKey(0, 0, 0, 0, 0, "other"), self.Image(1))
+        self.cache.Invalidate("volume")
+        self.assertEqual(len(self.cache.entries), 1)
+        self.assertEqual(self.cache.currentBytes, 100)
+        self.cache.SetMaximumBytes(50)
+        self.assertEqual(len(self.cache.entries), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+ModuleDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, ModuleDirectory)
+
+from CarmSimulatorDRR import CarmSimulatorDRREngine, ReadVolumeProperty
+from CarmSimulatorAttenuationCache import BakeAttenuation
+from CarmSimulatorCollimation import CollimationRadius
+from CarmSimulatorKinematics import ComputeDRRCameras
+from CarmSimulatorTestVolumes import CreatePhantom
+
+
+class CarmSimulatorDRRSkippingTest(unittest.TestCase):
+    """Cropping and empty block skipping against tracing every voxel of the volume."""
+
+    @classmethod
+    def setUpClass(cls):
+        opacityPoints, colorPoints = ReadVolumeProperty(os.path.join(ModuleDirectory, 'Resources', 'VolumeProperty.vp'))
+        scalars, ijkToRAS = CreatePhantom()
+        attenuation, scale = BakeAttenuation(scalars, opacityPoints)
+        cls.fullEngine = CarmSimulatorDRREngine(132, 84, numberOfThreads=1)
+        cls.fullEngine.emptyThreshold = None
+        cls.fullEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+        cls.skippingEngine = CarmSimulatorDRREngine(132, 84, numberOfThreads=1)
+        cls.skippingEngine.SetAttenuationVolume(attenuation, ijkToRAS, scale)
+        cls.poses = [[0, 0, 0, 0, 0], [20, 0, 0, 0, 27], [90, 30, 10, 50, 0], [-10, -40, -5, 0, 20]]
+
+    def test_Cropped(self):
+        statistics = self.skippingEngine.GetSkippingStatistics()
+        self.assertEqual(statistics["originalShape"], (80, 120, 120))
+        self.assertLess(np.prod(statistics["croppedShape"]), np.prod(statistics["originalShape"]))
+        self.assertLess(statistics["occupiedBlockFraction"], 1.0)
+
+    def test_LineIntegralsMatch(self):
+        # Skipped voxels attenuate less than emptyThreshold per mm; 1.3e-4 is the largest difference seen
+        for level in range(self.skippingEngine.numberOfLevels):
+            for pose in self.poses:
+                camera = ComputeDRRCameras(pose)
+                full = self.fullEngine.RenderLineIntegrals(*camera, level=level)
+                skipped = self.skippingEngine.RenderLineIntegrals(*camera, level=level)
+                self.assertEqual(full.shape, skipped.shape)
+                self.assertGreater(full.max(), 1.0)
+                np.testing.assert_allclose(skipped, full, rtol=0, atol=5e-4,
+                                           err_msg="level %d, pose %s" % (level, pose))
+
+    def test_SamplesSkipped(self):
+        self.skippingEngine.ResetSkippingStatistics()
+        for pose in self.poses:
+            self.skippingEngine.RenderLineIntegrals(*ComputeDRRCameras(pose))
+        statistics = self.skippingEngine.GetSkippingStatistics()
+        self.assertEqual(statistics["frames"], len(self.poses))
+        self.assertGreater(statistics["skippedFraction"], 0.2)
+
+    def test_CollimatedRaysMatch(self):
+        # Traced rays are unchanged by the collimation, the others are left at zero
+        radius = CollimationRadius(10.0)
+        camera = ComputeDRRCameras(self.poses[1])
+        open = self.fullEngine.RenderLineIntegrals(*camera)
+        collimated = self.skippingEngine.RenderLineIntegrals(*camera, collimation=radius)
+        mask = self.skippingEngine.collimationMasks.Get(radius)[0]
+        self.assertTrue(mask.any() and not mask.all())
+        np.testing.assert_allclose(collimated[mask], open[mask], rtol=0, atol=5e-4)
+        self.assertFalse(collimated[~mask].any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import math
+import os
+import sys
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorDose import CarmSimulatorDoseMap, CollimationFraction, ConeHeight, ConeBaseRadius, \
+    ReferenceDistance, DetectorViewAngle, DetectorAspectRatio
+from CarmSimulatorCollimation import CollimationRadius
+
+# CarmSimulator.TrainingFieldOfView, the module itself needs Slicer
+TrainingFieldOfView = 46.0
+
+
+def CreateGrid(size, spacing, z=0.0):
+    # Square grid of points at height z, facing +z (towards the source), and its triangles
+    coordinates = (np.arange(size) - (size - 1) / 2.0) * spacing
+    x, y = np.meshgrid(coordinates, coordinates, indexing='ij')
+    points = np.column_stack((x.ravel(), y.ravel(), np.full(x.size, z)))
+    triangles = []
+    for row in range(size - 1):
+        for column in range(size - 1):
+            a = row * size + column
+            triangles.extend([[a, a + size, a + 1], [a + 1, a + size, a + size + 1]])
+    return points, np.array(triangles)
+
+
+class CarmSimulatorDoseTest(unittest.TestCase):
+
+    def test_CollimationMatchesImagedField(self):
+        # The dosed cone is the field seen on the monitor, narrower or wider than the Cone model
+        coneTangent = ConeBaseRadius / ConeHeight
+        for fieldOfView in (0.0, 5.0, 10.0, 20.0, 28.0, 46.0):
+            fieldTangent = math.tan(math.radians(DetectorViewAngle / 2.0)) * CollimationRadius(fieldOfView)
+            self.assertAlmostEqual(CollimationFraction(fieldOfView) * coneTangent, fieldTangent)
+        self.assertLess(CollimationFraction(0.0), 1.0)
+        # Fully open, the field ends at the detector corners
+        cornerTangent = math.tan(math.radians(DetectorViewAngle / 2.0)) * math.hypot(1.0, DetectorAspectRatio)
+        self.assertAlmostEqual(CollimationFraction(60.0) * coneTangent, cornerTangent)
+
+    def test_TrainingFieldOfView(self):
+        # At the training field of view the imaged field is about twice the Cone model's
+        self.assertGreater(CollimationFraction(TrainingFieldOfView), 1.9)
+        points, triangles = CreateGrid(161, 5.0, z=100.0)
+        training = CarmSimulatorDoseMap(points, triangles)
+        narrower = CarmSimulatorDoseMap(points, triangles)
+        cone = CarmSimulatorDoseMap(points, triangles)
+        training.Deposit(np.eye(4), np.eye(4), CollimationFraction(TrainingFieldOfView))
+        narrower.Deposit(np.eye(4), np.eye(4), CollimationFraction(28.0))
+        cone.Deposit(np.eye(4), np.eye(4))
+
+        # Skin outside the Cone model is dosed, and dose and DAP still follow the collimation
+        self.assertGreater(np.count_nonzero(training.skinDose), np.count_nonzero(narrower.skinDose))
+        self.assertGreater(np.count_nonzero(narrower.skinDose), np.count_nonzero(cone.skinDose))
+        self.assertGreater(training.doseAreaProduct, narrower.doseAreaProduct)
+        ratio = (CollimationFraction(TrainingFieldOfView) / CollimationFraction(28.0)) ** 2
+        self.assertAlmostEqual(training.doseAreaProduct / narrower.doseAreaProduct, ratio)
+
+    def test_Deposit(self):
+        # Skin 100 mm towards the source from the cone base
+        points, triangles = CreateGrid(81, 5.0, z=100.0)
+        doseMap = CarmSimulatorDoseMap(points, triangles, airKermaPerShot=2.0)
+        collimation = CollimationFraction(0.0)
+        reached = doseMap.Deposit(np.eye(4), np.eye(4), collimation)
+
+        depth = ConeHeight - 100.0
+        radius = depth * ConeBaseRadius / ConeHeight * collimation
+        inBeam = np.hypot(points[:, 0], points[:, 1]) <= radius
+        self.assertEqual(reached, int(inBeam.sum()))
+        np.testing.assert_array_equal(doseMap.skinDose > 0, inBeam)
+        distance = np.sqrt(depth ** 2 + points[inBeam, 0] ** 2 + points[inBeam, 1] ** 2)
+        np.testing.assert_allclose(doseMap.skinDose[inBeam], 2.0 * (ReferenceDistance / distance) ** 2)
+        tangent = ConeBaseRadius / ConeHeight * collimation
+        self.assertAlmostEqual(doseMap.doseAreaProduct, 2.0 * math.pi * (ReferenceDistance * tangent) ** 2 / 100.0)
+
+        # Skin facing away from the source only gets the exit fraction
+        flipped = CarmSimulatorDoseMap(points, triangles[:, ::-1], airKermaPerShot=2.0, exitFraction=0.01)
+        flipped.Deposit(np.eye(4), np.eye(4), collimation)
+        np.testing.assert_allclose(flipped.skinDose, doseMap.skinDose * 0.01)
+
+        doseMap.Reset()
+        self.assertEqual(doseMap.GetStatistics()["peakSkinDose"], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
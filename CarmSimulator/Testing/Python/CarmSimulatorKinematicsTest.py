@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+import numpy as np
+import vtk
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorKinematics import ComputeModelMatrices, ComputeDRRCameras, ComputeDRRCamera
+
+
+def ArrayFromMatrix(matrix):
+    return np.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+
+class CarmSimulatorKinematicsTest(unittest.TestCase):
+    """Compares the NumPy kinematics with the vtkTransform chains the module used to build per pose."""
+
+    def setUp(self):
+        generator = np.random.default_rng(0)
+        self.poses = np.column_stack((generator.uniform(-15.0, 115.0, 50), generator.uniform(-55.0, 55.0, 50),
+                                      generator.uniform(-40.0, 40.0, 50), generator.uniform(-155.0, 155.0, 50),
+                                      generator.uniform(0.0, 50.0, 50)))
+
+    def test_ModelMatrices(self):
+        matrices = ComputeModelMatrices(self.poses)
+        for index, (c, gantry, wag, table, zoom) in enumerate(self.poses):
+            cTransform = vtk.vtkTransform()
+            cTransform.PostMultiply()
+            cTransform.Translate(-1262.2704, -337.5527, 5.7)
+            cTransform.RotateZ(c)
+            cTransform.Translate(1262.2704, 337.5527, -5.7)
+            gantryTransform = vtk.vtkTransform()
+            gantryTransform.Translate(0, 337.5527, 0)
+            gantryTransform.RotateX(gantry)
+            gantryTransform.Translate(0, -337.5527, 0)
+            wagTransform = vtk.vtkTransform()
+            wagTransform.Translate(500, 0, 0)
+            wagTransform.RotateY(wag)
+            wagTransform.Translate(-500, 0, 0)
+            tableTransform = vtk.vtkTransform()
+            tableTransform.Translate(0, table, 0)
+            for name, transform in (("C", cTransform), ("Gantry", gantryTransform), ("Wag", wagTransform),
+                                    ("Table", tableTransform)):
+                np.testing.assert_allclose(matrices[name][index], ArrayFromMatrix(transform.GetMatrix()), atol=1e-9)
+
+    def test_DRRCameras(self):
+        positions, focalPoints, viewUps = ComputeDRRCameras(self.poses)
+        for index, (c, gantry, wag, table, zoom) in enumerate(self.poses):
+            cameraTransform = vtk.vtkTransform()
+            cameraTransform.PostMultiply()
+            cameraTransform.Translate(0, -705.81 + zoom * 16, 0)
+            cameraTransform.RotateZ(-c)
+            cameraTransform.RotateX(gantry)
+            cameraTransform.Translate(500, 0, 0)
+            cameraTransform.RotateY(-wag)
+            cameraTransform.Translate(-500, 0, 0)
+            focalTransform = vtk.vtkTransform()
+            focalTransform.Translate(500, 0, 0)
+            focalTransform.RotateY(wag)
+            focalTransform.Translate(-500, 0, 0)
+            focalTransform.Translate(0, 0, -table)
+            viewUp = [0.0, 0.0, 0.0, 0.0]
+            cameraTransform.MultiplyPoint([0.0, 0.0, 1.0, 0.0], viewUp)
+            np.testing.assert_allclose(positions[index], cameraTransform.GetPosition(), atol=1e-9)
+            np.testing.assert_allclose(focalPoints[index], focalTransform.GetPosition(), atol=1e-9)
+            np.testing.assert_allclose(viewUps[index], viewUp[:3], atol=1e-12)
+
+    def test_SinglePose(self):
+        # A single pose gives unbatched results equal to the batched ones
+        position, focalPoint, viewUp = ComputeDRRCamera(*self.poses[3])
+        positions, focalPoints, viewUps = ComputeDRRCameras(self.poses)
+        np.testing.assert_array_equal(position, positions[3])
+        np.testing.assert_array_equal(focalPoint, focalPoints[3])
+        self.assertEqual(ComputeModelMatrices(self.poses[3])["C"].shape, (4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
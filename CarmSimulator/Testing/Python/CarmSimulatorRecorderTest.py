@@ -0,0 +1,94 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorRecorder import CarmSimulatorPoseRecorder, CarmSimulatorReplay, ReadRecording, HeaderStruct, \
+    RecordingMagic, RecordStruct, RecordDType, RecordDTypeVersion1, EventPose, EventShot, EventFieldOfView, EventInput
+
+
+class CarmSimulatorRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Session.carmrec')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_RoundTrip(self):
+        recorder = CarmSimulatorPoseRecorder(self.path, capacity=64, flushInterval=0.001)
+        recorder.Start()
+        poses = [[float(index), 2.5, -1.0, 10.0 * index, 27.0] for index in range(40)]
+        for pose in poses:
+            recorder.RecordPose(pose)
+        recorder.RecordShot(poses[-1], 3)
+        recorder.RecordFieldOfView(poses[-1], 46.3)
+        recorder.RecordInput([0.25, -0.5, 1.0, 1.0, 2.0], -1)
+        recorder.Stop()
+        self.assertFalse(recorder.IsRecording())
+
+        events = ReadRecording(self.path)
+        statistics = recorder.GetStatistics()
+        self.assertEqual(statistics["dropped"], 0)
+        self.assertEqual(len(events), statistics["recorded"])
+        self.assertEqual(statistics["bytes"], os.path.getsize(self.path))
+        self.assertEqual(list(events['type']), [EventPose] * 40 + [EventShot, EventFieldOfView, EventInput])
+        np.testing.assert_allclose(events['values'][:40], poses)
+        self.assertTrue((np.diff(events['time']) >= 0).all())
+        self.assertEqual(events['value'][40], 3)
+        # Field of view steps of 0.1 survive
+        self.assertAlmostEqual(float(events['value'][41]), 46.3, places=5)
+        self.assertEqual(events['value'][42], -1)
+
+    def test_DropsWhenFull(self):
+        recorder = CarmSimulatorPoseRecorder(self.path, capacity=4, flushInterval=60.0)
+        recorder.Start()
+        for index in range(6):
+            recorder.RecordPose([index, 0, 0, 0, 0])
+        recorder.Stop()
+        self.assertEqual(recorder.GetStatistics()["dropped"], 2)
+        np.testing.assert_array_equal(ReadRecording(self.path)['values'][:, 0], [0, 1, 2, 3])
+
+    def test_Replay(self):
+        events = np.zeros(4, dtype=RecordDType)
+        events['time'] = [0.0, 0.5, 1.0, 2.0]
+        events['type'] = [EventPose, EventShot, EventPose, EventFieldOfView]
+        events['values'][:, 0] = [1, 2, 3, 4]
+        events['value'] = [0, 1, 0, 12.5]
+        applied = []
+        callbacks = {eventType: (lambda values, value, eventType=eventType: applied.append((eventType, values[0], value)))
+                     for eventType in (EventPose, EventFieldOfView)}
+        replay = CarmSimulatorReplay(events, callbacks)
+        self.assertEqual(replay.GetDuration(), 2.0)
+        self.assertEqual(replay.Step(0.75), 2)
+        self.assertEqual(applied, [(EventPose, 1.0, 0.0)])
+        replay.Run()
+        self.assertTrue(replay.IsFinished())
+        self.assertEqual(applied[-1], (EventFieldOfView, 4.0, 12.5))
+        self.assertEqual(replay.appliedCount, 3)
+
+    def test_ReadsVersion1(self):
+        # Version 1 stored the event value as int32
+        with open(self.path, 'wb') as f:
+            f.write(HeaderStruct.pack(RecordingMagic, 1, RecordStruct.size))
+            f.write(np.array([(0.5, EventFieldOfView, b'', [1, 2, 3, 4, 27], 46)],
+                             dtype=RecordDTypeVersion1).tobytes())
+        events = ReadRecording(self.path)
+        self.assertEqual(events['value'].dtype, np.float32)
+        self.assertEqual(events['value'][0], 46.0)
+
+    def test_RejectsOtherFiles(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a recording at all')
+        with self.assertRaises(ValueError):
+            ReadRecording(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+# Module scripts, when not run from within Slicer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from CarmSimulatorSessionStore import CarmSimulatorSessionStore, GroupedPercentiles
+
+
+class CarmSimulatorGroupedPercentilesTest(unittest.TestCase):
+
+    def test_MatchesNumPy(self):
+        generator = np.random.default_rng(1)
+        groups = generator.integers(0, 7, 500)
+        # Group 6 gets a single value
+        groups[groups == 6] = 5
+        groups[0] = 6
+        values = generator.exponential(30.0, 500)
+        percentiles = (0, 10, 25, 50, 75, 90, 99, 100)
+        uniqueGroups, counts, means, result = GroupedPercentiles(groups, values, percentiles)
+        np.testing.assert_array_equal(uniqueGroups, np.arange(7))
+        for index, group in enumerate(uniqueGroups):
+            groupValues = values[groups == group]
+            self.assertEqual(counts[index], len(groupValues))
+            self.assertAlmostEqual(means[index], groupValues.mean())
+            np.testing.assert_allclose(result[index], np.percentile(groupValues, percentiles), rtol=1e-12)
+
+    def test_StringGroupsAndEmpty(self):
+        uniqueGroups, counts, means, result = GroupedPercentiles(["b", "a", "b"], [3.0, 1.0, 5.0], (50,))
+        self.assertEqual(list(uniqueGroups), ["a", "b"])
+        np.testing.assert_allclose(result[:, 0], [1.0, 4.0])
+        uniqueGroups, counts, means, result = GroupedPercentiles([], [], (50, 90))
+        self.assertEqual(result.shape, (0, 2))
+
+
+class CarmSimulatorSessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = CarmSimulatorSessionStore(os.path.join(self.directory, 'Sessions.sqlite'), batchInterval=0.01)
+
+    def tearDown(self):
+        self.store.Close()
+        shutil.rmtree(self.directory)
+
+    def test_SessionsAndShots(self):
+        completed = self.store.BeginSession("trainee", "case")
+        for index, label in enumerate(["Full AP", "Full Lateral", "Full AP"]):
+            self.store.AddShot(completed, index, label, [0, 0, 0, 0, 27], index + 1, 10.0 * (index + 1), 10.0,
+                               score=80.0 + index)
+        self.store.EndSession(completed, 6, 30.0, doseAreaProduct=12.0, peakSkinDose=3.0)
+        abandoned = self.store.BeginSession("trainee", "case")
+        self.store.AddShot(abandoned, 0, "Full AP", [0, 0, 0, 0, 27], 9, 50.0, 50.0)
+        self.store.EndSession(abandoned, 9, 50.0, completed=False)
+        self.store.Flush()
+
+        shots = self.store.GetShots()
+        self.assertEqual(len(shots["id"]), 4)
+        shotsPerImage = self.store.GetShotsPerImage(percentiles=(50,))
+        self.assertEqual(shotsPerImage["Full AP"]["count"], 3)
+        self.assertEqual(shotsPerImage["Full Lateral"]["p50"], 2.0)
+        # Shots without a score are left out of the score summary
+        self.assertEqual(self.store.GetScorePerView()["Full AP"]["count"], 2)
+
+        # Only the completed session counts towards the cohort
+        cohort = self.store.GetCohortPercentiles("totalShots", percentiles=(50,))
+        self.assertEqual(cohort["trainee"]["count"], 1)
+        self.assertEqual(cohort["trainee"]["p50"], 6.0)
+        self.assertEqual(self.store.GetStatistics()["written"], 8)
+
+        # Later calls only read the new rows
+        self.store.AddShot(completed, 3, "Full AP", [0, 0, 0, 0, 27], 1, 60.0, 10.0)
+        self.store.Flush()
+        self.assertEqual(len(self.store.GetShots()["id"]), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import numpy as np
+
+#
+# Synthetic CT volumes shared by the tests
+#
+
+
+def CreatePhantom():
+    # CT (HU) of an elliptic body with a spine, on a table slab, surrounded by air, and its ijkToRAS
+    shape = (80, 120, 120)
+    k, j, i = np.indices(shape)
+    scalars = np.full(shape, -1000, dtype=np.int16)
+    body = (np.hypot((j - 60) / 0.7, i - 60) < 36) & (k > 12) & (k < 68)
+    scalars[body] = 40
+    scalars[body & (np.hypot(j - 68, i - 60) < 6)] = 1200
+    scalars[(j > 100) & (j < 105)] = 200
+    ijkToRAS = np.diag([2.5, 2.5, 3.5, 1.0])
+    ijkToRAS[:3, 3] = [-150.0, -150.0, -140.0]
+    return scalars, ijkToRAS
+
+
+def WriteMetaImage(path, scalars, spacing=(1.0, 1.0, 1.0), offset=(0.0, 0.0, 0.0)):
+    # int16 scalars indexed [k, j, i], written as a single .mha file
+    with open(path, 'wb') as f:
+        f.write(("ObjectType = Image\nNDims = 3\nDimSize = %d %d %d\nElementSpacing = %g %g %g\n"
+                 "Offset = %g %g %g\nElementType = MET_SHORT\nElementDataFile = LOCAL\n" %
+                 (tuple(scalars.shape[::-1]) + tuple(spacing) + tuple(offset))).encode())
+        f.write(np.ascontiguousarray(scalars, dtype='<i2').tobytes())